@@ -0,0 +1,67 @@
+# Benchmark: top-k control store search over the trajectory index (control_index.py) against the
+# exhaustive scoring of control_matching.py, on a synthetic chain, with the match quality report.
+#
+# Usage:
+#   python benchmarks/bench_control_matching.py                      # 5,000 stores, 500 trials
+#   python benchmarks/bench_control_matching.py --stores 20000 --trials 1000 --oversample 10
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+from control_index import DEFAULT_OVERSAMPLE, build_trajectory_index, match_quality, top_k_control_stores  # noqa: E402
+from control_matching import find_similar_control_stores  # noqa: E402
+
+
+# Synthetic pre-trial measures: seven months of sales and customers per store,
+# a store level times a shared seasonal shape plus store-specific noise
+def synthetic_pre_trial_measures(n_stores, seed=0):
+    rng = np.random.default_rng(seed)
+    months = np.array([201807, 201808, 201809, 201810, 201811, 201812, 201901])
+    level = rng.lognormal(6, 0.3, (n_stores, 1))
+    season = 1 + 0.05 * np.sin(np.arange(len(months)))
+    sales = level * season * (1 + 0.1 * rng.normal(size=(n_stores, len(months))))
+    customers = np.round(sales / 8 * (1 + 0.05 * rng.normal(size=sales.shape)))
+    return pd.DataFrame({
+        'STORE_NBR': np.repeat(np.arange(1, n_stores + 1), len(months)),
+        'YEARMONTH': np.tile(months, n_stores),
+        'Total Sales': sales.ravel(),
+        'no_Customers': customers.ravel()
+    })
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the indexed top-k control store search.')
+    parser.add_argument('--stores', type=int, default=5000)
+    parser.add_argument('--trials', type=int, default=500)
+    parser.add_argument('--k', type=int, default=5)
+    parser.add_argument('--oversample', type=int, default=DEFAULT_OVERSAMPLE)
+    args = parser.parse_args()
+
+    preTrialMeasures = synthetic_pre_trial_measures(args.stores)
+    trial_stores = np.random.default_rng(1).choice(preTrialMeasures['STORE_NBR'].unique(), args.trials, replace=False)
+
+    start = time.perf_counter()
+    exhaustive = find_similar_control_stores(preTrialMeasures, trial_stores, n=args.k)
+    exhaustive_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    index = build_trajectory_index(preTrialMeasures)
+    build_time = time.perf_counter() - start
+    start = time.perf_counter()
+    approximate = top_k_control_stores(index, trial_stores, k=args.k, oversample=args.oversample)
+    query_time = time.perf_counter() - start
+
+    quality = match_quality(exhaustive, approximate)
+    print(f'{args.stores:,} stores, {args.trials:,} trial stores, top {args.k}, oversample {args.oversample}')
+    print(f'Exhaustive scoring: {exhaustive_time:8.2f} s')
+    print(f'Index build:        {build_time:8.2f} s')
+    print(f'Index query:        {query_time:8.2f} s')
+    print(f'Speedup:            {exhaustive_time / (build_time + query_time):8.1f}x')
+    print(f"Recall@{args.k}:           {quality['recall'].mean():8.3f}")
+    print(f"Best match found:   {quality['best_match'].mean():8.3f}")
+    print(f"Max score diff:     {quality['max_score_diff'].max():8.1e}")
@@ -0,0 +1,80 @@
+# Benchmark: measureOverTime with the fused single-pass aggregation (store_metrics.py)
+# against the original per-metric groupbys of Trial_store_analysis.py, on synthetic data.
+#
+# Usage:
+#   python benchmarks/bench_measure_over_time.py               # 50M rows
+#   python benchmarks/bench_measure_over_time.py --rows 5000000
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+from store_metrics import compute_measure_over_time  # noqa: E402
+
+
+# Synthetic cleaned transactions with the columns measureOverTime needs
+# Roughly QVI shaped: 272 stores, 12 months, one or two chip packets per line
+def synthetic_transactions(n_rows, n_stores=272, n_customers=70_000, seed=0):
+    rng = np.random.default_rng(seed)
+    months = np.array([201807, 201808, 201809, 201810, 201811, 201812,
+                       201901, 201902, 201903, 201904, 201905, 201906])
+    qty = rng.choice(np.array([1, 2, 3, 4, 5], dtype=np.int32), n_rows, p=[0.1, 0.8, 0.05, 0.03, 0.02])
+    return pd.DataFrame({
+        'STORE_NBR': rng.integers(1, n_stores + 1, n_rows, dtype=np.int32),
+        'YEARMONTH': months[rng.integers(0, len(months), n_rows)],
+        'LYLTY_CARD_NBR': rng.integers(1000, 1000 + n_customers, n_rows),
+        'TXN_ID': np.arange(n_rows) // 2,
+        'PROD_QTY': qty,
+        'TOT_SALES': (qty * rng.uniform(1.5, 6.5, n_rows)).round(1)
+    })
+
+
+# The original measureOverTime code of Trial_store_analysis.py
+def legacy_measure_over_time(df1):
+    Total_Sales = df1.groupby(['STORE_NBR', 'YEARMONTH']).TOT_SALES.sum()
+    no_Customers = df1.groupby(['STORE_NBR', 'YEARMONTH']).LYLTY_CARD_NBR.nunique()
+    trans_per_customer = df1.groupby(['STORE_NBR', 'YEARMONTH']).TXN_ID.nunique() / df1.groupby(['STORE_NBR', 'YEARMONTH']).LYLTY_CARD_NBR.nunique()
+    chips_per_customer = df1.groupby(['STORE_NBR', 'YEARMONTH']).PROD_QTY.sum() / df1.groupby(['STORE_NBR', 'YEARMONTH']).TXN_ID.nunique()
+    average_price = df1.groupby(['STORE_NBR', 'YEARMONTH']).TOT_SALES.sum() / df1.groupby(['STORE_NBR', 'YEARMONTH']).PROD_QTY.sum()
+    measureOverTime = pd.concat([Total_Sales, no_Customers, trans_per_customer, chips_per_customer, average_price],
+                                join='outer', axis=1)
+    measureOverTime.rename(columns={
+        'TOT_SALES': 'Total Sales',
+        'LYLTY_CARD_NBR': 'no_Customers',
+        0: 'trans_per_customer',
+        1: 'chips_per_customer',
+        2: 'average_price'
+    }, inplace=True)
+    return measureOverTime
+
+
+# Best wall time of repeat runs
+def best_time(func, df, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(df)
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the fused measureOverTime aggregation.')
+    parser.add_argument('--rows', type=int, default=50_000_000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    df = synthetic_transactions(args.rows)
+    print(f'Synthetic transactions: {len(df):,} rows, {df.memory_usage().sum() / 1e6:,.0f} MB')
+
+    legacy_time, legacy = best_time(legacy_measure_over_time, df, args.repeat)
+    fused_time, fused = best_time(compute_measure_over_time, df, args.repeat)
+    pd.testing.assert_frame_equal(fused, legacy, check_dtype=False, check_index_type=False)
+
+    print(f'Legacy groupbys: {legacy_time:8.2f} s')
+    print(f'Fused pass:      {fused_time:8.2f} s')
+    print(f'Speedup:         {legacy_time / fused_time:8.1f}x')
@@ -0,0 +1,200 @@
+# Benchmark harness: times and memory-profiles every stage of the analysis on synthetic
+# QVI-shaped data (synthetic_data.py), so performance regressions show up before they reach
+# the real data. Stages, in the order of chip_analysis.py, QVI_analysis.py and Trial_store_analysis.py:
+#   load, cleaning, customer_index, merge, segment_analysis, measure_over_time, control_matching, trial_assessment
+# customer_index builds and saves the index of the customer file, merge opens it and joins the
+# customers as the scripts do (join_customers); merge_baseline times the pd.merge it replaced,
+# on the same input, for comparison.
+# Peak memory per stage is the peak of Python allocations traced by tracemalloc (numpy and pandas
+# buffers included); tracing slows the stages down, use --no-memory for timings only.
+#
+# Usage:
+#   python benchmarks/bench_pipeline.py --rows 1000000 --output bench_results.json
+#   python benchmarks/bench_pipeline.py --rows 1000000 --baseline bench_results.json --tolerance 0.25
+# With --baseline the exit status is 1 if a stage got slower or needs more memory than the baseline
+# allows, so the harness can gate a CI job.
+import argparse
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+from cleaning_pipeline import clean_transactions, find_excluded_customers  # noqa: E402
+from control_matching import find_similar_control_stores  # noqa: E402
+from customer_index import join_customers, load_customer_index  # noqa: E402
+from exclusion_rules import customer_rule_candidates  # noqa: E402
+from execution_backend import stores_missing_months  # noqa: E402
+from product_dimension import PRODUCT_DIMENSION_PATH, load_product_dimension  # noqa: E402
+from qvi_io import CLEANED_DTYPES, add_yearmonth, apply_schema  # noqa: E402
+from segment_cube import build_segment_cube, rollup, welch_test  # noqa: E402
+from store_metrics import compute_measure_over_time  # noqa: E402
+from synthetic_data import write_synthetic_data  # noqa: E402
+from trial_batch import complete_stores_only, evaluate_trials  # noqa: E402
+
+# Trial stores and period of Trial_store_analysis.py
+TRIAL_STORES = [77, 86, 88]
+TRIAL_PERIOD = (201902, 201904)
+
+# Target segment of QVI_analysis.py
+TARGET = {'PREMIUM_CUSTOMER': 'Mainstream', 'LIFESTAGE': ['MIDAGE SINGLES/COUPLES', 'YOUNG SINGLES/COUPLES']}
+
+# Default allowed slowdown (and memory growth) against a baseline, as a fraction
+DEFAULT_TOLERANCE = 0.25
+
+
+# Run func(*args) and measure it: returns (result, {'seconds': ..., 'peak_bytes': ...})
+def measure(func, *args, memory=True):
+    if memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args)
+    seconds = time.perf_counter() - start
+    peak_bytes = None
+    if memory:
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result, {'seconds': seconds, 'peak_bytes': peak_bytes}
+
+
+def load_stage(transaction_path, customer_path):
+    return pd.read_csv(transaction_path), pd.read_csv(customer_path)
+
+
+# Product dimension, excluded customers, then the cleaning steps of cleaning_pipeline.py on the whole table
+def cleaning_stage(transactions, product_dim_path):
+    products = transactions[['PROD_NBR', 'PROD_NAME']].drop_duplicates()
+    product_dim = load_product_dimension(products, product_dim_path)
+    candidates = transactions[customer_rule_candidates(transactions)]
+    return clean_transactions(transactions, find_excluded_customers(candidates, product_dim), product_dim)
+
+
+# Customer index of the customer file, saved to index_path as the scripts do when the file changed
+def customer_index_stage(customer_path, index_path):
+    return load_customer_index(customer_path, index_path)
+
+
+# Customer join of cleaning_pipeline.py through the saved customer index, in the compact schema
+# read_cleaned_data returns
+def merge_stage(cleaned, customer_path, index_path):
+    merged = join_customers(cleaned, load_customer_index(customer_path, index_path))
+    add_yearmonth(merged)
+    return apply_schema(merged[list(CLEANED_DTYPES)])
+
+
+# Baseline of the customer join: the hash join of pd.merge the customer index replaced
+def merge_baseline_stage(cleaned, customers):
+    merged = pd.merge(cleaned, customers, on='LYLTY_CARD_NBR', how='left')
+    add_yearmonth(merged)
+    return apply_schema(merged[list(CLEANED_DTYPES)])
+
+
+# Segment cube and the target segment summaries of QVI_analysis.py
+def segment_analysis_stage(merged):
+    cube = build_segment_cube(merged)
+    rollup(cube, ['LIFESTAGE', 'PREMIUM_CUSTOMER'])
+    rollup(cube, ['BRAND'], TARGET)
+    rollup(cube, ['PACK_SIZE'], TARGET)
+    for segment in ['Budget', 'Premium']:
+        welch_test(cube, TARGET, {**TARGET, 'PREMIUM_CUSTOMER': segment})
+    return cube
+
+
+def measure_over_time_stage(merged):
+    measureOverTime = compute_measure_over_time(merged).reset_index()
+    return measureOverTime[~measureOverTime['STORE_NBR'].isin(stores_missing_months(measureOverTime))]
+
+
+def control_matching_stage(measureOverTime):
+    preTrialMeasures = measureOverTime[measureOverTime['YEARMONTH'] < TRIAL_PERIOD[0]]
+    return find_similar_control_stores(preTrialMeasures, TRIAL_STORES)
+
+
+def trial_assessment_stage(measureOverTime):
+    specs = [(trial_store, TRIAL_PERIOD) for trial_store in TRIAL_STORES]
+    return evaluate_trials(complete_stores_only(measureOverTime), specs, processes=1)
+
+
+# Generate the data (unless data_dir already holds it) and run every stage once
+def run_benchmark(n_rows, data_dir=None, memory=True, seed=0):
+    with tempfile.TemporaryDirectory() as tmp:
+        data_dir = data_dir or tmp
+        transaction_path = os.path.join(data_dir, 'QVI_transaction_data.csv')
+        customer_path = os.path.join(data_dir, 'QVI_purchase_behaviour.csv')
+        if not os.path.exists(transaction_path):
+            write_synthetic_data(data_dir, n_rows, seed=seed)
+
+        stages = {}
+        (transactions, customers), stages['load'] = measure(load_stage, transaction_path, customer_path, memory=memory)
+        product_dim_path = os.path.join(tmp, os.path.basename(PRODUCT_DIMENSION_PATH))
+        cleaned, stages['cleaning'] = measure(cleaning_stage, transactions, product_dim_path, memory=memory)
+        del transactions
+        index_path = os.path.join(tmp, 'customer_index')
+        _, stages['customer_index'] = measure(customer_index_stage, customer_path, index_path, memory=memory)
+        merged, stages['merge'] = measure(merge_stage, cleaned, customer_path, index_path, memory=memory)
+        _, stages['merge_baseline'] = measure(merge_baseline_stage, cleaned, customers, memory=memory)
+        del cleaned
+        _, stages['segment_analysis'] = measure(segment_analysis_stage, merged, memory=memory)
+        measureOverTime, stages['measure_over_time'] = measure(measure_over_time_stage, merged, memory=memory)
+        _, stages['control_matching'] = measure(control_matching_stage, measureOverTime, memory=memory)
+        _, stages['trial_assessment'] = measure(trial_assessment_stage, measureOverTime, memory=memory)
+
+    return {
+        'rows': len(merged),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'max_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        'stages': stages
+    }
+
+
+# Stages that got slower or need more memory than the baseline allows: list of messages
+def find_regressions(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    regressions = []
+    for stage, current in results['stages'].items():
+        expected = baseline['stages'].get(stage)
+        if expected is None:
+            continue
+        for measure_name in ['seconds', 'peak_bytes']:
+            if current[measure_name] is None or expected[measure_name] is None:
+                continue
+            if current[measure_name] > expected[measure_name] * (1 + tolerance):
+                regressions.append(f'{stage}: {measure_name} {current[measure_name]:,.2f} against '
+                                   f'{expected[measure_name]:,.2f} in the baseline')
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time and memory-profile the analysis stages on synthetic data.')
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--data-dir', default=None, help='reuse (or keep) the synthetic files in this directory')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-memory', action='store_true', help='skip tracemalloc, timings only')
+    parser.add_argument('--output', default=None, help='write the results as JSON')
+    parser.add_argument('--baseline', default=None, help='results JSON of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args()
+
+    results = run_benchmark(args.rows, args.data_dir, memory=not args.no_memory, seed=args.seed)
+    print(f"{args.rows:,} transaction rows, {results['rows']:,} after cleaning")
+    for stage, measures in results['stages'].items():
+        peak = '' if measures['peak_bytes'] is None else f"{measures['peak_bytes'] / 1024 ** 2:10.1f} MB peak"
+        print(f"{stage:<18}{measures['seconds']:8.2f} s{peak}")
+    print(f"Max RSS: {results['max_rss_bytes'] / 1024 ** 2:.0f} MB")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = find_regressions(results, json.load(f), args.tolerance)
+        for message in regressions:
+            print(f'Regression: {message}')
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,177 @@
+# Synthetic QVI-shaped data generator
+# Writes QVI_transaction_data.csv and QVI_purchase_behaviour.csv with the schema chip_analysis.py
+# reads (DATE as an Excel serial day number, STORE_NBR, LYLTY_CARD_NBR, TXN_ID, PROD_NBR, PROD_NAME,
+# PROD_QTY, TOT_SALES), at any scale: transactions are generated and appended chunk by chunk, so
+# 500M rows need no more memory than a single chunk.
+#
+# The data keeps the features the cleaning steps look for: salsa products, brand spellings that
+# brand_replacements cleans up, a commercial customer buying 200 packs, no trading on Christmas Day
+# and two stores that miss a month (so they drop out of control store matching).
+#
+# Usage:
+#   python benchmarks/synthetic_data.py --rows 10000000 --output-dir synthetic
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+# 1 Jul 2018 as an Excel serial day number, the data covers one year from there
+FIRST_DAY_SERIAL = 43282
+N_DAYS = 365
+
+# Christmas Day 2018, stores are closed
+CHRISTMAS_SERIAL = 43459
+
+# Product lines, flavours and pack sizes of the product catalogue
+# Several lines use the spellings cleaned up by brand_replacements (Red, Smith, Dorito, Woolworths, Infzns)
+PRODUCT_LINES = [
+    'Natural Chip Compny', 'Red Rock Deli', 'Smiths Crinkle Cut', 'Smith Crinkle Cut', 'Kettle Sensations',
+    'Kettle Tortilla', 'Doritos Corn Chips', 'Dorito Corn Chp', 'Woolworths Mild', 'Infzns Crn Crnchers',
+    'Infuzions Thai', 'Pringles Sthrn', 'Thins Chips Light&', 'WW Original Stacked', 'Cobs Popd Sea Salt',
+    'Tostitos Splash Of', 'Twisties Cheese', 'Grain Waves Sour', 'CCs Nacho Cheese', 'Smiths Chip Thinly'
+]
+SALSA_LINES = ['Old El Paso Salsa Dip', 'Doritos Salsa Mild', 'Woolworths Medium Salsa']
+FLAVOURS = ['SeaSalt', 'Chilli', 'Cheese', 'Original', 'BBQ', 'Lime']
+PACK_SIZES = [70, 90, 110, 134, 150, 165, 170, 175, 190, 200, 210, 250, 270, 300, 330, 380]
+
+# Customer segments and their shares in QVI_purchase_behaviour
+LIFESTAGES = {
+    'RETIREES': 0.204, 'OLDER SINGLES/COUPLES': 0.201, 'YOUNG SINGLES/COUPLES': 0.199, 'OLDER FAMILIES': 0.135,
+    'YOUNG FAMILIES': 0.126, 'MIDAGE SINGLES/COUPLES': 0.100, 'NEW FAMILIES': 0.035
+}
+PREMIUM_CUSTOMERS = {'Mainstream': 0.403, 'Budget': 0.337, 'Premium': 0.260}
+
+# Packs bought per transaction line
+PROD_QTY_SHARES = {1: 0.1, 2: 0.8, 3: 0.05, 4: 0.03, 5: 0.02}
+
+# Loyalty card numbers are STORE_NBR * CARDS_PER_STORE + customer number within the store
+CARDS_PER_STORE = 100_000
+
+# The commercial customer who bought 200 packs twice, removed as an outlier by the cleaning steps
+OUTLIER_STORE = 226
+OUTLIER_CARD = OUTLIER_STORE * CARDS_PER_STORE + CARDS_PER_STORE - 1
+OUTLIER_QTY = 200
+
+# Stores without any transactions in March 2019
+MISSING_MONTH_STORES = [11, 31]
+MISSING_MONTH = (43525, 43556)
+
+# Transaction rows generated per chunk
+DEFAULT_CHUNK_ROWS = 5_000_000
+
+
+# Product catalogue: PROD_NBR, PROD_NAME and the unit price, salsa products included
+def product_catalogue(n_products=114, seed=0):
+    rng = np.random.default_rng(seed)
+    lines = PRODUCT_LINES + SALSA_LINES
+    names = []
+    for i in range(n_products):
+        line = lines[i % len(lines)]
+        names.append(f'{line} {FLAVOURS[(i // len(lines)) % len(FLAVOURS)]} {PACK_SIZES[i % len(PACK_SIZES)]}g')
+    return pd.DataFrame({
+        'PROD_NBR': np.arange(1, n_products + 1),
+        'PROD_NAME': names,
+        'PRICE': rng.uniform(1.5, 6.5, n_products).round(1)
+    })
+
+
+# Purchase behaviour: one row per loyalty card with LIFESTAGE and PREMIUM_CUSTOMER
+# Customers are spread evenly over the stores, the outlier customer is added at the end
+def synthetic_customers(n_customers, n_stores=272, seed=0):
+    rng = np.random.default_rng(seed)
+    per_store = min(max(1, n_customers // n_stores), CARDS_PER_STORE - 2)
+    stores = np.repeat(np.arange(1, n_stores + 1), per_store)
+    cards = stores * CARDS_PER_STORE + np.tile(np.arange(per_store), n_stores)
+    customers = pd.DataFrame({
+        'LYLTY_CARD_NBR': np.append(cards, OUTLIER_CARD),
+        'LIFESTAGE': rng.choice(list(LIFESTAGES), len(cards) + 1, p=list(LIFESTAGES.values())),
+        'PREMIUM_CUSTOMER': rng.choice(list(PREMIUM_CUSTOMERS), len(cards) + 1, p=list(PREMIUM_CUSTOMERS.values()))
+    })
+    return customers
+
+
+# Generator over chunks of synthetic transactions
+# Each customer shops at their home store; a transaction has one to three product lines
+def iter_synthetic_transactions(n_rows, customers, products, chunk_rows=DEFAULT_CHUNK_ROWS, seed=0):
+    rng = np.random.default_rng(seed)
+    cards = customers['LYLTY_CARD_NBR'].to_numpy()[:-1]
+    qty_values = np.array(list(PROD_QTY_SHARES))
+    qty_shares = np.array(list(PROD_QTY_SHARES.values()))
+    next_txn = 1
+    for start in range(0, n_rows, chunk_rows):
+        n = min(chunk_rows, n_rows - start)
+        lines_per_txn = rng.choice([1, 2, 3], n, p=[0.9, 0.08, 0.02])
+        txn = np.repeat(np.arange(next_txn, next_txn + n), lines_per_txn)[:n]
+        next_txn = txn[-1] + 1
+        # All lines of a transaction share the customer and the day
+        first = np.r_[True, txn[1:] != txn[:-1]]
+        txn_card = cards[rng.integers(0, len(cards), first.sum())]
+        txn_day = FIRST_DAY_SERIAL + rng.integers(0, N_DAYS, first.sum())
+        txn_day[txn_day == CHRISTMAS_SERIAL] += 1
+        card = txn_card[np.cumsum(first) - 1]
+        day = txn_day[np.cumsum(first) - 1]
+        store = card // CARDS_PER_STORE
+        product = rng.integers(0, len(products), n)
+        qty = rng.choice(qty_values, n, p=qty_shares)
+        chunk = pd.DataFrame({
+            'DATE': day,
+            'STORE_NBR': store,
+            'LYLTY_CARD_NBR': card,
+            'TXN_ID': txn,
+            'PROD_NBR': products['PROD_NBR'].to_numpy()[product],
+            'PROD_NAME': products['PROD_NAME'].to_numpy()[product],
+            'PROD_QTY': qty,
+            'TOT_SALES': (qty * products['PRICE'].to_numpy()[product]).round(1)
+        })
+        missing = np.isin(store, MISSING_MONTH_STORES) & (day >= MISSING_MONTH[0]) & (day < MISSING_MONTH[1])
+        chunk = chunk[~missing]
+        if start == 0:
+            chunk = pd.concat([chunk, outlier_transactions(products, next_txn)], ignore_index=True)
+            next_txn += 2
+        yield chunk
+
+
+# The two 200 pack purchases of the commercial customer
+def outlier_transactions(products, first_txn):
+    product = products[~products['PROD_NAME'].str.contains('Salsa')].iloc[0]
+    return pd.DataFrame({
+        'DATE': [FIRST_DAY_SERIAL + 48, FIRST_DAY_SERIAL + 230],
+        'STORE_NBR': OUTLIER_STORE,
+        'LYLTY_CARD_NBR': OUTLIER_CARD,
+        'TXN_ID': [first_txn, first_txn + 1],
+        'PROD_NBR': product['PROD_NBR'],
+        'PROD_NAME': product['PROD_NAME'],
+        'PROD_QTY': OUTLIER_QTY,
+        'TOT_SALES': round(OUTLIER_QTY * product['PRICE'], 1)
+    })
+
+
+# Write both files to output_dir, returns their paths
+# n_customers defaults to one customer per four transaction lines, as in the QVI data
+def write_synthetic_data(output_dir, n_rows, n_customers=None, n_stores=272, chunk_rows=DEFAULT_CHUNK_ROWS, seed=0):
+    os.makedirs(output_dir, exist_ok=True)
+    customers = synthetic_customers(n_customers or max(n_stores, n_rows // 4), n_stores, seed)
+    products = product_catalogue(seed=seed)
+    customer_path = os.path.join(output_dir, 'QVI_purchase_behaviour.csv')
+    transaction_path = os.path.join(output_dir, 'QVI_transaction_data.csv')
+    customers.to_csv(customer_path, index=False)
+    header = True
+    for chunk in iter_synthetic_transactions(n_rows, customers, products, chunk_rows, seed):
+        chunk.to_csv(transaction_path, mode='w' if header else 'a', header=header, index=False)
+        header = False
+    return transaction_path, customer_path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write synthetic QVI transaction and purchase behaviour files.')
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--customers', type=int, default=None)
+    parser.add_argument('--stores', type=int, default=272)
+    parser.add_argument('--chunk-rows', type=int, default=DEFAULT_CHUNK_ROWS)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output-dir', default='synthetic')
+    args = parser.parse_args()
+
+    paths = write_synthetic_data(args.output_dir, args.rows, args.customers, args.stores, args.chunk_rows, args.seed)
+    print(f'{args.rows:,} transaction rows written to {paths[0]}, customers to {paths[1]}')
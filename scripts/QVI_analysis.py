@@ -1,15 +1,24 @@
 import pandas as pd
 from datetime import timedelta, datetime
 import matplotlib.pyplot as plt
-from scipy import stats
 import seaborn as sns
+from affinity import build_purchase_matrices, segment_affinity, top_affinities
+from qvi_io import CLEANED_DATA_PATH, category_mask, read_cleaned_data
+from report import show_figures, write_report
+from resampling import bootstrap_ci, permutation_test
+from segment_cube import CUBE_COLUMNS, build_segment_cube, moments, rollup, welch_test
 
 
-#Load the data
-merged_clean_data = pd.read_csv('QVI_cleaned_data.csv')
+#Load the data, only the columns used in this analysis
+merged_clean_data = read_cleaned_data(CLEANED_DATA_PATH, columns=CUBE_COLUMNS + ['LYLTY_CARD_NBR'])
+
+# Precompute the segment cube (LIFESTAGE x PREMIUM_CUSTOMER x BRAND x PACK_SIZE x month x store) in one pass,
+# the segment totals, averages and preference counts below are roll-ups of the cube
+segment_cube = build_segment_cube(merged_clean_data)
+segment_totals = rollup(segment_cube, ['LIFESTAGE', 'PREMIUM_CUSTOMER'])
 
 # Total sales by LIFESTAGE and PREMIUM_CUSTOMER
-total_sales = merged_clean_data.groupby(['LIFESTAGE', 'PREMIUM_CUSTOMER'])['TOT_SALES'].sum().reset_index()
+total_sales = segment_totals['TOT_SALES'].reset_index()
 
 plt.rcParams["figure.figsize"] = (18, 10)
 plt.xticks(rotation=45)
@@ -21,21 +30,21 @@ plt.ylabel('Total Sales')
 plt.xticks(rotation=45)
 plt.legend(title='PREMIUM_CUSTOMER', loc='upper right')
 plt.tight_layout()
-plt.show()
+show_figures('total_sales_by_segment')
 
 # Number of customers by LIFESTAGE and PREMIUM_CUSTOMER
 # total_customer= merged_clean_data.groupby(['LIFESTAGE', 'PREMIUM_CUSTOMER'])['LYLTY_CARD_NBR'].count().reset_index()
 # total_customer_AVG= merged_clean_data.groupby(['LIFESTAGE', 'PREMIUM_CUSTOMER'])['PROD_QTY'].mean().reset_index()
 
 merged_clean_data['PRICE_PER_UNIT'] = merged_clean_data['TOT_SALES'] / merged_clean_data['PROD_QTY']
-total_avg_price_per_unit = merged_clean_data.groupby(['LIFESTAGE', 'PREMIUM_CUSTOMER'])['PRICE_PER_UNIT'].mean().reset_index()
+total_avg_price_per_unit = moments(segment_totals, 'PRICE_PER_UNIT')['mean'].rename('PRICE_PER_UNIT').reset_index()
 # total_customer_by_lifestyle= total_customer.groupby(['LIFESTAGE']).sum().reset_index()
 # total_customer_by_premium= total_customer.groupby(['PREMIUM_CUSTOMER']).sum().reset_index()
 # Pivot the DataFrame for plotting
 # Set plot size
 # Plotting the total average price per unit
 # Calculate average units sold
-average_units_sold = merged_clean_data.groupby(['LIFESTAGE', 'PREMIUM_CUSTOMER'])['PROD_QTY'].mean().reset_index()
+average_units_sold = moments(segment_totals, 'PROD_QTY')['mean'].rename('PROD_QTY').reset_index()
 
 # Set plot size and theme
 plt.rcParams["figure.figsize"] = (18, 10)
@@ -47,24 +56,28 @@ plt.ylabel('Average Units Sold')
 plt.xticks(rotation=45)
 plt.legend(title='PREMIUM_CUSTOMER', loc='upper right')
 plt.tight_layout()
-plt.show()
+show_figures('average_units_by_segment')
+
+# Segment masks, computed once on the integer codes of the categorical columns
+is_mainstream = category_mask(merged_clean_data['PREMIUM_CUSTOMER'], 'Mainstream')
+is_singles_couples = category_mask(merged_clean_data['LIFESTAGE'], ['MIDAGE SINGLES/COUPLES', 'YOUNG SINGLES/COUPLES'])
 
 # Separate data for the different customer segments
-mainstream = merged_clean_data[(merged_clean_data['PREMIUM_CUSTOMER'] == 'Mainstream') & 
-                               (merged_clean_data['LIFESTAGE'].isin(['MIDAGE SINGLES/COUPLES', 'YOUNG SINGLES/COUPLES']))]
+mainstream = merged_clean_data[is_mainstream & is_singles_couples]
 
-premium = merged_clean_data[(merged_clean_data['PREMIUM_CUSTOMER'] == 'Premium') & 
-                            (merged_clean_data['LIFESTAGE'].isin(['MIDAGE SINGLES/COUPLES', 'YOUNG SINGLES/COUPLES']))]
+premium = merged_clean_data[category_mask(merged_clean_data['PREMIUM_CUSTOMER'], 'Premium') & is_singles_couples]
 
-budget = merged_clean_data[(merged_clean_data['PREMIUM_CUSTOMER'] == 'Budget') & 
-                           (merged_clean_data['LIFESTAGE'].isin(['MIDAGE SINGLES/COUPLES', 'YOUNG SINGLES/COUPLES']))]
+budget = merged_clean_data[category_mask(merged_clean_data['PREMIUM_CUSTOMER'], 'Budget') & is_singles_couples]
 
-# Perform independent t-tests
-t_stat_mainstream_vs_premium, p_value_mainstream_vs_premium = stats.ttest_ind(
-    mainstream['PRICE_PER_UNIT'], premium['PRICE_PER_UNIT'], equal_var=False)
+# Perform independent (Welch) t-tests, from the price per unit sums and sums of squares in the segment cube
+singles_couples = ['MIDAGE SINGLES/COUPLES', 'YOUNG SINGLES/COUPLES']
+t_stat_mainstream_vs_premium, p_value_mainstream_vs_premium = welch_test(
+    segment_cube, {'PREMIUM_CUSTOMER': 'Mainstream', 'LIFESTAGE': singles_couples},
+    {'PREMIUM_CUSTOMER': 'Premium', 'LIFESTAGE': singles_couples})
 
-t_stat_mainstream_vs_budget, p_value_mainstream_vs_budget = stats.ttest_ind(
-    mainstream['PRICE_PER_UNIT'], budget['PRICE_PER_UNIT'], equal_var=False)
+t_stat_mainstream_vs_budget, p_value_mainstream_vs_budget = welch_test(
+    segment_cube, {'PREMIUM_CUSTOMER': 'Mainstream', 'LIFESTAGE': singles_couples},
+    {'PREMIUM_CUSTOMER': 'Budget', 'LIFESTAGE': singles_couples})
 
 # Print the results
 print("Mainstream vs Premium:")
@@ -82,12 +95,19 @@ print(f"T-statistic: {t_stat_mainstream_vs_budget}, P-value: {p_value_mainstream
 #The p-value is extraordinarily small This means there is very strong evidence to reject the null hypothesis for this comparison as well.
 #The large t-statistic values and extremely small p-values suggest that these differences are not due to random chance.
 
-# Filter data for Mainstream - Young Singles/Couples
-mainstream_young = merged_clean_data[(merged_clean_data['PREMIUM_CUSTOMER'] == 'Mainstream') & 
-                                     (merged_clean_data['LIFESTAGE'] == 'YOUNG SINGLES/COUPLES')]
+# Check the same differences with a permutation test and a bootstrap confidence interval, which make no
+# assumption about the distribution of price per unit (10,000 resamples, seeded for reproducibility)
+for segment_name, segment in [('Premium', premium), ('Budget', budget)]:
+    diff, p_value = permutation_test(mainstream['PRICE_PER_UNIT'], segment['PRICE_PER_UNIT'], seed=2019)
+    low, high = bootstrap_ci(mainstream['PRICE_PER_UNIT'], segment['PRICE_PER_UNIT'], seed=2019)
+    print(f"\nMainstream vs {segment_name} (resampling):")
+    print(f"Difference in mean price per unit: {diff:.4f}, permutation p-value: {p_value}, 95% bootstrap CI: ({low:.4f}, {high:.4f})")
+
+# Slice of the segment cube for Mainstream - Young Singles/Couples
+mainstream_young = {'PREMIUM_CUSTOMER': 'Mainstream', 'LIFESTAGE': 'YOUNG SINGLES/COUPLES'}
 
 # Calculating the frequency of each brand
-brand_preferences = mainstream_young['BRAND'].value_counts().reset_index()
+brand_preferences = rollup(segment_cube, ['BRAND'], mainstream_young)['n_rows'].sort_values(ascending=False).reset_index()
 brand_preferences.columns = ['BRAND', 'COUNT']
 print("Brand preferences for Mainstream - Young Singles/Couples:")
 print(brand_preferences)
@@ -98,18 +118,18 @@ sns.barplot(x='COUNT', y='BRAND', data=brand_preferences)
 plt.title('Preferred Brands for Mainstream - Young Singles/Couples')
 plt.xlabel('Count')
 plt.ylabel('Brand')
-plt.show()
+show_figures('brand_preferences')
 
 #Seems like the Kettle brand is signficiantly more preferred by this group.
 
 # Calculating the frequency of each pack size for the target segment
-pack_size_preferences_target = mainstream_young['PACK_SIZE'].value_counts().reset_index()
+pack_size_counts_target = rollup(segment_cube, ['PACK_SIZE'], mainstream_young)['n_rows']
+pack_size_preferences_target = pack_size_counts_target.sort_values(ascending=False).reset_index()
 pack_size_preferences_target.columns = ['PACK_SIZE', 'COUNT']
 
-# Calculating the frequency of each pack size for the rest of the population
-other_segments = merged_clean_data[~((merged_clean_data['PREMIUM_CUSTOMER'] == 'Mainstream') & 
-                                     (merged_clean_data['LIFESTAGE'] == 'YOUNG SINGLES/COUPLES'))]
-pack_size_preferences_other = other_segments['PACK_SIZE'].value_counts().reset_index()
+# Calculating the frequency of each pack size for the rest of the population (all transactions minus the target segment)
+pack_size_counts_other = rollup(segment_cube, ['PACK_SIZE'])['n_rows'].sub(pack_size_counts_target, fill_value=0).astype('int64')
+pack_size_preferences_other = pack_size_counts_other[pack_size_counts_other > 0].sort_values(ascending=False).reset_index()
 pack_size_preferences_other.columns = ['PACK_SIZE', 'COUNT']
 
 # Plot the pack size preferences
@@ -120,7 +140,22 @@ plt.title('Preferred Pack Sizes')
 plt.xlabel('Pack Size')
 plt.ylabel('Count')
 plt.legend()
-plt.show()
+show_figures('pack_size_preferences')
 
 #The most preferred pack size for every group appears to be 175g, followed by 150g and 200g.
-#The secondary preferences (150g and 200g) are also similar between the two groups, indicating a general consistency in pack size preferences among different customer segments.
\ No newline at end of file
+#The secondary preferences (150g and 200g) are also similar between the two groups, indicating a general consistency in pack size preferences among different customer segments.
+
+# Affinity of every segment for every brand and pack size against the rest of the population, from sparse
+# card x brand and card x pack size purchase matrices built in one pass (see affinity.py)
+# affinity > 1: the segment spends a larger share of its units on the item; lift > 1: more of its cards buy it
+purchases = build_purchase_matrices(merged_clean_data)
+brand_affinity = segment_affinity(purchases, 'BRAND')
+pack_size_affinity = segment_affinity(purchases, 'PACK_SIZE')
+print("\nBrand affinity of Mainstream - Young Singles/Couples against the rest of the population:")
+print(top_affinities(brand_affinity, mainstream_young, 10)[['BRAND', 'share', 'share_rest', 'affinity', 'lift']])
+print("\nPack size affinity of Mainstream - Young Singles/Couples against the rest of the population:")
+print(top_affinities(pack_size_affinity, mainstream_young, 10)[['PACK_SIZE', 'share', 'share_rest', 'affinity', 'lift']])
+
+
+# Render the collected figures when running headless (QVI_REPORT_DIR set, see report.py)
+write_report('QVI_analysis')
@@ -1,75 +1,94 @@
 # Data Wrangling
+import os
 import numpy as np
 import pandas as pd
 
 # Visualization
 import matplotlib.pyplot as plt
+from report import show_figures, write_report
 
 # Date Functionality
 import matplotlib.dates as mdates
 
 # Statistics
-from scipy.stats import ttest_ind
+from resampling import METHODS, two_sample_test
 
-# Remove Warnings
-import warnings
-warnings.filterwarnings("ignore")
+# Control store matching
+from control_matching import find_similar_control_stores
+from trial_batch import evaluate_trials
+from synthetic_control import synthetic_control
 
-# Load the data
-df1 = pd.read_csv('QVI_cleaned_data.csv')
+# Trial / control / other stores comparison charts
+from comparison_panels import PANEL_LABELS, comparison_panels, panel_frame
 
-# Display the first few rows of the dataframe
-print(df1.head())
+# Cleaned data hand-off
+from qvi_io import CLEANED_DATA_PATH, read_cleaned_data
 
-# Display the number of missing values in each column
-print(df1.isnull().sum())
+# Store/month measures and the persisted aggregate store
+from store_metrics import compute_measure_over_time
+from monthly_aggregates import AGGREGATE_STORE_PATH, incomplete_stores, load_aggregates, measure_over_time
+from execution_backend import BACKEND, get_backend, stores_missing_months
 
-# Create a month ID in format yyyymm
-df1['YEARMONTH'] = [''.join(x.split('-')[0:2]) for x in df1.DATE]
-df1['YEARMONTH'] = pd.to_numeric(df1['YEARMONTH'])
+# Timing of the named steps when QVI_PROFILE is set
+from instrumentation import step
+
+# Store exclusion rules
+from exclusion_rules import STORE_RULES, evaluate_rules
+
+# Remove Warnings
+import warnings
+warnings.filterwarnings("ignore")
 
-# Total Sales for each store and month
-Total_Sales = df1.groupby(['STORE_NBR', 'YEARMONTH']).TOT_SALES.sum()
+# Read the store/month measures from the persisted aggregate store when QVI_AGGREGATE_STORE is set
+# (see monthly_aggregates.py), compute them out of core when QVI_BACKEND selects another execution
+# backend (see execution_backend.py), otherwise compute them in memory from the cleaned transactions
+if os.environ.get('QVI_AGGREGATE_STORE'):
+    aggregates = load_aggregates(AGGREGATE_STORE_PATH)
+    measureOverTime = measure_over_time(aggregates)
 
-# Number of customers for each store and month
-no_Customers = df1.groupby(['STORE_NBR', 'YEARMONTH']).LYLTY_CARD_NBR.nunique()
+    # Display the dataframe
+    print(measureOverTime)
 
-# Transactions per customer for each store and month
-trans_per_customer = df1.groupby(['STORE_NBR', 'YEARMONTH']).TXN_ID.nunique() / df1.groupby(['STORE_NBR', 'YEARMONTH']).LYLTY_CARD_NBR.nunique()
+    # Store numbers that do not have full observation periods
+    null_stores = incomplete_stores(aggregates)
+elif BACKEND != 'pandas':
+    measureOverTime = get_backend()['measure_over_time'](CLEANED_DATA_PATH)
 
-# Chips per customer for each store and month
-chips_per_customer = df1.groupby(['STORE_NBR', 'YEARMONTH']).PROD_QTY.sum() / df1.groupby(['STORE_NBR', 'YEARMONTH']).TXN_ID.nunique()
+    # Display the dataframe
+    print(measureOverTime)
 
-# Average price per unit for each store and month
-average_price = df1.groupby(['STORE_NBR', 'YEARMONTH']).TOT_SALES.sum() / df1.groupby(['STORE_NBR', 'YEARMONTH']).PROD_QTY.sum()
+    # Store numbers that do not have full observation periods
+    null_stores = stores_missing_months(measureOverTime)
+else:
+    # Load the data, only the columns needed for the store/month measures
+    # The month ID YEARMONTH in format yyyymm comes with the typed DATE column
+    df1 = read_cleaned_data(CLEANED_DATA_PATH, columns=[
+        'DATE', 'YEARMONTH', 'STORE_NBR', 'LYLTY_CARD_NBR', 'TXN_ID', 'PROD_QTY', 'TOT_SALES'])
 
-# Concatenate into a new dataframe 'measureOverTime'
-df2 = [Total_Sales, no_Customers, trans_per_customer, chips_per_customer, average_price]
-measureOverTime = pd.concat(df2, join='outer', axis=1)
+    # Display the first few rows of the dataframe
+    print(df1.head())
 
-# Rename the columns
-measureOverTime.rename(columns={
-    'TOT_SALES': 'Total Sales',
-    'LYLTY_CARD_NBR': 'no_Customers',
-    0: 'trans_per_customer',
-    1: 'chips_per_customer',
-    2: 'average_price'
-}, inplace=True)
+    # Display the number of missing values in each column
+    print(df1.isnull().sum())
 
-# Display the first 15 rows of the dataframe
-print(measureOverTime.head(15))
+    # All store/month measures in a single grouping pass over the (STORE_NBR, YEARMONTH) keys:
+    # Total Sales, no_Customers, trans_per_customer, chips_per_customer and average_price
+    measureOverTime = compute_measure_over_time(df1)
 
-# Reset the index of the dataframe
-measureOverTime.reset_index(inplace=True)
+    # Display the first 15 rows of the dataframe
+    print(measureOverTime.head(15))
 
-# Display the updated dataframe
-print(measureOverTime)
+    # Reset the index of the dataframe
+    measureOverTime.reset_index(inplace=True)
 
-# Create a pivot table to check for full observation periods
-df3 = pd.pivot_table(df1, index='STORE_NBR', columns='YEARMONTH', values='TXN_ID', aggfunc='count')
+    # Display the updated dataframe
+    print(measureOverTime)
 
-# Store numbers that do not have full observation periods
-null_stores = df3[df3.isnull().any(axis=1)].index.tolist()
+    # Check for full observation periods with the incomplete store rule (see exclusion_rules.py):
+    # store numbers that miss a month present in the data
+    with step('null_stores', rows_in=len(df1)) as record:
+        null_stores = evaluate_rules(df1, STORE_RULES)['excluded_keys']['incomplete_store'].tolist()
+        record['rows_out'] = len(null_stores)
 
 # Filter out the null stores
 measureOverTime = measureOverTime[~measureOverTime['STORE_NBR'].isin(null_stores)]
@@ -83,72 +102,25 @@ preTrialMeasures = measureOverTime[measureOverTime['YEARMONTH'] < 201902]
 # Display the pre-trial measures
 print(preTrialMeasures)
 
-# Define function to calculate correlation for a measure
-def calculateCorrelation(inputTable, metricCol, trial_store):
-    calcCorrTable = []
-    x = inputTable.loc[inputTable['STORE_NBR'] == trial_store, metricCol]
-    x.reset_index(drop=True, inplace=True)
-    storeNumbers = inputTable['STORE_NBR'].unique()
-    for i in storeNumbers:
-        y = inputTable.loc[inputTable['STORE_NBR'] == i, metricCol]
-        y.reset_index(drop=True, inplace=True)
-        calcCorrTable.append({'Store1': trial_store, 'Store2': i, 'corr_measure': y.corr(x)})
-    return pd.DataFrame(calcCorrTable)
-
-# Define function to calculate magnitude distance for a measure
-def calculateMagnitudeDistance(inputTable, metricCol, trial_store):
-    calcDistTable = []
-    x = inputTable.loc[inputTable['STORE_NBR'] == trial_store, metricCol]
-    x.reset_index(drop=True, inplace=True)
-    storeNumbers = inputTable['STORE_NBR'].unique()
-    for i in storeNumbers:
-        y = inputTable.loc[inputTable['STORE_NBR'] == i, metricCol]
-        y.reset_index(drop=True, inplace=True)
-        z = abs(x - y)
-        A = np.mean(1 - (z - min(z)) / (max(z) - min(z)))
-        calcDistTable.append({'Store1': trial_store, 'Store2': i, 'Magnitude': A})
-    return pd.DataFrame(calcDistTable)
-
-# Function to find the most similar control store for a given trial store
-# Function to find the most similar control store for a given trial store
-# Function to find the most similar control store for a given trial store
+# Function to find the most similar control stores for a given trial store
+# Correlation and magnitude scores for every candidate store are computed in one batched pass
+# over the store x month matrix of each metric (see control_matching.py)
 def find_similar_control_store(preTrialMeasures, trial_store):
-    corr_Sales = calculateCorrelation(preTrialMeasures, 'Total Sales', trial_store)
-    corr_Customers = calculateCorrelation(preTrialMeasures, 'no_Customers', trial_store)
-
-    magnitude_Sales = calculateMagnitudeDistance(preTrialMeasures, 'Total Sales', trial_store)
-    magnitude_Customers = calculateMagnitudeDistance(preTrialMeasures, 'no_Customers', trial_store)
-
-    # Combine correlation and magnitude scores
-    score_Sales = pd.concat([corr_Sales, magnitude_Sales['Magnitude']], axis=1)
-    score_Customers = pd.concat([corr_Customers, magnitude_Customers['Magnitude']], axis=1)
-
-    # Add an additional column which calculates the weighted average
-    corr_weight = 0.5
-    score_Sales['scoreSales'] = corr_weight * score_Sales['corr_measure'] + (1 - corr_weight) * score_Sales['Magnitude']
-    score_Customers['scoreCustomers'] = corr_weight * score_Customers['corr_measure'] + (1 - corr_weight) * score_Customers['Magnitude']
-
-    # Set index for easier merging
-    score_Sales.set_index(['Store1', 'Store2'], inplace=True)
-    score_Customers.set_index(['Store1', 'Store2'], inplace=True)
-
-    # Combine Sales and Customers scores into one dataframe
-    score_Control = pd.concat([score_Sales['scoreSales'], score_Customers['scoreCustomers']], axis=1)
-
-    # Add a new column 'finalControlScore' to 'score_Control'
-    score_Control['finalControlScore'] = 0.5 * (score_Control['scoreSales'] + score_Control['scoreCustomers'])
-
-    return score_Control.sort_values(by='finalControlScore', ascending=False).head()
+    return find_similar_control_stores(preTrialMeasures, [trial_store], corr_weight=0.5)
 
 # Define the trial stores
 trial_stores = [77, 86, 88]
 
+# Score the candidate control stores for all trial stores at once
+all_similar_control_stores = find_similar_control_stores(preTrialMeasures, trial_stores, corr_weight=0.5)
+
 # Loop through each trial store and create visualizations
 for trial_store in trial_stores:
-    similar_control_stores = find_similar_control_store(preTrialMeasures, trial_store)
+    similar_control_stores = all_similar_control_stores.xs(trial_store, level='Store1', drop_level=False)
 
     # Create a grouped bar chart for correlation scores
-    fig, ax = plt.subplots(figsize=(12, 8))
+    # Labelled figure, saved as control_scores_<store> in the headless report
+    fig, ax = plt.subplots(figsize=(12, 8), num=f'control_scores_{trial_store}')
     width = 0.35  # Width of the bars
 
     store_indices = np.arange(len(similar_control_stores))
@@ -166,73 +138,17 @@ for trial_store in trial_stores:
 # We find that the most similar stores for the trial stores 77, 86 and 88 are store 233, 155 and 14
 # Now I will visualize the total sales and total customer metrics of these stores compared to the baseline others stores
 
-# Function to visualize the metrics
-def visualize_metrics(trial_store, control_store, preTrialMeasures):
-    pastSales = preTrialMeasures.copy()
-    store_type = []
-
-    for i in pastSales['STORE_NBR']:
-        if i == trial_store:
-            store_type.append('Trial Store')
-        elif i == control_store:
-            store_type.append('Control Store')
-        else:
-            store_type.append('Other Stores')
-
-    pastSales['store_type'] = store_type
-    pastSales['TransactionMonth'] = pd.to_datetime(pastSales['YEARMONTH'].astype(str), format='%Y%m')
-    pastSales['Month'] = pd.DatetimeIndex(pastSales['TransactionMonth']).month_name().str[:3]
-
-    controlPlot = pastSales.loc[pastSales['store_type'] == 'Control Store', ['Month', 'Total Sales']]
-    controlPlot.set_index('Month', inplace=True)
-
-    trialPlot = pastSales.loc[pastSales['store_type'] == 'Trial Store', ['Month', 'Total Sales']]
-    trialPlot.set_index('Month', inplace=True)
-
-    otherPlot = pastSales.loc[pastSales['store_type'] == 'Other Stores', ['Month', 'Total Sales']]
-    otherPlot = pd.DataFrame(otherPlot.groupby('Month')['Total Sales'].mean())
-
-    # Renaming Column Names
-    controlPlot.rename(columns={'Total Sales': 'Control Store Sales'}, inplace=True)
-    trialPlot.rename(columns={'Total Sales': 'Trial Store Sales'}, inplace=True)
-    otherPlot.rename(columns={'Total Sales': 'Other Stores Sales'}, inplace=True)
-
-    # Concatenate
-    combinePlot = pd.concat([controlPlot, trialPlot, otherPlot], axis=1)
-
-    # Plot Total Sales
-    combinePlot.plot(kind='line', figsize=(14, 8))
-    plt.title(f'Total Sales Comparison for Trial Store {trial_store} and Control Store {control_store}')
-    plt.xlabel('Month')
-    plt.ylabel('Total Sales')
-    plt.legend()
-    plt.show()
-
-    # Visualize total store customers
-    controlPlot_customers = pastSales.loc[pastSales['store_type'] == 'Control Store', ['Month', 'no_Customers']]
-    controlPlot_customers.set_index('Month', inplace=True)
-
-    trialPlot_customers = pastSales.loc[pastSales['store_type'] == 'Trial Store', ['Month', 'no_Customers']]
-    trialPlot_customers.set_index('Month', inplace=True)
-
-    otherPlot_customers = pastSales.loc[pastSales['store_type'] == 'Other Stores', ['Month', 'no_Customers']]
-    otherPlot_customers = pd.DataFrame(otherPlot_customers.groupby('Month')['no_Customers'].mean())
-
-    # Renaming Column Names
-    controlPlot_customers.rename(columns={'no_Customers': 'Control Store Customers'}, inplace=True)
-    trialPlot_customers.rename(columns={'no_Customers': 'Trial Store Customers'}, inplace=True)
-    otherPlot_customers.rename(columns={'no_Customers': 'Other Stores Customers'}, inplace=True)
-
-    # Concatenate
-    combinePlot_customers = pd.concat([controlPlot_customers, trialPlot_customers, otherPlot_customers], axis=1)
-
-    # Plot Total Customers
-    combinePlot_customers.plot(kind='line', figsize=(14, 8))
-    plt.title(f'Total Customers Comparison for Trial Store {trial_store} and Control Store {control_store}')
-    plt.xlabel('Month')
-    plt.ylabel('Total Customers')
-    plt.legend()
-    plt.show()
+# Function to visualize the metrics of one pair from the comparison panels (comparison_panels.py),
+# which hold the trial, control and other stores series of every pair and metric
+def visualize_metrics(trial_store, control_store, panels):
+    for metric, figure in [('Total Sales', 'sales_comparison'), ('no_Customers', 'customers_comparison')]:
+        label = PANEL_LABELS[metric][1]
+        panel_frame(panels, trial_store, control_store, metric).plot(kind='line', figsize=(14, 8))
+        plt.title(f'{label} Comparison for Trial Store {trial_store} and Control Store {control_store}')
+        plt.xlabel('Month')
+        plt.ylabel(label)
+        plt.legend()
+        show_figures(f'{figure}_{trial_store}')
 
 # Define the trial stores and their most similar control stores
 trial_control_pairs = {
@@ -241,12 +157,17 @@ trial_control_pairs = {
     88: 14
 }
 
+# Trial, control and other stores series of every pair and every metric, built in one pass
+comparison = comparison_panels(preTrialMeasures, trial_control_pairs)
+print(comparison)
+
 # Visualize the metrics for each trial and control pair
 for trial_store, control_store in trial_control_pairs.items():
-    visualize_metrics(trial_store, control_store, preTrialMeasures)
+    visualize_metrics(trial_store, control_store, comparison)
 
 # Function to assess the trial period
-def assess_trial(trial_store, control_store, trial_period, measureOverTime):
+# method: 'ttest' (default), 'welch', 'permutation' or 'bootstrap' (see resampling.py)
+def assess_trial(trial_store, control_store, trial_period, measureOverTime, method='ttest', seed=None):
     trial_data = measureOverTime[(measureOverTime['STORE_NBR'] == trial_store) & 
                                  (measureOverTime['YEARMONTH'] >= trial_period[0]) & 
                                  (measureOverTime['YEARMONTH'] <= trial_period[1])]
@@ -259,19 +180,19 @@ def assess_trial(trial_store, control_store, trial_period, measureOverTime):
     trial_total_sales = trial_data['Total Sales'].sum()
     control_total_sales = control_data['Total Sales'].sum()
     
-    # Perform t-test to check if the difference in total sales is significant
-    t_stat_sales, p_value_sales = ttest_ind(trial_data['Total Sales'], control_data['Total Sales'])
+    # Perform t-test (or the chosen resampling test) to check if the difference in total sales is significant
+    t_stat_sales, p_value_sales = two_sample_test(trial_data['Total Sales'], control_data['Total Sales'], method, seed)
     
     # Calculate total customers
     trial_total_customers = trial_data['no_Customers'].sum()
     control_total_customers = control_data['no_Customers'].sum()
     
-    # Perform t-test to check if the difference in number of customers is significant
-    t_stat_customers, p_value_customers = ttest_ind(trial_data['no_Customers'], control_data['no_Customers'])
+    # Perform t-test (or the chosen resampling test) to check if the difference in number of customers is significant
+    t_stat_customers, p_value_customers = two_sample_test(trial_data['no_Customers'], control_data['no_Customers'], method, seed)
     
     print(f"Assessment for Trial Store {trial_store} and Control Store {control_store} during Trial Period:")
     print(f"Total Sales - Trial: {trial_total_sales}, Control: {control_total_sales}")
-    print(f"T-test p-value for Total Sales: {p_value_sales}")
+    print(f"{METHODS[method]} p-value for Total Sales: {p_value_sales}")
     
     if p_value_sales < 0.05:
         print("Significant difference in total sales during the trial period.")
@@ -279,7 +200,7 @@ def assess_trial(trial_store, control_store, trial_period, measureOverTime):
         print("No significant difference in total sales during the trial period.")
     
     print(f"Total Customers - Trial: {trial_total_customers}, Control: {control_total_customers}")
-    print(f"T-test p-value for Total Customers: {p_value_customers}")
+    print(f"{METHODS[method]} p-value for Total Customers: {p_value_customers}")
     
     if p_value_customers < 0.05:
         print("Significant difference in number of customers during the trial period.")
@@ -291,9 +212,26 @@ def assess_trial(trial_store, control_store, trial_period, measureOverTime):
 # Define the trial period (example: February 2019 to April 2019)
 trial_period = (201902, 201904)
 
+# Significance test: 'ttest', 'welch', 'permutation' or 'bootstrap'
+# With only three monthly points per store the resampling tests make fewer assumptions than the t-test
+significance_method = 'ttest'
+
 # Assess the trial for each trial and control pair
 for trial_store, control_store in trial_control_pairs.items():
-    assess_trial(trial_store, control_store, trial_period, measureOverTime)
+    assess_trial(trial_store, control_store, trial_period, measureOverTime, method=significance_method, seed=2019)
+
+# Assess all trial stores in one batch, with the control store for each trial picked automatically
+# on the months before the trial period (trial_batch.py runs hundreds of trials across a process pool)
+batch_results = evaluate_trials(measureOverTime, [(trial_store, trial_period) for trial_store in trial_stores], processes=1,
+                                method=significance_method, seed=2019)
+print(batch_results)
+
+# Counterfactual assessment without a control store: each trial store against a non-negative weighted
+# combination of its best scoring donor stores, fitted on the pre-trial months (see synthetic_control.py)
+counterfactual = synthetic_control(measureOverTime, [(trial_store, trial_period) for trial_store in trial_stores],
+                                   solver='nnls')
+print(counterfactual['summary'])
+print(counterfactual['weights'])
 
 # Assessment for Trial Store 77 and Control Store 233 during Trial Period:
 # Total Sales - Trial: 724.8, Control: 545.5
@@ -319,4 +257,7 @@ for trial_store, control_store in trial_control_pairs.items():
 # Significant difference in total sales during the trial period.
 # Total Customers - Trial: 374, Control: 10
 # T-test p-value for Total Customers: 9.793497825729776e-06
-# Significant difference in number of customers during the trial period.
\ No newline at end of file
+# Significant difference in number of customers during the trial period.
+
+# Render the collected figures when running headless (QVI_REPORT_DIR set, see report.py)
+write_report('Trial_store_analysis')
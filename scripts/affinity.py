@@ -0,0 +1,134 @@
+# Customer x brand / pack size affinity of the LIFESTAGE x PREMIUM_CUSTOMER segments
+# One pass over the merged transactions builds a sparse loyalty card x item purchase matrix for
+# each item column (BRAND, PACK_SIZE) and a sparse segment x card indicator holding the segment of
+# every card. The units and buyers of every segment and item are then sparse matrix products, so
+# all segments are scored against all items at once instead of filtering the transactions per segment:
+#   affinity  share of the segment's units that go to the item / the same share in the rest of the population
+#   lift      share of the segment's cards that bought the item / the same share in the rest of the population
+# Cards without customer details are left out.
+#
+# Usage (from the data directory):
+#   python affinity.py QVI_cleaned_data.csv --item BRAND --segment "YOUNG SINGLES/COUPLES" Mainstream
+#   python affinity.py QVI_cleaned_data.csv --item PACK_SIZE --output pack_size_affinity.csv
+import argparse
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from instrumentation import instrumented
+from qvi_io import CLEANED_DATA_PATH, read_cleaned_data
+from segment_cube import filter_cube
+
+# Columns defining the customer segments
+SEGMENT_COLUMNS = ['LIFESTAGE', 'PREMIUM_CUSTOMER']
+
+# Item columns a purchase matrix is built for
+ITEM_COLUMNS = ['BRAND', 'PACK_SIZE']
+
+# Columns of the cleaned data the purchase matrices are built from
+AFFINITY_COLUMNS = ['LYLTY_CARD_NBR'] + SEGMENT_COLUMNS + ITEM_COLUMNS + ['PROD_QTY']
+
+
+# Integer codes and sorted labels of a column, -1 for nulls; categoricals use their own codes
+def column_codes(series):
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        return series.cat.codes.to_numpy().astype(np.int64), series.cat.categories
+    codes, labels = pd.factorize(series, sort=True)
+    return codes.astype(np.int64), labels
+
+
+# Sparse purchase matrices of the transactions, built in one pass
+# weight: column summed into the matrices (units bought by default), None counts transactions
+# Returns {'cards': card numbers of the matrix rows, 'segments': segment x card indicator,
+#          'segment_labels': (LIFESTAGE, PREMIUM_CUSTOMER) of every segment row,
+#          'matrices': {item column: {'matrix': card x item CSR matrix, 'labels': item values}}}
+@instrumented('build_purchase_matrices')
+def build_purchase_matrices(transactions, items=ITEM_COLUMNS, weight='PROD_QTY'):
+    (lifestage_codes, lifestages), (premium_codes, premiums) = [column_codes(transactions[col]) for col in SEGMENT_COLUMNS]
+    known = (lifestage_codes >= 0) & (premium_codes >= 0)
+    card_codes, cards = pd.factorize(transactions['LYLTY_CARD_NBR'].to_numpy()[known])
+
+    # Every card belongs to the segment of its customer details
+    shape = (len(lifestages), len(premiums))
+    card_segments = np.empty(len(cards), dtype=np.int64)
+    card_segments[card_codes] = np.ravel_multi_index((lifestage_codes[known], premium_codes[known]), shape)
+    segments = sparse.csr_matrix((np.ones(len(cards)), (card_segments, np.arange(len(cards)))),
+                                 shape=(shape[0] * shape[1], len(cards)))
+    segment_labels = pd.MultiIndex.from_product([lifestages, premiums], names=SEGMENT_COLUMNS)
+
+    values = transactions[weight].to_numpy(dtype=np.float64)[known] if weight else np.ones(int(known.sum()))
+    matrices = {}
+    for item in items:
+        item_codes, labels = column_codes(transactions[item])
+        item_codes = item_codes[known]
+        valid = item_codes >= 0
+        # Repeated (card, item) entries are summed when the matrix is built
+        matrix = sparse.csr_matrix((values[valid], (card_codes[valid], item_codes[valid])), shape=(len(cards), len(labels)))
+        matrices[item] = {'matrix': matrix, 'labels': pd.Index(labels, name=item)}
+    return {'cards': cards, 'segments': segments, 'segment_labels': segment_labels, 'matrices': matrices}
+
+
+# Affinity and lift of every segment for every value of an item column
+# Returns one row per (LIFESTAGE, PREMIUM_CUSTOMER, item value) of the segments with cards:
+# units, buyers and cards of the segment, share/share_rest and affinity, penetration/penetration_rest and lift
+def segment_affinity(purchases, item):
+    matrix = purchases['matrices'][item]['matrix']
+    labels = purchases['matrices'][item]['labels']
+    segments = purchases['segments']
+
+    units = (segments @ matrix).toarray()
+    buyers = (segments @ (matrix > 0).astype(np.float64)).toarray()
+    cards = np.asarray(segments.sum(axis=1)).ravel()
+    segment_units = units.sum(axis=1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        share = units / segment_units
+        share_rest = (units.sum(axis=0) - units) / (units.sum() - segment_units)
+        penetration = buyers / cards[:, None]
+        penetration_rest = (buyers.sum(axis=0) - buyers) / (cards.sum() - cards)[:, None]
+
+    n_items = len(labels)
+    index = pd.MultiIndex.from_arrays(
+        [np.repeat(purchases['segment_labels'].get_level_values(col), n_items) for col in SEGMENT_COLUMNS]
+        + [np.tile(labels, len(cards))], names=SEGMENT_COLUMNS + [item])
+    scores = pd.DataFrame({
+        'units': units.ravel(),
+        'buyers': buyers.ravel().astype(np.int64),
+        'cards': np.repeat(cards, n_items).astype(np.int64),
+        'share': share.ravel(),
+        'share_rest': share_rest.ravel(),
+        'penetration': penetration.ravel(),
+        'penetration_rest': penetration_rest.ravel()
+    }, index=index)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scores['affinity'] = scores['share'] / scores['share_rest']
+        scores['lift'] = scores['penetration'] / scores['penetration_rest']
+    return scores[scores['cards'] > 0].reset_index()
+
+
+# Scores of one segment, best affinity first; where: {column: value or list of values}
+def top_affinities(scores, where, n=None, by='affinity'):
+    top = filter_cube(scores, where).sort_values(by, ascending=False)
+    return top if n is None else top.head(n)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Affinity of every customer segment for every brand or pack size.')
+    parser.add_argument('cleaned_data', nargs='?', default=CLEANED_DATA_PATH)
+    parser.add_argument('--item', default='BRAND', choices=ITEM_COLUMNS)
+    parser.add_argument('--segment', nargs=2, metavar=('LIFESTAGE', 'PREMIUM_CUSTOMER'), default=None)
+    parser.add_argument('--top', type=int, default=10)
+    parser.add_argument('--output', default=None, help='CSV of the scores of every segment')
+    args = parser.parse_args()
+
+    transactions = read_cleaned_data(args.cleaned_data, columns=AFFINITY_COLUMNS)
+    purchases = build_purchase_matrices(transactions, [args.item])
+    scores = segment_affinity(purchases, args.item)
+    print(f"{len(purchases['cards']):,} cards, {len(scores):,} segment/{args.item} scores")
+    if args.output:
+        scores.to_csv(args.output, index=False)
+        print(f'Scores saved to {args.output}')
+    if args.segment:
+        print(top_affinities(scores, dict(zip(SEGMENT_COLUMNS, args.segment)), args.top).to_string(index=False))
+    else:
+        print(scores.sort_values('affinity', ascending=False).head(args.top).to_string(index=False))
@@ -1,18 +1,35 @@
 import pandas as pd
-from datetime import timedelta, datetime
 import matplotlib.pyplot as plt
+from cleaning_pipeline import excel_serial_to_date
+from customer_index import build_card_rows, card_row_positions, customer_positions, join_customers, load_customer_index
+from daily_index import build_daily_index, daily_series, zero_days
+from exclusion_rules import EXCLUSION_RULES, evaluate_rules
+from instrumentation import step
+from product_dimension import attach_product_attributes, load_product_dimension, product_word_counts
+from qvi_io import CLEANED_DATA_PATH, write_cleaned_data
+from report import show_figures, write_report
+from workbook_io import CUSTOMER_DATA_PATH, read_customer_data
+
+# For transaction files too large to load at once run cleaning_pipeline.py, which applies
+# the same cleaning steps chunk by chunk and writes the same QVI_cleaned_data.csv
+
+# Named steps are timed when QVI_PROFILE is set (see instrumentation.py)
 
 #Load the data
-transaction_data = pd.read_csv('QVI_transaction_data.csv')
-customer_data = pd.read_csv('QVI_purchase_behaviour.csv')
+with step('read_transactions') as record:
+    transaction_data = pd.read_csv('QVI_transaction_data.csv')
+    # CSV or the xlsx workbook (QVI_CUSTOMER_DATA=QVI_purchase_behaviour_excel.xlsx, see workbook_io.py)
+    customer_data = read_customer_data(CUSTOMER_DATA_PATH)
+    record['rows_out'] = len(transaction_data)
 
 # Examine transaction data
 print(transaction_data.head())
 print(transaction_data.info())
 
-# Convert DATE column to a date format, 1899 because CSV and excel integer begins on 30 Dec 1899 
-origin_date = datetime.strptime('1899-12-30', '%Y-%m-%d')
-transaction_data['DATE'] = transaction_data['DATE'].apply(lambda x: origin_date + timedelta(days=x))
+# Convert DATE column to a date format, 1899 because CSV and excel integer begins on 30 Dec 1899
+# (one vectorized conversion of the serial day numbers)
+with step('convert_dates', rows_in=len(transaction_data)):
+    transaction_data['DATE'] = excel_serial_to_date(transaction_data['DATE'])
 
 # Check the first few rows to confirm the change
 # print(transaction_data.head())
@@ -21,31 +38,26 @@ transaction_data['DATE'] = transaction_data['DATE'].apply(lambda x: origin_date
 # # Summary of PROD_NAME
 # print(transaction_data['PROD_NAME'].unique())
 
-# Split product names into individual words and explode the list
-transaction_data['words'] = transaction_data['PROD_NAME'].str.split()
-words_exploded = transaction_data.explode('words')
-
-# Remove words with digits or special characters
-words_filtered = words_exploded[~words_exploded['words'].str.contains(r'\d|[^a-zA-Z\s]')]
+# There are only ~100 distinct products, so each product name is parsed once into a product
+# dimension table (salsa flag, pack size, brand and name words) which is joined back by PROD_NBR
+product_dim = load_product_dimension(transaction_data[['PROD_NBR', 'PROD_NAME']])
 
-# Print the changed column
-print(words_filtered[['PROD_NAME', 'words']])
+# Product names split into individual words, with words containing digits or special characters removed
+print(product_dim[['PROD_NAME', 'WORDS']])
 
-# Count the frequency of each word and sort
-word_counts = words_filtered['words'].value_counts().sort_values(ascending=False)
+# Count the frequency of each word over all transactions and sort
+word_counts = product_word_counts(product_dim, transaction_data['PROD_NBR'].value_counts())
 
 # print(word_counts)
 
-# Create a new column 'SALSA' which is True if 'PROD_NAME' contains the word 'salsa', and False if not or if the row is null
-transaction_data['SALSA'] = transaction_data['PROD_NAME'].str.contains('salsa', case=False, na=False)
-
-# Filter out the salsa products, i.e., keep only rows where 'SALSA' is False
-transaction_data = transaction_data[transaction_data['SALSA'] == False]
-
-# Drop the SALSA column as it is no longer needed
-transaction_data = transaction_data.drop(columns=['SALSA'])
-
-transaction_data = transaction_data.drop(columns=['words'])
+# Exclusion rules (see exclusion_rules.py): salsa products, i.e. PROD_NAME contains the word 'salsa',
+# and every transaction of a customer who bought 200 packets of chips at once. All rules are
+# evaluated in one pass into a single keep mask, applied once after the checks below
+with step('exclusion_rules', rows_in=len(transaction_data)) as record:
+    exclusions = evaluate_rules(transaction_data, EXCLUSION_RULES, products=product_dim)
+    record['rows_out'] = int(exclusions['keep'].sum())
+print("Transactions excluded per rule:")
+print(exclusions['report'])
 
 # Summarize the data to check for nulls and possible outliers
 summary_statistics = transaction_data.describe()
@@ -64,8 +76,9 @@ print(outlier_transactions)
 # Identify the customer who made the outlier transaction
 outlier_customer = outlier_transactions['LYLTY_CARD_NBR'].iloc[0]
 
-# Filter the dataset to see all transactions made by this customer
-customer_transactions = transaction_data[transaction_data['LYLTY_CARD_NBR'] == outlier_customer]
+# Index the rows of every loyalty card once, then look up all transactions made by this customer
+card_rows = build_card_rows(transaction_data['LYLTY_CARD_NBR'])
+customer_transactions = transaction_data.iloc[card_row_positions(card_rows, outlier_customer)]
 print(f"All transactions made by the customer {outlier_customer}:")
 print(customer_transactions)
 
@@ -73,21 +86,19 @@ print(customer_transactions)
 #not an ordinary retail customer. The customer might be buying chips for commercial 
 #purposes instead. We'll remove this loyalty card number from further analysis.
 
-
-transaction_data = transaction_data[transaction_data['LYLTY_CARD_NBR'] != outlier_customer]
-Count_Outlier_transaction_data = transaction_data[transaction_data['LYLTY_CARD_NBR'] == outlier_customer]
+# Keep the transactions no exclusion rule matched, the salsa products and this customer are removed
+transaction_data = transaction_data[exclusions['keep']]
+Count_Outlier_transaction_data = transaction_data.loc[transaction_data.index.intersection(customer_transactions.index)]
 print(f"Transactions of the customer {outlier_customer} after filtering:")
 print(Count_Outlier_transaction_data)# we get empty data frame so the outlier transcations has been removed.
 
-# Grouping by the DATE column and counting the number of transactions for each date helps us understand the daily transaction volume.
-transaction_count_by_date = transaction_data.groupby('DATE').size().reset_index(name='transaction_count')
-
-# Create a sequence of dates from 1 Jul 2018 to 30 Jun 2019
-full_date_range = pd.date_range(start='2018-07-01', end='2019-06-30')
-
-# Left join the full date range table with the transaction count table
-#The how='left' argument ensures that all dates in full_date_range are included, even if they don't have corresponding transaction data.
-full_transaction_data = pd.DataFrame({'DATE': full_date_range}).merge(transaction_count_by_date, on='DATE', how='left').fillna(0)
+# Counting the number of transactions for each date helps us understand the daily transaction volume.
+# The dense store x day index (daily_index.py) holds every day from 1 Jul 2018 to 30 Jun 2019, days
+# without transactions included as 0, so no date range has to be merged in
+with step('daily_index', rows_in=len(transaction_data)):
+    daily_index = build_daily_index(transaction_data)
+full_transaction_data = daily_series(daily_index).rename(columns={'transactions': 'transaction_count'})
+print(f"Days without transactions: {[str(day.date()) for day in zero_days(daily_index)]}")
 
 # Plot the transaction count over time
 plt.figure(figsize=(14, 7))
@@ -98,11 +109,11 @@ plt.ylabel('Number of Transactions')
 plt.grid(True)
 plt.xticks(rotation=45)
 plt.tight_layout()
-plt.show()
+show_figures('transaction_count')
 
 
-# Filter the data for December 2018
-december_data = full_transaction_data[(full_transaction_data['DATE'] >= '2018-12-01') & (full_transaction_data['DATE'] <= '2018-12-31')]
+# Slice the index for December 2018
+december_data = daily_series(daily_index, start='2018-12-01', end='2018-12-31').rename(columns={'transactions': 'transaction_count'})
 
 # Plot the transaction count for December 2018
 plt.figure(figsize=(14, 7))
@@ -113,10 +124,10 @@ plt.ylabel('Number of Transactions')
 plt.grid(True)
 plt.xticks(rotation=45)
 plt.tight_layout()
-plt.show()
+show_figures('transaction_count_december')
 
-# Extract pack size from PROD_NAME
-transaction_data['PACK_SIZE'] = transaction_data['PROD_NAME'].str.extract(r'(\d+)').astype(int)
+# Extract pack size from PROD_NAME, the first number in the name taken from the product dimension
+attach_product_attributes(transaction_data, product_dim, columns=['PACK_SIZE'])
 
 # Check if the pack sizes look sensible
 pack_size_summary = transaction_data.groupby('PACK_SIZE').size().reset_index(name='transaction_count')
@@ -129,28 +140,12 @@ plt.title('Histogram of Pack Sizes')
 plt.xlabel('Pack Size')
 plt.ylabel('Number of Transactions')
 plt.grid(True)
-plt.show()
+show_figures('pack_size_histogram')
 
 # Extract brand from PROD_NAME
-# We make a column called BRAND in the transaction_data table and then we use fill
-# str.split splits the product names based on found white spaces and then str[0] takes the first word of the splited product name
-transaction_data['BRAND'] = transaction_data['PROD_NAME'].str.split().str[0]
-
-# Check the extracted brand names
-# reset_index converts the series(description and value format) into a table like format(data frame) and then we name the column 'transaction count'
-brand_summary = transaction_data.groupby('BRAND').size().reset_index(name='transaction_count')
-print(brand_summary.sort_values(by='transaction_count', ascending=False))
-
-# Clean brand names change Red to RRD (left to right)
-brand_replacements = {
-    'Red': 'RRD',
-    'Smith': 'Smiths',
-    'Dorito': 'Doritos',
-    'Woolworths': 'WW',
-    'Infzns' : 'Infuzions'
-}
-
-transaction_data['BRAND'] = transaction_data['BRAND'].replace(brand_replacements)
+# The brand is the first word of the product name, with brand names cleaned by brand_replacements
+# (Red to RRD, Smith to Smiths, ...) when the product dimension is built
+attach_product_attributes(transaction_data, product_dim, columns=['BRAND'])
 
 # Check the cleaned brand names
 cleaned_brand_summary = transaction_data.groupby('BRAND').size().reset_index(name='transaction_count')
@@ -165,7 +160,7 @@ plt.ylabel('Number of Transactions')
 plt.xticks(rotation=45)
 plt.grid(True)
 plt.tight_layout()
-plt.show()
+show_figures('brand_counts')
 
 print(customer_data.describe(include='all'))
 
@@ -181,23 +176,32 @@ for column in key_columns:
     plt.xticks(rotation=45)
     plt.grid(True)
     plt.tight_layout()
-    plt.show()
+    show_figures(f'distribution_{column.lower()}')
 
 # Merge transaction data with customer data
-merged_data = pd.merge(transaction_data, customer_data, on='LYLTY_CARD_NBR', how='left')
+# LIFESTAGE and PREMIUM_CUSTOMER are attached by position from the memory-mapped customer index
+# (see customer_index.py), which also tells which cards have no customer details
+with step('merge_customers', rows_in=len(transaction_data)) as record:
+    customer_index = load_customer_index(CUSTOMER_DATA_PATH)
+    positions = customer_positions(customer_index, transaction_data['LYLTY_CARD_NBR'])
+    merged_data = join_customers(transaction_data, customer_index, positions)
+    record['rows_out'] = len(merged_data)
 
 # Check the merged data
 print("\nMerged Data Sample:")
 print(merged_data.head())
 
-# Check for missing customer details
-missing_customer_details = merged_data.isnull().sum()
+# Check for missing customer details, the transactions whose card is not in the customer index
+missing_customer_details = pd.Series(int((positions < 0).sum()), index=list(customer_index['categories']))
 print("Missing customer details:")
 print(missing_customer_details[missing_customer_details > 0])
 
-# Save the merged dataset as a CSV file
-merged_data.to_csv('QVI_cleaned_data.csv', index=False)
+# Save the merged dataset, as CSV by default or as a month-partitioned Parquet dataset
+# when QVI_CLEANED_DATA points to a .parquet path
+with step('write_cleaned_data', rows_in=len(merged_data)):
+    write_cleaned_data(merged_data, CLEANED_DATA_PATH)
 
 # print("Data exploration is now complete and the dataset has been saved as 'QVI_cleaned_data.csv'.")
 
-
+# Render the collected figures when running headless (QVI_REPORT_DIR set, see report.py)
+write_report('chip_analysis')
@@ -0,0 +1,140 @@
+# Chunked cleaning pipeline for the chips transaction data
+# Applies the same cleaning steps as chip_analysis.py (salsa filter, outlier customer removal,
+# PACK_SIZE/BRAND extraction and the customer join) one chunk at a time and streams the
+# result to QVI_cleaned_data (CSV or a month-partitioned Parquet dataset, see qvi_io.py), so peak
+# memory depends on the chunk size and not the file size.
+# Product attributes come from the product dimension (product_dimension.py), so product names
+# are parsed once per product rather than once per transaction.
+#
+# Usage (from the data directory):
+#   python cleaning_pipeline.py --chunksize 1000000
+#   python cleaning_pipeline.py --output QVI_cleaned_data.parquet
+import argparse
+
+import pandas as pd
+
+from customer_index import join_customers, load_customer_index
+from exclusion_rules import EXCLUSION_RULES, combine_reports, customer_rule_candidates, evaluate_rules, rule_columns
+from instrumentation import step
+from product_dimension import (PRODUCT_DIMENSION_PATH, attach_product_attributes, load_product_dimension,
+                               product_word_counts)
+from qvi_io import CLEANED_DATA_PATH, write_cleaned_data
+from workbook_io import CUSTOMER_DATA_PATH
+
+# CSV and Excel integer dates begin on 30 Dec 1899
+ORIGIN_DATE = '1899-12-30'
+
+# Number of transaction rows read per chunk
+DEFAULT_CHUNKSIZE = 1_000_000
+
+
+# Convert Excel serial day numbers to dates in one vectorized step
+# Microsecond resolution, as when adding timedelta(days=...) to a datetime row by row
+def excel_serial_to_date(serial):
+    return pd.to_datetime(serial, unit='D', origin=ORIGIN_DATE).astype('datetime64[us]')
+
+
+# Read the transaction file lazily in chunks
+def iter_transactions(transaction_path, chunksize=DEFAULT_CHUNKSIZE, usecols=None):
+    return pd.read_csv(transaction_path, chunksize=chunksize, usecols=usecols)
+
+
+# First pass: collect the distinct products and the rows that could match a customer exclusion rule
+# (the OUTLIER_QTY purchases with the default rules); only the columns needed are parsed
+def scan_transactions(transaction_path, chunksize=DEFAULT_CHUNKSIZE, rules=EXCLUSION_RULES):
+    columns = sorted({'LYLTY_CARD_NBR', 'PROD_NBR', 'PROD_NAME'} | set(rule_columns(rules)))
+    products = []
+    candidates = []
+    for chunk in iter_transactions(transaction_path, chunksize, usecols=columns):
+        products.append(chunk[['PROD_NBR', 'PROD_NAME']].drop_duplicates())
+        candidates.append(chunk[customer_rule_candidates(chunk, rules)])
+    return pd.concat(products).drop_duplicates(), pd.concat(candidates)
+
+
+# Loyalty cards excluded by each customer rule, found among the candidate rows of the first pass
+# Store rules need every row at once, the chunked pipeline does not support them
+def find_excluded_customers(candidates, product_dim, rules=EXCLUSION_RULES):
+    if any(rule['kind'] == 'store' for rule in rules):
+        raise ValueError('Store exclusion rules are not supported when cleaning in chunks')
+    excluded_keys = evaluate_rules(candidates, rules, products=product_dim)['excluded_keys']
+    return {rule['name']: excluded_keys[rule['name']] for rule in rules if rule['kind'] == 'customer'}
+
+
+# Clean a chunk of transactions: drop the rows excluded by the rules (salsa products and outlier
+# customers by default) with one combined mask, convert the dates and add PACK_SIZE and BRAND
+# excluded_customers: cards of each customer rule (find_excluded_customers); reports collects the
+# per-rule counts when given
+def clean_transactions(chunk, excluded_customers, product_dim, rules=EXCLUSION_RULES, reports=None):
+    exclusions = evaluate_rules(chunk, rules, products=product_dim, excluded_keys=excluded_customers)
+    if reports is not None:
+        reports.append(exclusions['report'])
+    chunk = chunk[exclusions['keep']]
+    chunk['DATE'] = excel_serial_to_date(chunk['DATE'])
+    attach_product_attributes(chunk, product_dim, columns=('PACK_SIZE', 'BRAND'))
+    return chunk
+
+
+# Clean a single chunk of transactions and join the customer segments onto it
+# customer_index: the memory-mapped customer index (customer_index.py)
+def clean_chunk(chunk, customer_index, excluded_customers, product_dim, rules=EXCLUSION_RULES, reports=None):
+    chunk = clean_transactions(chunk, excluded_customers, product_dim, rules, reports)
+    with step('merge_customers', rows_in=len(chunk)) as record:
+        merged = join_customers(chunk, customer_index)
+        record['rows_out'] = len(merged)
+    return merged
+
+
+# Generator over cleaned chunks, also filling summary with running counts
+def iter_cleaned_chunks(transaction_path, customer_index, excluded_customers, product_dim, chunksize=DEFAULT_CHUNKSIZE, summary=None,
+                        rules=EXCLUSION_RULES):
+    if summary is None:
+        summary = {}
+    summary.setdefault('rows_in', 0)
+    summary.setdefault('rows_out', 0)
+    summary.setdefault('missing_customers', 0)
+    summary.setdefault('product_counts', pd.Series(dtype='int64'))
+    summary.setdefault('exclusion_reports', [])
+    for chunk in iter_transactions(transaction_path, chunksize):
+        summary['rows_in'] += len(chunk)
+        summary['product_counts'] = summary['product_counts'].add(chunk['PROD_NBR'].value_counts(), fill_value=0)
+        cleaned = clean_chunk(chunk, customer_index, excluded_customers, product_dim, rules, summary['exclusion_reports'])
+        summary['rows_out'] += len(cleaned)
+        summary['missing_customers'] += int(cleaned['LIFESTAGE'].isnull().sum())
+        yield cleaned
+
+
+# Run the full chunked pipeline and stream the cleaned rows to output_path
+def run_chunked_pipeline(transaction_path='QVI_transaction_data.csv', customer_path=CUSTOMER_DATA_PATH,
+                         output_path=CLEANED_DATA_PATH, chunksize=DEFAULT_CHUNKSIZE, product_dim_path=PRODUCT_DIMENSION_PATH,
+                         rules=EXCLUSION_RULES):
+    customer_index = load_customer_index(customer_path)
+    products, candidates = scan_transactions(transaction_path, chunksize, rules)
+    product_dim = load_product_dimension(products, product_dim_path)
+    excluded_customers = find_excluded_customers(candidates, product_dim, rules)
+    summary = {'outlier_customers': sorted(set().union(*[cards.tolist() for cards in excluded_customers.values()]))}
+
+    append = False
+    for cleaned in iter_cleaned_chunks(transaction_path, customer_index, excluded_customers, product_dim, chunksize, summary, rules):
+        write_cleaned_data(cleaned, output_path, append=append)
+        append = True
+
+    summary['exclusions'] = combine_reports(summary.pop('exclusion_reports'))
+    summary['word_counts'] = product_word_counts(product_dim, summary['product_counts'])
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Clean the QVI transaction data chunk by chunk.')
+    parser.add_argument('--transactions', default='QVI_transaction_data.csv')
+    parser.add_argument('--customers', default=CUSTOMER_DATA_PATH, help='CSV or xlsx')
+    parser.add_argument('--output', default=CLEANED_DATA_PATH)
+    parser.add_argument('--chunksize', type=int, default=DEFAULT_CHUNKSIZE)
+    args = parser.parse_args()
+
+    summary = run_chunked_pipeline(args.transactions, args.customers, args.output, args.chunksize)
+    print(f"Rows read: {summary['rows_in']}, rows written: {summary['rows_out']}")
+    print(f"Outlier customers removed: {summary['outlier_customers']}")
+    print(f"Rows excluded per rule:\n{summary['exclusions']}")
+    print(f"Transactions with missing customer details: {summary['missing_customers']}")
+    print("Most common product name words:")
+    print(summary['word_counts'].head(20))
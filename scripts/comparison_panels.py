@@ -0,0 +1,98 @@
+# Trial / control / other stores comparison panels of many trial-control pairs
+# The store x month matrix of every measureOverTime metric is stacked once (trial_batch.metric_cube)
+# and summed over all stores once per metric. The mean of the other stores of a pair is then the
+# all-store total minus its trial and control rows, over the remaining stores, so every pair and
+# every metric comes out of the same array operations and an extra pair only adds two row lookups.
+# The result is a tidy table, one row per pair, metric, month and store type:
+#   trial_store, control_store, metric, YEARMONTH, Month, store_type, value
+# store_type is 'Trial Store', 'Control Store' or 'Other Stores' (mean of every other store), as in
+# the comparison charts of Trial_store_analysis.py.
+#
+# Usage (from the data directory), pairs CSV with columns trial_store, control_store:
+#   python comparison_panels.py trial_control_pairs.csv --before 201902 --output comparison_panels.csv
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from instrumentation import instrumented
+from qvi_io import CLEANED_DATA_PATH, read_cleaned_data
+from store_metrics import METRICS, compute_measure_over_time
+from trial_batch import complete_stores_only, metric_cube
+
+# Store types of a panel, in plotting order
+STORE_TYPES = ['Control Store', 'Trial Store', 'Other Stores']
+
+# Legend word and axis label of the charted metrics: metric -> (legend word, axis label)
+PANEL_LABELS = {
+    'Total Sales': ('Sales', 'Total Sales'),
+    'no_Customers': ('Customers', 'Total Customers')
+}
+
+
+# Comparison panels of every trial-control pair and metric
+# measureOverTime must hold a full observation period for every store (null stores removed)
+# pairs: {trial store: control store} or a list of (trial store, control store)
+@instrumented('comparison_panels')
+def comparison_panels(measureOverTime, pairs, metrics=tuple(METRICS)):
+    pairs = np.array(list(pairs.items() if isinstance(pairs, dict) else pairs), dtype=np.int64).reshape(-1, 2)
+    metrics = list(metrics)
+    cube, stores, months = metric_cube(measureOverTime, metrics)
+    if len(stores) < 3:
+        raise ValueError('Comparison panels need at least one store besides the trial and control store')
+    positions = np.searchsorted(stores, pairs)
+    if (positions >= len(stores)).any() or (stores[np.minimum(positions, len(stores) - 1)] != pairs).any():
+        raise ValueError(f'Stores without a full observation period: {np.setdiff1d(pairs, stores)}')
+    if (pairs[:, 0] == pairs[:, 1]).any():
+        raise ValueError('A trial store cannot be its own control store')
+
+    # (metrics, pairs, months) series of every store type
+    trial, control = cube[:, positions[:, 0]], cube[:, positions[:, 1]]
+    other = (cube.sum(axis=1)[:, None] - trial - control) / (len(stores) - 2)
+    values = np.stack([control, trial, other], axis=2)  # (metrics, pairs, store types, months)
+
+    n_metrics, n_pairs, n_types, n_months = values.shape
+    month_names = pd.to_datetime(months.astype(str), format='%Y%m').month_name().str[:3].to_numpy()
+    panels = pd.DataFrame({
+        'trial_store': np.tile(np.repeat(pairs[:, 0], n_types * n_months), n_metrics),
+        'control_store': np.tile(np.repeat(pairs[:, 1], n_types * n_months), n_metrics),
+        'metric': np.repeat(metrics, n_pairs * n_types * n_months),
+        'YEARMONTH': np.tile(months, n_metrics * n_pairs * n_types),
+        'Month': np.tile(month_names, n_metrics * n_pairs * n_types),
+        'store_type': np.tile(np.repeat(STORE_TYPES, n_months), n_metrics * n_pairs),
+        'value': values.ravel()
+    })
+    return panels.sort_values(['trial_store', 'control_store', 'metric', 'store_type', 'YEARMONTH'], kind='stable',
+                              ignore_index=True)
+
+
+# One pair and metric as a chart frame: one column per store type, one row per month, in month order
+# A trial store may be compared with several control stores, so the pair is its trial and control store
+def panel_frame(panels, trial_store, control_store, metric):
+    panel = panels[(panels['trial_store'].to_numpy() == trial_store) & (panels['control_store'].to_numpy() == control_store)
+                   & (panels['metric'].to_numpy() == metric)]
+    if panel.empty:
+        raise ValueError(f'No {metric} panel of trial store {trial_store} and control store {control_store}')
+    frame = panel.pivot(index=['YEARMONTH', 'Month'], columns='store_type', values='value')[STORE_TYPES].droplevel('YEARMONTH')
+    word = PANEL_LABELS.get(metric, (metric, metric))[0]
+    frame.columns = [f'{store_type} {word}' for store_type in STORE_TYPES]
+    return frame
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Trial/control/other stores comparison panels of many pairs.')
+    parser.add_argument('pairs', help='CSV with trial_store, control_store')
+    parser.add_argument('--cleaned-data', default=CLEANED_DATA_PATH)
+    parser.add_argument('--before', type=int, default=None, help='only the months before this yyyymm')
+    parser.add_argument('--output', default='comparison_panels.csv')
+    args = parser.parse_args()
+
+    df1 = read_cleaned_data(args.cleaned_data, columns=['STORE_NBR', 'YEARMONTH', 'LYLTY_CARD_NBR', 'TXN_ID', 'PROD_QTY', 'TOT_SALES'])
+    measureOverTime = complete_stores_only(compute_measure_over_time(df1).reset_index())
+    if args.before is not None:
+        measureOverTime = measureOverTime[measureOverTime['YEARMONTH'] < args.before]
+    pairs = pd.read_csv(args.pairs)
+
+    panels = comparison_panels(measureOverTime, zip(pairs['trial_store'], pairs['control_store']))
+    panels.to_csv(args.output, index=False)
+    print(f"{len(pairs)} pairs x {panels['metric'].nunique()} metrics, {len(panels):,} panel rows saved to {args.output}")
@@ -0,0 +1,82 @@
+# Vectorized control store matching
+# Pivots the pre-trial measures once into a store x month matrix per metric and scores
+# every candidate store against every trial store in one batched NumPy pass.
+import numpy as np
+import pandas as pd
+
+from instrumentation import instrumented
+
+# Metrics used to match control stores and the name of their score column
+MATCH_METRICS = {
+    'Total Sales': 'scoreSales',
+    'no_Customers': 'scoreCustomers'
+}
+
+
+# Pivot a long store/month table into a stores x months matrix for one metric
+# Rows follow the order in which stores first appear, like STORE_NBR.unique()
+def pivot_metric(inputTable, metricCol):
+    storeNumbers = inputTable['STORE_NBR'].unique()
+    matrix = inputTable.pivot(index='STORE_NBR', columns='YEARMONTH', values=metricCol)
+    return matrix.reindex(storeNumbers)
+
+
+# Pearson correlation of every trial row against every candidate row -> (trials, stores)
+# store_matrix: (stores, months) shared by every trial row, or (trials, stores, months) holding
+# the own candidate rows of each trial row (control_index.py)
+def batch_correlation(trial_matrix, store_matrix):
+    x = trial_matrix - trial_matrix.mean(axis=1, keepdims=True)
+    y = store_matrix - store_matrix.mean(axis=-1, keepdims=True)
+    products = x @ y.T if y.ndim == 2 else np.einsum('tm,tsm->ts', x, y)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        corr = products / (np.sqrt((x ** 2).sum(axis=1))[:, None] * np.sqrt((y ** 2).sum(axis=-1)))
+    return np.clip(corr, -1, 1)
+
+
+# Min-max scaled magnitude similarity of every trial row against every candidate row -> (trials, stores)
+# The absolute monthly difference is scaled within each store pair; pairs with a constant
+# difference (e.g. the trial store against itself) have no defined score and come back as NaN
+def batch_magnitude(trial_matrix, store_matrix):
+    z = np.abs(trial_matrix[:, None, :] - (store_matrix[None, :, :] if store_matrix.ndim == 2 else store_matrix))
+    z_min = z.min(axis=2, keepdims=True)
+    z_range = z.max(axis=2, keepdims=True) - z_min
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scaled = 1 - (z - z_min) / z_range
+    magnitude = scaled.mean(axis=2)
+    magnitude[(z_range == 0)[:, :, 0]] = np.nan
+    return magnitude
+
+
+# Weighted correlation/magnitude score of every candidate for each trial row -> (trials, stores)
+# store_matrix: shared or per trial row, as in batch_correlation
+def control_score(trial_matrix, store_matrix, corr_weight=0.5):
+    corr = batch_correlation(trial_matrix, store_matrix)
+    magnitude = batch_magnitude(trial_matrix, store_matrix)
+    return corr_weight * corr + (1 - corr_weight) * magnitude
+
+
+# Score every store as a control for each of the trial stores
+# Returns one row per (Store1, Store2) pair with a score per metric and the finalControlScore
+@instrumented('score_control_stores')
+def score_control_stores(preTrialMeasures, trial_stores, metrics=MATCH_METRICS, corr_weight=0.5):
+    trial_stores = list(trial_stores)
+    scores = {}
+    for metricCol, scoreCol in metrics.items():
+        matrix = pivot_metric(preTrialMeasures, metricCol)
+        store_matrix = matrix.to_numpy(dtype=float)
+        trial_matrix = matrix.loc[trial_stores].to_numpy(dtype=float)
+        scores[scoreCol] = control_score(trial_matrix, store_matrix, corr_weight).ravel()
+
+    index = pd.MultiIndex.from_product([trial_stores, matrix.index], names=['Store1', 'Store2'])
+    score_Control = pd.DataFrame(scores, index=index)
+    score_Control['finalControlScore'] = score_Control[list(metrics.values())].mean(axis=1, skipna=False)
+    return score_Control
+
+
+# Top n control stores for each trial store, best first
+def find_similar_control_stores(preTrialMeasures, trial_stores, n=5, metrics=MATCH_METRICS, corr_weight=0.5):
+    score_Control = score_control_stores(preTrialMeasures, trial_stores, metrics, corr_weight)
+    parts = [score_Control.xs(trial_store, level='Store1', drop_level=False)
+             .sort_values(by='finalControlScore', ascending=False).head(n)
+             for trial_store in score_Control.index.unique('Store1')]
+    return pd.concat(parts)
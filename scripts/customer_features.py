@@ -0,0 +1,302 @@
+# Persistent per-customer feature store, memory-mapped like the customer index (customer_index.py)
+# One row per loyalty card, held as aligned .npy arrays sorted by card number: purchase count,
+# total spend, units, largest pack quantity of a purchase, first/last purchase date, home store,
+# favourite brand and pack size, and the LIFESTAGE/PREMIUM_CUSTOMER codes. Customer screening
+# ("cards that bought 200 packs at once") and segment counts read these arrays instead of
+# scanning the transactions.
+#
+# The store is built in one pass over the transactions sorted by card: every feature is a
+# reduction over the card's run of rows (np.add/minimum/maximum.reduceat). New transaction files
+# are merged in with the same reductions, so the history is never read again. The favourites
+# come from (card, value, purchases) tables kept next to the features, which add up across files.
+# A file that was already added is skipped, by batch id as in monthly_aggregates.py.
+#
+# Layout of the store directory:
+#   cards.npy                   sorted loyalty card numbers (int64)
+#   <feature>.npy               one value per card, aligned with cards
+#   <column>_counts_<part>.npy  (card, value, purchases) table of a favourite's column
+#   meta.json                   categories of the coded columns and the batches already added
+#
+# Usage (from the data directory):
+#   python customer_features.py QVI_cleaned_data.csv
+#   python customer_features.py new_week_cleaned.csv --screen max_units '>=' 200 --segments
+import argparse
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from exclusion_rules import OPS
+from qvi_io import read_cleaned_data
+
+# Store directory, override with the QVI_CUSTOMER_FEATURES environment variable
+FEATURE_STORE_PATH = os.environ.get('QVI_CUSTOMER_FEATURES', 'QVI_customer_features')
+
+# Columns of the cleaned data the features are built from
+FEATURE_COLUMNS = ['LYLTY_CARD_NBR', 'DATE', 'STORE_NBR', 'PROD_QTY', 'TOT_SALES', 'PACK_SIZE', 'BRAND',
+                   'LIFESTAGE', 'PREMIUM_CUSTOMER']
+
+# Features reduced over the rows of each card: name -> (column, reducer, dtype)
+# Reducers: 'count' (rows), 'sum', 'min' and 'max'
+FEATURES = {
+    'n_purchases': (None, 'count', 'int64'),
+    'total_spend': ('TOT_SALES', 'sum', 'float64'),
+    'units': ('PROD_QTY', 'sum', 'int64'),
+    'max_units': ('PROD_QTY', 'max', 'int64'),
+    'first_date': ('DATE', 'min', 'datetime64[D]'),
+    'last_date': ('DATE', 'max', 'datetime64[D]')
+}
+
+# Most purchased value of a column per card: name -> column (coded columns hold category codes)
+FAVOURITES = {
+    'home_store': 'STORE_NBR',
+    'favourite_brand': 'BRAND',
+    'favourite_pack_size': 'PACK_SIZE'
+}
+
+# Segment columns stored as category codes, -1 for cards without customer details
+SEGMENT_COLUMNS = ['LIFESTAGE', 'PREMIUM_CUSTOMER']
+
+# Columns stored as codes of the categories in meta.json
+CODED_COLUMNS = ['BRAND'] + SEGMENT_COLUMNS
+
+# Value of a feature for a card that has no rows in one of two merged parts: reducer -> dtype kind -> value
+# Dates fill with NaT and floats with NaN, which np.fmin/np.fmax skip; integers with the reducer's identity
+FILL_VALUES = {
+    'count': {'i': 0},
+    'sum': {'i': 0, 'f': 0.0},
+    'min': {'M': np.datetime64('NaT'), 'f': np.nan, 'i': np.iinfo(np.int64).max},
+    'max': {'M': np.datetime64('NaT'), 'f': np.nan, 'i': np.iinfo(np.int64).min}
+}
+
+REDUCERS = {'sum': np.add, 'min': np.minimum, 'max': np.maximum}
+
+# Bits of the value in the (card, value) sort keys of the favourite tables: store numbers, pack
+# sizes and category codes must be below 2 ** VALUE_BITS
+VALUE_BITS = 24
+
+
+# Empty store
+def empty_feature_store():
+    store = {'cards': np.array([], dtype=np.int64), 'categories': {col: [] for col in CODED_COLUMNS}, 'batches': [],
+             'counts': {}}
+    for name, (_, _, dtype) in FEATURES.items():
+        store[name] = np.array([], dtype=dtype)
+    for name in list(FAVOURITES) + SEGMENT_COLUMNS:
+        store[name] = np.array([], dtype=np.int64)
+    for column in FAVOURITES.values():
+        store['counts'][column] = {part: np.array([], dtype=np.int64) for part in ('card', 'value', 'purchases')}
+    return store
+
+
+# Integer values of a column: category codes (categories extended with unseen values) for coded columns
+# Categoricals are recoded through their categories, the values themselves are not compared
+def column_values(transactions, column, categories):
+    if column not in CODED_COLUMNS:
+        return transactions[column].to_numpy(dtype=np.int64)
+    series = transactions[column]
+    if not isinstance(series.dtype, pd.CategoricalDtype):
+        series = series.astype('category')
+    unseen = series.cat.categories.difference(categories[column])
+    categories[column] = list(categories[column]) + sorted(unseen)
+    mapping = pd.Index(categories[column]).get_indexer(series.cat.categories)
+    codes = series.cat.codes.to_numpy()
+    return np.where(codes >= 0, mapping[codes], -1).astype(np.int64)
+
+
+# First position of every run of equal values in a sorted array
+def run_starts(values):
+    if not len(values):
+        return np.array([], dtype=np.intp)
+    return np.flatnonzero(np.append(True, values[1:] != values[:-1]))
+
+
+# (card, value, purchases) table of the pairs given by card positions, summing repeated pairs
+# The pairs are sorted on one int64 key (card position, value), so the table is sorted by card then value
+def sum_pairs(cards, positions, values, purchases):
+    if len(values) and (values.min() < 0 or values.max() >= 1 << VALUE_BITS):
+        raise ValueError(f'Favourite values must be between 0 and {1 << VALUE_BITS}')
+    keys = (positions.astype(np.int64) << VALUE_BITS) | values
+    order = np.argsort(keys, kind='stable')
+    keys, purchases = keys[order], purchases[order]
+    starts = run_starts(keys)
+    return {'card': cards[keys[starts] >> VALUE_BITS], 'value': keys[starts] & ((1 << VALUE_BITS) - 1),
+            'purchases': np.add.reduceat(purchases, starts) if len(starts) else purchases}
+
+
+# Most purchased value of every card of a (card, value, purchases) table, ties to the smallest value
+def favourite(counts):
+    cards, purchases = np.asarray(counts['card']), np.asarray(counts['purchases'])
+    if not len(cards):
+        return np.array([], dtype=np.int64)
+    starts = run_starts(cards)
+    best = np.repeat(np.maximum.reduceat(purchases, starts), np.diff(np.append(starts, len(cards))))
+    is_best = np.flatnonzero(purchases == best)
+    first = is_best[np.append(True, cards[is_best][1:] != cards[is_best][:-1])]
+    return np.asarray(counts['value'])[first]
+
+
+# Features of a batch of transactions, in one pass over the rows sorted by card
+# categories: categories of the coded columns so far, extended in place with new values
+def build_features(transactions, categories=None):
+    store = empty_feature_store()
+    if categories is not None:
+        store['categories'] = {col: list(values) for col, values in categories.items()}
+    if not len(transactions):
+        return store
+    all_cards = transactions['LYLTY_CARD_NBR'].to_numpy(dtype=np.int64)
+    order = np.argsort(all_cards, kind='stable')
+    starts = run_starts(all_cards[order])
+    store['cards'] = all_cards[order][starts]
+    positions = np.repeat(np.arange(len(starts)), np.diff(np.append(starts, len(order))))
+
+    for name, (column, reducer, dtype) in FEATURES.items():
+        if reducer == 'count':
+            store[name] = np.diff(np.append(starts, len(order))).astype(dtype)
+        else:
+            store[name] = REDUCERS[reducer].reduceat(transactions[column].to_numpy().astype(dtype)[order], starts)
+    # Every row of a card carries the same details; known codes (>= 0) win over missing ones
+    for column in SEGMENT_COLUMNS:
+        store[column] = np.maximum.reduceat(column_values(transactions, column, store['categories'])[order], starts)
+    for column in FAVOURITES.values():
+        store['counts'][column] = sum_pairs(store['cards'], positions,
+                                            column_values(transactions, column, store['categories'])[order],
+                                            np.ones(len(order), dtype=np.int64))
+    for name, column in FAVOURITES.items():
+        store[name] = favourite(store['counts'][column])
+    return store
+
+
+# Feature of a part placed at the positions of its cards in the merged cards, fill elsewhere
+def _spread(n_cards, positions, part, name, fill):
+    values = np.full(n_cards, fill, dtype=part[name].dtype)
+    values[positions] = part[name]
+    return values
+
+
+# Merge the features of a new batch into a store; the batch must use the store's categories
+# (build_features(transactions, store['categories'])), segment codes of the batch win
+def merge_features(store, batch):
+    cards = np.sort(np.concatenate([store['cards'], batch['cards']]), kind='stable')
+    cards = cards[run_starts(cards)]
+    merged = {'cards': cards, 'categories': batch['categories'], 'batches': list(store['batches']), 'counts': {}}
+    old_positions, new_positions = np.searchsorted(cards, store['cards']), np.searchsorted(cards, batch['cards'])
+    for name, (_, reducer, dtype) in FEATURES.items():
+        fill = FILL_VALUES[reducer][np.dtype(dtype).kind]
+        old = _spread(len(cards), old_positions, store, name, fill)
+        new = _spread(len(cards), new_positions, batch, name, fill)
+        merged[name] = {'count': np.add, 'sum': np.add, 'min': np.fmin, 'max': np.fmax}[reducer](old, new)
+    for column in SEGMENT_COLUMNS:
+        old, new = _spread(len(cards), old_positions, store, column, -1), _spread(len(cards), new_positions, batch, column, -1)
+        merged[column] = np.where(new >= 0, new, old)
+    for column in FAVOURITES.values():
+        parts = [np.concatenate([store['counts'][column][part], batch['counts'][column][part]])
+                 for part in ('card', 'value', 'purchases')]
+        merged['counts'][column] = sum_pairs(cards, np.searchsorted(cards, parts[0]), parts[1], parts[2])
+    for name, column in FAVOURITES.items():
+        merged[name] = favourite(merged['counts'][column])
+    return merged
+
+
+# Save a store, written to a temporary directory first so a partial store is never opened
+def save_feature_store(store, path=FEATURE_STORE_PATH):
+    tmp_path = f'{path}.tmp{os.getpid()}'
+    os.makedirs(tmp_path, exist_ok=True)
+    for name in ['cards'] + list(FEATURES) + list(FAVOURITES) + SEGMENT_COLUMNS:
+        np.save(os.path.join(tmp_path, f'{name}.npy'), store[name])
+    for column, counts in store['counts'].items():
+        for part, values in counts.items():
+            np.save(os.path.join(tmp_path, f'{column}_counts_{part}.npy'), values)
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump({'categories': store['categories'], 'batches': store['batches']}, f)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+
+
+# Open a saved store with every array memory-mapped read-only, empty if the store does not exist yet
+def open_feature_store(path=FEATURE_STORE_PATH):
+    if not os.path.exists(os.path.join(path, 'meta.json')):
+        return empty_feature_store()
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    store = {'categories': meta['categories'], 'batches': meta['batches'], 'counts': {}}
+    for name in ['cards'] + list(FEATURES) + list(FAVOURITES) + SEGMENT_COLUMNS:
+        store[name] = np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r')
+    for column in FAVOURITES.values():
+        store['counts'][column] = {part: np.load(os.path.join(path, f'{column}_counts_{part}.npy'), mmap_mode='r')
+                                   for part in ('card', 'value', 'purchases')}
+    return store
+
+
+# Add a file's transactions to the store; a batch_id that was already added is skipped
+def update_feature_store(transactions, path=FEATURE_STORE_PATH, batch_id=None):
+    store = open_feature_store(path)
+    if batch_id is not None and batch_id in store['batches']:
+        return store
+    store = merge_features(store, build_features(transactions, store['categories']))
+    if batch_id is not None:
+        store['batches'].append(batch_id)
+    save_feature_store(store, path)
+    return open_feature_store(path)
+
+
+# Features of every card (or of the given cards) as a DataFrame, coded columns as categoricals
+def feature_frame(store, cards=None):
+    positions = slice(None)
+    if cards is not None:
+        cards = np.asarray(cards, dtype=np.int64)
+        positions = np.searchsorted(store['cards'], cards)
+        if (positions >= len(store['cards'])).any() or (np.asarray(store['cards'])[np.minimum(positions, len(store['cards']) - 1)] != cards).any():
+            raise ValueError('Cards missing from the customer feature store')
+    frame = pd.DataFrame({'LYLTY_CARD_NBR': np.asarray(store['cards'])[positions]})
+    for name in list(FEATURES) + list(FAVOURITES) + SEGMENT_COLUMNS:
+        values = np.asarray(store[name])[positions]
+        column = FAVOURITES.get(name, name)
+        if column in CODED_COLUMNS:
+            values = pd.Categorical.from_codes(values, categories=store['categories'][column])
+        frame[name] = values
+    return frame
+
+
+# Cards whose feature matches a condition, e.g. screen_customers(store, 'max_units', '>=', 200)
+def screen_customers(store, feature, op, value):
+    if op not in OPS:
+        raise ValueError(f'Unknown operator {op!r}, expected one of {list(OPS)}')
+    return np.asarray(store['cards'])[OPS[op](np.asarray(store[feature]), value)]
+
+
+# Number of customers of every LIFESTAGE x PREMIUM_CUSTOMER segment, from the segment codes alone
+def segment_counts(store):
+    lifestages, premiums = [store['categories'][col] for col in SEGMENT_COLUMNS]
+    known = (np.asarray(store['LIFESTAGE']) >= 0) & (np.asarray(store['PREMIUM_CUSTOMER']) >= 0)
+    codes = np.asarray(store['LIFESTAGE'])[known] * len(premiums) + np.asarray(store['PREMIUM_CUSTOMER'])[known]
+    counts = np.bincount(codes, minlength=len(lifestages) * len(premiums))
+    index = pd.MultiIndex.from_product([lifestages, premiums], names=SEGMENT_COLUMNS)
+    return pd.Series(counts, index=index, name='customers').reset_index()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Add cleaned transactions to the per-customer feature store.')
+    parser.add_argument('cleaned_data', nargs='?', default=None, help='cleaned transactions, CSV or Parquet dataset')
+    parser.add_argument('--store', default=FEATURE_STORE_PATH)
+    parser.add_argument('--screen', nargs=3, metavar=('FEATURE', 'OP', 'VALUE'), default=None)
+    parser.add_argument('--segments', action='store_true', help='print the customers of every segment')
+    args = parser.parse_args()
+
+    if args.cleaned_data:
+        transactions = read_cleaned_data(args.cleaned_data, columns=FEATURE_COLUMNS)
+        batch_id = f'{os.path.abspath(args.cleaned_data)}@{os.path.getmtime(args.cleaned_data)}'
+        store = update_feature_store(transactions, args.store, batch_id)
+    else:
+        store = open_feature_store(args.store)
+    print(f"Customer feature store {args.store}: {len(store['cards']):,} cards from {len(store['batches'])} batches")
+    if args.screen:
+        feature, op, value = args.screen
+        cards = screen_customers(store, feature, op, float(value))
+        print(f'{len(cards):,} cards with {feature} {op} {value}')
+        print(feature_frame(store, cards[:20]))
+    if args.segments:
+        print(segment_counts(store))
@@ -0,0 +1,147 @@
+# Persistent, memory-mapped index of the customer demographics for the loyalty card join
+# The index is a sorted array of card numbers plus one aligned array of categorical codes per
+# demographic column (LIFESTAGE, PREMIUM_CUSTOMER), saved as .npy files and opened with mmap, so
+# loading it is instant and only the pages a lookup touches are read. Cards are found by binary
+# search (np.searchsorted, O(log n) per card, vectorized over a whole chunk of transactions) and
+# the demographics are attached by position as categoricals, without pd.merge's hash table.
+# The index is rebuilt when the customer file changes (size or mtime).
+#
+# The card -> row range index (build_card_rows) does the same for the transactions themselves:
+# rows sorted by card once, then the rows of any customer are a slice.
+#
+# Layout of the index directory:
+#   cards.npy              sorted loyalty card numbers (int64)
+#   <column>.npy           category codes of each demographic column, aligned with cards (int8)
+#   meta.json              categories of each column and the size/mtime of the customer file
+#
+# Usage (from the data directory):
+#   python customer_index.py --customers QVI_purchase_behaviour.csv
+import argparse
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from workbook_io import CUSTOMER_DATA_PATH, read_customer_data
+
+# Index directory, override with the QVI_CUSTOMER_INDEX environment variable
+CUSTOMER_INDEX_PATH = os.environ.get('QVI_CUSTOMER_INDEX', 'QVI_customer_index')
+
+# Key column of the customer demographics
+CARD_COLUMN = 'LYLTY_CARD_NBR'
+
+
+# Build the index from the customer demographics, every column other than the card number is coded
+# Repeated identical rows are kept once; a card with conflicting details raises
+def build_customer_index(customer_data):
+    customer_data = customer_data.drop_duplicates().sort_values(CARD_COLUMN, kind='stable')
+    cards = customer_data[CARD_COLUMN].to_numpy(dtype=np.int64)
+    if len(cards) > 1 and (cards[1:] == cards[:-1]).any():
+        raise ValueError(f'Conflicting customer details for some {CARD_COLUMN} values in the customer data')
+    index = {'cards': cards, 'codes': {}, 'categories': {}}
+    for column in customer_data.columns.drop(CARD_COLUMN):
+        values = customer_data[column].astype('category')
+        index['categories'][column] = values.cat.categories.tolist()
+        index['codes'][column] = values.cat.codes.to_numpy()
+    return index
+
+
+# Save an index, written to a temporary directory first so a partial index is never opened
+def save_customer_index(index, path=CUSTOMER_INDEX_PATH, source=None):
+    tmp_path = f'{path}.tmp{os.getpid()}'
+    os.makedirs(tmp_path, exist_ok=True)
+    np.save(os.path.join(tmp_path, 'cards.npy'), index['cards'])
+    for column, codes in index['codes'].items():
+        np.save(os.path.join(tmp_path, f'{column}.npy'), codes)
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump({'categories': index['categories'], 'source': source}, f)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+
+
+# Open a saved index, the arrays memory-mapped read-only
+def open_customer_index(path=CUSTOMER_INDEX_PATH):
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    return {
+        'cards': np.load(os.path.join(path, 'cards.npy'), mmap_mode='r'),
+        'codes': {column: np.load(os.path.join(path, f'{column}.npy'), mmap_mode='r') for column in meta['categories']},
+        'categories': meta['categories'],
+        'source': meta['source']
+    }
+
+
+# Size and mtime of the customer file, to tell if a saved index is still current
+def source_signature(customer_path):
+    stat = os.stat(customer_path)
+    return {'path': os.path.abspath(customer_path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+# Index of the customer file, opened from disk or rebuilt (and saved) if the file changed
+def load_customer_index(customer_path=CUSTOMER_DATA_PATH, path=CUSTOMER_INDEX_PATH):
+    source = source_signature(customer_path)
+    if os.path.exists(os.path.join(path, 'meta.json')):
+        index = open_customer_index(path)
+        if index['source'] == source:
+            return index
+    save_customer_index(build_customer_index(read_customer_data(customer_path)), path, source)
+    return open_customer_index(path)
+
+
+# Positions of card numbers in the index, -1 for cards without customer details
+# The cards are searched in sorted order: binary searches for unsorted keys jump all over the
+# index, sorted keys walk through it once
+def customer_positions(index, cards):
+    cards = np.asarray(cards, dtype=np.int64)
+    order = np.argsort(cards)
+    positions = np.empty(len(cards), dtype=np.intp)
+    positions[order] = np.searchsorted(index['cards'], cards[order])
+    positions[positions == len(index['cards'])] = 0
+    found = len(index['cards']) > 0 and np.asarray(index['cards'])[positions] == cards
+    return np.where(found, positions, -1)
+
+
+# Transactions with the demographic columns attached by position, like a left pd.merge on the card
+# number (same row order, new RangeIndex); cards missing from the index get nulls
+def join_customers(transactions, index, positions=None):
+    if positions is None:
+        positions = customer_positions(index, transactions[CARD_COLUMN])
+    joined = transactions.reset_index(drop=True)
+    missing = positions < 0
+    for column, categories in index['categories'].items():
+        codes = np.full(len(positions), -1, dtype=np.int64)
+        codes[~missing] = index['codes'][column][positions[~missing]]
+        joined[column] = pd.Categorical.from_codes(codes, categories=categories)
+    return joined
+
+
+# Card -> row range index of a transaction table: the row positions sorted by card, and the
+# first sorted position of every distinct card
+def build_card_rows(cards):
+    cards = np.asarray(cards)
+    order = np.argsort(cards, kind='stable')
+    distinct, starts = np.unique(cards[order], return_index=True)
+    return {'cards': distinct, 'starts': np.append(starts, len(cards)), 'order': order}
+
+
+# Row positions of one customer's transactions, in table order
+def card_row_positions(card_rows, card):
+    i = np.searchsorted(card_rows['cards'], card)
+    if i == len(card_rows['cards']) or card_rows['cards'][i] != card:
+        return np.array([], dtype=np.intp)
+    return card_rows['order'][card_rows['starts'][i]:card_rows['starts'][i + 1]]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the memory-mapped customer index.')
+    parser.add_argument('--customers', default=CUSTOMER_DATA_PATH, help='CSV or xlsx')
+    parser.add_argument('--output', default=CUSTOMER_INDEX_PATH)
+    args = parser.parse_args()
+
+    index = load_customer_index(args.customers, args.output)
+    print(f"{len(index['cards']):,} customers indexed in {args.output}")
+    for column, categories in index['categories'].items():
+        print(f'{column}: {len(categories)} categories')
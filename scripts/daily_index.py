@@ -0,0 +1,115 @@
+# Dense store x day index of the transactions over the observation period
+# One pass over the transactions adds every row into a (stores x days) array per measure
+# (transactions, sales, units) with np.bincount, so every day of the period is present and days
+# without transactions hold 0 instead of being missing rows. The calendar index is arithmetic: the
+# column of a date is its day offset from the start of the period, O(1) with no lookup table.
+# Windows (the December zoom), per-store daily series and daily totals are then array slices,
+# and zero-transaction days (Christmas Day) are found from the daily totals, not by merging a
+# date range and filtering it again for every window.
+#
+# Usage (from the data directory):
+#   python daily_index.py QVI_cleaned_data.csv --window 2018-12-01 2018-12-31
+#   python daily_index.py QVI_cleaned_data.csv --store 88 --measure sales --window 2019-02-01 2019-04-30
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from instrumentation import instrumented
+from qvi_io import CLEANED_DATA_PATH, read_cleaned_data
+
+# Observation period of the transaction data, both ends included
+PERIOD_START = '2018-07-01'
+PERIOD_END = '2019-06-30'
+
+# Measures of the index: name -> column summed per store and day, None counts transactions
+DAILY_MEASURES = {
+    'transactions': None,
+    'sales': 'TOT_SALES',
+    'units': 'PROD_QTY'
+}
+
+# Columns of the cleaned data the index is built from
+DAILY_COLUMNS = ['DATE', 'STORE_NBR', 'TOT_SALES', 'PROD_QTY']
+
+
+# Day offsets of dates from the start of the index, raises ValueError outside the period
+def day_offsets(index, dates):
+    offsets = (np.asarray(dates, dtype='datetime64[D]') - index['start']).astype(np.int64)
+    if np.any((offsets < 0) | (offsets >= len(index['days']))):
+        raise ValueError(f"Dates outside the indexed period {index['days'][0]} to {index['days'][-1]}")
+    return offsets
+
+
+# Build the index of the transactions over start..end (both included)
+# Returns {'start': first day, 'days': every day of the period, 'stores': sorted store numbers,
+#          'values': {measure: (stores x days) array}, 'totals': {measure: daily total over all stores}}
+@instrumented('build_daily_index')
+def build_daily_index(transactions, start=PERIOD_START, end=PERIOD_END, measures=None):
+    if measures is None:
+        measures = DAILY_MEASURES
+    index = {'start': np.datetime64(start, 'D'), 'days': np.arange(np.datetime64(start, 'D'), np.datetime64(end, 'D') + 1)}
+    if not len(index['days']):
+        raise ValueError(f'Empty period {start} to {end}')
+    offsets = day_offsets(index, transactions['DATE'].to_numpy())
+    store_positions, index['stores'] = pd.factorize(transactions['STORE_NBR'].to_numpy(), sort=True)
+    cells = store_positions.astype(np.int64) * len(index['days']) + offsets
+    shape = (len(index['stores']), len(index['days']))
+
+    index['values'], index['totals'] = {}, {}
+    for name, column in measures.items():
+        weights = None if column is None else transactions[column].to_numpy(dtype=np.float64)
+        values = np.bincount(cells, weights=weights, minlength=shape[0] * shape[1]).reshape(shape)
+        index['values'][name] = values if column is None else values.astype(np.float64)
+        index['totals'][name] = values.sum(axis=0)
+    return index
+
+
+# Column slice of a window, start..end both included; None is the start or end of the period
+def window_slice(index, start=None, end=None):
+    first = 0 if start is None else int(day_offsets(index, start))
+    last = len(index['days']) - 1 if end is None else int(day_offsets(index, end))
+    if last < first:
+        raise ValueError(f'Window ends before it starts: {start} to {end}')
+    return slice(first, last + 1)
+
+
+# Daily series of a window: the total over all stores, or the series of one store
+# Returns a frame with DATE and the measure, one row per day of the window
+def daily_series(index, measure='transactions', start=None, end=None, store=None):
+    window = window_slice(index, start, end)
+    if store is None:
+        values = index['totals'][measure][window]
+    else:
+        position = np.searchsorted(index['stores'], store)
+        if position >= len(index['stores']) or index['stores'][position] != store:
+            raise ValueError(f'Store {store} has no transactions')
+        values = index['values'][measure][position, window]
+    return pd.DataFrame({'DATE': pd.DatetimeIndex(index['days'][window]), measure: values})
+
+
+# Daily series of every store in a window, one row per store and one column per day
+def store_window(index, measure='transactions', start=None, end=None):
+    window = window_slice(index, start, end)
+    return pd.DataFrame(index['values'][measure][:, window], index=pd.Index(index['stores'], name='STORE_NBR'),
+                        columns=pd.DatetimeIndex(index['days'][window], name='DATE'))
+
+
+# Days of a window without any transaction in any store
+def zero_days(index, start=None, end=None):
+    window = window_slice(index, start, end)
+    return pd.DatetimeIndex(index['days'][window][index['totals']['transactions'][window] == 0])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Dense store x day index of the transactions.')
+    parser.add_argument('cleaned_data', nargs='?', default=CLEANED_DATA_PATH)
+    parser.add_argument('--measure', default='transactions', choices=list(DAILY_MEASURES))
+    parser.add_argument('--window', nargs=2, metavar=('START', 'END'), default=(None, None))
+    parser.add_argument('--store', type=int, default=None, help='series of one store instead of the total')
+    args = parser.parse_args()
+
+    index = build_daily_index(read_cleaned_data(args.cleaned_data, columns=DAILY_COLUMNS))
+    print(f"{len(index['stores'])} stores x {len(index['days'])} days")
+    print(daily_series(index, args.measure, *args.window, store=args.store).to_string(index=False))
+    print(f"Days without transactions: {[str(day.date()) for day in zero_days(index, *args.window)]}")
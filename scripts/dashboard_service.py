@@ -0,0 +1,408 @@
+# Live trial monitoring dashboard, a local asyncio HTTP service
+# Keeps the store/month aggregates, measureOverTime and the trial/control results of the trial
+# stores warm in memory instead of re-running Trial_store_analysis.py by hand every week.
+# New batches of cleaned transactions dropped in the watched directory are appended to the
+# aggregate store (monthly_aggregates.py). Only the store/months of a batch are recomputed, and
+# only the trials whose pre-trial or trial months changed are matched and assessed again
+# (trial_batch.py). Responses are built once per refresh and the charts are rendered in worker
+# processes, so viewers are always answered from memory and never wait on matplotlib.
+#
+# Endpoints:
+#   /                     index page with the trial results and charts, reloads itself
+#   /status               version, batches, stores and months of the warm state
+#   /trials               trial/control results, one row per trial store
+#   /measures?store=77    measureOverTime of one store (every store without the parameter)
+#   /charts/<store>.png   trial store against its control store over time
+# Responses carry an ETag, so viewers polling an unchanged state get a 304 without a body.
+#
+# A batch is a cleaned transaction file, CSV or Parquet dataset (see qvi_io.py). Write it under a
+# name starting with '.' and rename it when complete: names starting with '.' are not read.
+#
+# Usage (from the data directory):
+#   python dashboard_service.py --watch incoming --port 8050
+#   python dashboard_service.py --specs trial_specs.csv --store QVI_monthly_aggregates
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+from functools import partial
+from urllib.parse import parse_qs, urlsplit
+import argparse
+import asyncio
+import html
+import io
+import json
+import os
+
+import matplotlib
+
+matplotlib.use('Agg')
+
+import matplotlib.pyplot as plt  # noqa: E402
+import pandas as pd  # noqa: E402
+
+from instrumentation import instrumented  # noqa: E402
+from monthly_aggregates import (AGGREGATE_COLUMNS, AGGREGATE_STORE_PATH, KEYS, append_transactions,  # noqa: E402
+                                incomplete_stores, load_aggregates, load_batches, measure_over_time)
+from qvi_io import CLEANED_DATA_PATH, is_csv, read_cleaned_data  # noqa: E402
+from trial_batch import ASSESS_METRICS, evaluate_trials, metric_cube  # noqa: E402
+
+# Directory watched for new batches, override with the QVI_DASHBOARD_WATCH environment variable
+DASHBOARD_WATCH_DIR = os.environ.get('QVI_DASHBOARD_WATCH', 'incoming')
+
+# Seconds between two scans of the watched directory, also the reload interval of the index page
+POLL_SECONDS = 5
+
+# Trial stores monitored by default, as in Trial_store_analysis.py
+DEFAULT_TRIALS = [(77, (201902, 201904)), (86, (201902, 201904)), (88, (201902, 201904))]
+
+# Columns identifying a trial spec in the results
+SPEC_COLUMNS = ['trial_store', 'trial_start', 'trial_end']
+
+# Metrics drawn in the trial charts, one panel each
+CHART_METRICS = list(ASSESS_METRICS)
+
+# Resolution of the charts
+CHART_DPI = 100
+
+# Reason phrases of the status codes the service answers with
+STATUS_REASONS = {200: 'OK', 304: 'Not Modified', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed'}
+
+JSON_TYPE = 'application/json'
+
+
+# Trial specs from a CSV with columns trial_store, trial_start, trial_end, as in trial_batch.py
+def read_specs(path):
+    specs = pd.read_csv(path)
+    return list(zip(specs['trial_store'], zip(specs['trial_start'], specs['trial_end'])))
+
+
+# Empty warm state of the service for a list of (trial store, (trial start, trial end)) specs
+# The request handlers only read it; refresh() replaces its entries on the event loop
+def new_state(specs):
+    trial_stores = [int(store) for store, _ in specs]
+    if len(set(trial_stores)) != len(trial_stores):
+        raise ValueError(f'Every trial store can only be monitored once, got {trial_stores}')
+    return {
+        'specs': [(int(store), (int(period[0]), int(period[1]))) for store, period in specs],
+        'aggregates': None,
+        'measures': None,
+        'null_stores': None,
+        'trials': None,
+        'charts': {},
+        'responses': {},
+        'batches': [],
+        'failed_batches': {},
+        'version': 0,
+        'updated': None
+    }
+
+
+# Append one batch of cleaned transactions to the aggregate store
+# Returns the new aggregates and the (STORE_NBR, YEARMONTH) index of the store/months in the batch
+def ingest_batch(path, store_path, batch_id):
+    transactions = read_cleaned_data(path, columns=AGGREGATE_COLUMNS)
+    affected = pd.MultiIndex.from_frame(transactions[KEYS].drop_duplicates().astype('int64'))
+    return append_transactions(transactions, store_path, batch_id), affected
+
+
+# Batches in the watched directory that were not appended yet, oldest first: (path, batch id)
+# The batch id is the one of the monthly_aggregates.py command line, the path and its mtime
+def new_batches(directory, seen):
+    if not os.path.isdir(directory):
+        return []
+    entries = [entry for entry in os.scandir(directory)
+               if not entry.name.startswith('.') and (entry.is_dir() or is_csv(entry.name))]
+    batches = [(entry.path, f'{os.path.abspath(entry.path)}@{entry.stat().st_mtime}')
+               for entry in sorted(entries, key=lambda entry: entry.stat().st_mtime)]
+    return [(path, batch_id) for path, batch_id in batches if batch_id not in seen]
+
+
+# measureOverTime with the affected store/months recomputed from the aggregates and the rest kept
+# affected: None recomputes every store/month
+def update_measures(measures, aggregates, affected=None):
+    if measures is None or affected is None:
+        return measure_over_time(aggregates)
+    changed = measure_over_time(aggregates.loc[affected])
+    kept = measures.set_index(KEYS).drop(affected, errors='ignore').reset_index()
+    return pd.concat([kept, changed]).sort_values(KEYS, ignore_index=True)
+
+
+# Match and assess the given specs on the stores with a full observation period
+# Trial stores without a full observation period get a row without control store
+def evaluate_specs(complete, null_stores, specs):
+    valid = [spec for spec in specs if spec[0] not in null_stores]
+    invalid = pd.DataFrame([(store, period[0], period[1]) for store, period in specs if store in null_stores],
+                           columns=SPEC_COLUMNS)
+    results = evaluate_trials(complete, valid, processes=1) if valid else pd.DataFrame(columns=SPEC_COLUMNS)
+    return pd.concat([results, invalid], ignore_index=True) if len(invalid) else results
+
+
+# New measures, trial results and the charts to render after the aggregates changed
+# Matching reads every month before the trial and the assessment the trial months, so a trial is
+# evaluated again when a month up to its trial end changed, and every trial is when the set of
+# stores with a full observation period changed. Charts are drawn again for those trials and for
+# trials whose trial or control store changed.
+# Returns the new state entries and the arguments of render_trial_chart per trial store to draw
+# (None for trials without a control store, whose chart is dropped)
+@instrumented('dashboard_update')
+def compute_update(state, aggregates, affected=None):
+    measures = update_measures(state['measures'], aggregates, affected)
+    null_stores = incomplete_stores(aggregates) if len(aggregates) else []
+    if affected is None or null_stores != state['null_stores']:
+        specs = state['specs']
+    else:
+        first_month = affected.get_level_values('YEARMONTH').min()
+        specs = [spec for spec in state['specs'] if first_month <= spec[1][1]]
+
+    complete = measures[~measures['STORE_NBR'].isin(null_stores)]
+    results = evaluate_specs(complete, set(null_stores), specs) if len(complete) else None
+    trials = state['trials']
+    if results is None:
+        trials = pd.DataFrame([(store, period[0], period[1]) for store, period in state['specs']], columns=SPEC_COLUMNS)
+    elif specs:
+        kept = trials[~trials['trial_store'].isin(results['trial_store'])] if trials is not None else None
+        trials = pd.concat([kept, results], ignore_index=True).sort_values('trial_store', ignore_index=True)
+
+    charts = {}
+    if results is None:
+        charts = {store: None for store, _ in state['specs']}
+    else:
+        cube, stores, months = metric_cube(complete, CHART_METRICS)
+        changed_stores = None if affected is None else set(affected.get_level_values('STORE_NBR'))
+        for row in trials.itertuples(index=False):
+            trial_store, control_store = int(row.trial_store), row.control_store
+            if pd.isnull(control_store):
+                charts[trial_store] = None
+                continue
+            if (changed_stores is not None and trial_store not in results['trial_store'].values
+                    and trial_store not in changed_stores and control_store not in changed_stores):
+                continue
+            trial_position, control_position = stores.searchsorted([trial_store, control_store])
+            charts[trial_store] = (trial_store, int(control_store), (int(row.trial_start), int(row.trial_end)),
+                                   months, cube[:, trial_position], cube[:, control_position])
+    return {'aggregates': aggregates, 'measures': measures, 'null_stores': null_stores, 'trials': trials}, charts
+
+
+# Worker: chart of a trial store against its control store, one panel per metric with the trial
+# period shaded, returned as PNG bytes
+def render_trial_chart(trial_store, control_store, trial_period, months, trial_values, control_values):
+    dates = pd.to_datetime([str(month) for month in months], format='%Y%m')
+    start = pd.to_datetime(str(trial_period[0]), format='%Y%m')
+    end = pd.to_datetime(str(trial_period[1]), format='%Y%m') + pd.offsets.MonthEnd(0)
+    fig, axes = plt.subplots(len(CHART_METRICS), 1, figsize=(10, 3 * len(CHART_METRICS)), sharex=True, squeeze=False)
+    for ax, metric, trial, control in zip(axes[:, 0], CHART_METRICS, trial_values, control_values):
+        ax.plot(dates, trial, marker='o', label=f'Trial store {trial_store}')
+        ax.plot(dates, control, marker='o', label=f'Control store {control_store}')
+        ax.axvspan(start, end, color='grey', alpha=0.2, label='Trial period')
+        ax.set_ylabel(metric)
+        ax.legend(loc='upper left')
+    axes[0, 0].set_title(f'Trial store {trial_store} against control store {control_store}')
+    fig.tight_layout()
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format='png', dpi=CHART_DPI)
+    plt.close(fig)
+    return buffer.getvalue()
+
+
+# Bring the warm state up to date with the aggregates, off the event loop: the measures and trials
+# are computed in the state thread, the charts in the rendering processes. The new entries are
+# swapped in together once everything is ready, so viewers never see a half-updated state.
+# affected: (STORE_NBR, YEARMONTH) index of the store/months that changed, None recomputes everything
+async def refresh(state, aggregates, affected, threads, renderers):
+    loop = asyncio.get_running_loop()
+    update, charts = await loop.run_in_executor(threads, compute_update, state, aggregates, affected)
+    drawn = [store for store, args in charts.items() if args is not None]
+    images = await asyncio.gather(*[loop.run_in_executor(renderers, render_trial_chart, *charts[store]) for store in drawn])
+
+    version = state['version'] + 1
+    for store in [store for store, args in charts.items() if args is None]:
+        state['charts'].pop(store, None)
+    state['charts'].update({store: (version, image) for store, image in zip(drawn, images)})
+    state.update(update, version=version, updated=datetime.now().isoformat(timespec='seconds'), responses={})
+    print(f'Dashboard state {version}: {len(update["measures"])} store/months, '
+          f'{len(drawn)} charts drawn, {len(state["batches"])} batches')
+
+
+# Scan the watched directory and refresh the state after new batches were appended
+# A batch that cannot be read is reported in /status and not retried until its file changes
+async def watch(state, store_path, directory, poll_seconds, threads, renderers):
+    loop = asyncio.get_running_loop()
+    while True:
+        affected = None
+        aggregates = None
+        for path, batch_id in new_batches(directory, set(state['batches']) | set(state['failed_batches'])):
+            try:
+                aggregates, batch_affected = await loop.run_in_executor(threads, ingest_batch, path, store_path, batch_id)
+            except (OSError, ValueError, KeyError) as error:
+                state['failed_batches'][batch_id] = str(error)
+                print(f'Batch {path} skipped: {error}')
+                continue
+            state['batches'].append(batch_id)
+            affected = batch_affected if affected is None else affected.union(batch_affected)
+        if aggregates is not None:
+            await refresh(state, aggregates, affected, threads, renderers)
+        await asyncio.sleep(poll_seconds)
+
+
+# Summary of the warm state for /status
+def status_payload(state):
+    measures = state['measures']
+    return {
+        'version': state['version'],
+        'updated': state['updated'],
+        'batches': len(state['batches']),
+        'failed_batches': state['failed_batches'],
+        'stores': int(measures['STORE_NBR'].nunique()) if measures is not None else 0,
+        'months': sorted(int(month) for month in measures['YEARMONTH'].unique()) if measures is not None else [],
+        'null_stores': [int(store) for store in state['null_stores'] or []],
+        'trial_stores': [store for store, _ in state['specs']]
+    }
+
+
+# Index page: the trial results and the chart of every trial store
+def index_page(state, poll_seconds=POLL_SECONDS):
+    lines = ['<html><head><meta charset="utf-8">',
+             f'<meta http-equiv="refresh" content="{int(poll_seconds)}"><title>Trial monitoring</title></head><body>',
+             '<h1>Trial monitoring</h1>',
+             f'<p>State {state["version"]}, updated {html.escape(str(state["updated"]))}, {len(state["batches"])} batches</p>']
+    if state['trials'] is not None:
+        lines.append(state['trials'].to_html(index=False, na_rep=''))
+    for store, (version, _) in sorted(state['charts'].items()):
+        lines.append(f'<h2>Trial store {store}</h2>')
+        lines.append(f'<p><img src="/charts/{store}.png?v={version}" style="max-width: 100%"></p>')
+    lines.append('</body></html>')
+    return '\n'.join(lines).encode('utf-8')
+
+
+# Records of a frame as JSON, NaN as null
+def json_records(df):
+    return df.to_json(orient='records').encode('utf-8') if df is not None else b'[]'
+
+
+# Response to a path of the current state: (status, content type, body)
+def build_response(state, path, query):
+    if path == '/':
+        return 200, 'text/html; charset=utf-8', index_page(state)
+    if path == '/status':
+        return 200, JSON_TYPE, json.dumps(status_payload(state)).encode('utf-8')
+    if path == '/trials':
+        return 200, JSON_TYPE, json_records(state['trials'])
+    if path == '/measures':
+        measures = state['measures']
+        if 'store' in query and measures is not None:
+            store = query['store'][0]
+            if not store.isdigit():
+                return 400, 'text/plain', b'store must be a store number'
+            measures = measures[measures['STORE_NBR'] == int(store)]
+            if not len(measures):
+                return 404, 'text/plain', f'No measures for store {store}'.encode('utf-8')
+        return 200, JSON_TYPE, json_records(measures)
+    return 404, 'text/plain', b'Not found'
+
+
+# Response to a GET request: (status, content type, body, ETag)
+# Successful responses are kept until the next refresh, the charts until they are drawn again
+def route(state, target):
+    url = urlsplit(target)
+    if url.path.startswith('/charts/') and url.path.endswith('.png'):
+        store = url.path[len('/charts/'):-len('.png')]
+        chart = state['charts'].get(int(store)) if store.isdigit() else None
+        if chart is None:
+            return 404, 'text/plain', b'Not found', None
+        return 200, 'image/png', chart[1], f'"chart-{chart[0]}"'
+    key = (url.path, url.query)
+    response = state['responses'].get(key)
+    if response is None:
+        response = build_response(state, url.path, parse_qs(url.query))
+        if response[0] == 200:
+            state['responses'][key] = response
+    status, content_type, body = response
+    return status, content_type, body, f'"{state["version"]}"' if status == 200 else None
+
+
+# Serve the requests of one connection, HTTP/1.1 with keep-alive, GET and HEAD only
+async def handle_connection(state, reader, writer):
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+
+            parts = request_line.decode('latin-1').split()
+            if len(parts) != 3:
+                status, content_type, body, etag = 400, 'text/plain', b'Bad request', None
+                method, version = 'GET', 'HTTP/1.0'
+            else:
+                method, target, version = parts
+                if method in ('GET', 'HEAD'):
+                    status, content_type, body, etag = route(state, target)
+                else:
+                    status, content_type, body, etag = 405, 'text/plain', b'Method not allowed', None
+            if status == 200 and etag is not None and headers.get('if-none-match') == etag:
+                status, body = 304, b''
+
+            keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+            head = [f'HTTP/1.1 {status} {STATUS_REASONS[status]}', f'Content-Type: {content_type}',
+                    f'Content-Length: {len(body)}', 'Cache-Control: no-cache']
+            if etag is not None:
+                head.append(f'ETag: {etag}')
+            if not keep_alive:
+                head.append('Connection: close')
+            writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1'))
+            if method != 'HEAD':
+                writer.write(body)
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (ConnectionError, asyncio.LimitOverrunError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+# Run the service until interrupted: load the aggregate store (appending the cleaned data first if
+# the store is empty), compute the warm state, then serve requests and watch for new batches
+async def serve(specs, store_path=AGGREGATE_STORE_PATH, cleaned_data=CLEANED_DATA_PATH, directory=DASHBOARD_WATCH_DIR,
+                host='127.0.0.1', port=8050, poll_seconds=POLL_SECONDS, processes=None):
+    state = new_state(specs)
+    state['batches'] = load_batches(store_path)
+    loop = asyncio.get_running_loop()
+    with ThreadPoolExecutor(max_workers=1) as threads, ProcessPoolExecutor(max_workers=processes) as renderers:
+        aggregates = load_aggregates(store_path)
+        if not len(aggregates) and cleaned_data and os.path.exists(cleaned_data):
+            batch_id = f'{os.path.abspath(cleaned_data)}@{os.path.getmtime(cleaned_data)}'
+            aggregates, _ = await loop.run_in_executor(threads, ingest_batch, cleaned_data, store_path, batch_id)
+            state['batches'].append(batch_id)
+        await refresh(state, aggregates, None, threads, renderers)
+
+        server = await asyncio.start_server(partial(handle_connection, state), host, port)
+        print(f'Serving the trial dashboard on http://{host}:{port}/, watching {directory} for new batches')
+        async with server:
+            await asyncio.gather(server.serve_forever(),
+                                 watch(state, store_path, directory, poll_seconds, threads, renderers))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve live trial monitoring from the monthly aggregate store.')
+    parser.add_argument('--specs', default=None, help='CSV with trial_store, trial_start, trial_end (default: 77, 86, 88)')
+    parser.add_argument('--store', default=AGGREGATE_STORE_PATH)
+    parser.add_argument('--cleaned-data', default=CLEANED_DATA_PATH, help='appended first if the store is empty')
+    parser.add_argument('--watch', default=DASHBOARD_WATCH_DIR, help='directory of new cleaned transaction batches')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8050)
+    parser.add_argument('--poll-seconds', type=float, default=POLL_SECONDS)
+    parser.add_argument('--processes', type=int, default=None, help='chart rendering processes')
+    args = parser.parse_args()
+
+    specs = read_specs(args.specs) if args.specs else DEFAULT_TRIALS
+    try:
+        asyncio.run(serve(specs, args.store, args.cleaned_data, args.watch, args.host, args.port,
+                          args.poll_seconds, args.processes))
+    except KeyboardInterrupt:
+        pass
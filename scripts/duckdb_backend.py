@@ -0,0 +1,127 @@
+# DuckDB execution backend (see execution_backend.py), needs the duckdb package
+# The cleaning and aggregation stages run as DuckDB queries straight over the local CSV/Parquet
+# files. DuckDB scans lazily, reads only the columns a query uses, applies the WHERE clauses
+# (salsa filter, outlier customers, month cut) during the scan, prunes Parquet month partitions
+# and spills joins and aggregations to DUCKDB_TEMP_DIRECTORY when they do not fit in memory.
+# Only the product dimension and the final store/month table are brought into pandas.
+import os
+
+import duckdb
+
+from cleaning_pipeline import ORIGIN_DATE
+from exclusion_rules import DEFAULT_EXCLUSION_RULES, EXCLUSION_RULES, OUTLIER_QTY
+from product_dimension import PRODUCT_DIMENSION_PATH, load_product_dimension, product_word_counts
+from qvi_io import CLEANED_DATA_PATH, apply_schema, is_csv, remove_output
+from workbook_io import CUSTOMER_DATA_PATH, is_workbook, workbook_cache
+
+# Spill directory and memory limit of the DuckDB connection, e.g. QVI_DUCKDB_MEMORY_LIMIT=4GB
+DUCKDB_TEMP_DIRECTORY = os.environ.get('QVI_DUCKDB_TEMP_DIRECTORY', 'duckdb_tmp')
+DUCKDB_MEMORY_LIMIT = os.environ.get('QVI_DUCKDB_MEMORY_LIMIT')
+
+# Store/month measures, the same definitions as store_metrics.METRICS
+# fsum is a compensated sum, like the pandas float sums
+MEASURE_SQL = '''
+SELECT STORE_NBR, YEARMONTH,
+       fsum(TOT_SALES) AS "Total Sales",
+       count(DISTINCT LYLTY_CARD_NBR) AS no_Customers,
+       count(DISTINCT TXN_ID) / count(DISTINCT LYLTY_CARD_NBR) AS trans_per_customer,
+       sum(PROD_QTY) / count(DISTINCT TXN_ID) AS chips_per_customer,
+       fsum(TOT_SALES) / sum(PROD_QTY) AS average_price
+FROM {source}
+{where}
+GROUP BY STORE_NBR, YEARMONTH
+ORDER BY STORE_NBR, YEARMONTH
+'''
+
+
+# Quote a file path as an SQL string literal
+def sql_path(path):
+    return "'" + str(path).replace("'", "''") + "'"
+
+
+# New DuckDB connection that spills to disk; insertion order is not kept so large queries can stream
+def connect():
+    con = duckdb.connect()
+    con.execute(f'SET temp_directory = {sql_path(DUCKDB_TEMP_DIRECTORY)}')
+    con.execute('SET preserve_insertion_order = false')
+    if DUCKDB_MEMORY_LIMIT:
+        con.execute(f'SET memory_limit = {sql_path(DUCKDB_MEMORY_LIMIT)}')
+    return con
+
+
+# Table expression over the cleaned data, CSV or the month-partitioned Parquet dataset,
+# with YEARMONTH available either way
+def cleaned_source(path=CLEANED_DATA_PATH):
+    if is_csv(path):
+        return (f'(SELECT *, year(DATE) * 100 + month(DATE) AS YEARMONTH '
+                f'FROM read_csv({sql_path(path)}, header = true))')
+    return f"read_parquet({sql_path(os.path.join(path, '**', '*.parquet'))}, hive_partitioning = true)"
+
+
+# Table expression over the customer demographics, CSV or the Parquet conversion of an xlsx workbook
+def customer_source(path=CUSTOMER_DATA_PATH):
+    if is_workbook(path):
+        return f'read_parquet({sql_path(workbook_cache(path))})'
+    return f'read_csv({sql_path(path)}, header = true)'
+
+
+# Cleaning stage: the same steps as cleaning_pipeline.py, written by one COPY query
+# Row order of the output may differ from the transaction file
+# The salsa and outlier filters are written in SQL, so only the default exclusion rules are supported
+def clean(transaction_path='QVI_transaction_data.csv', customer_path=CUSTOMER_DATA_PATH,
+          output_path=CLEANED_DATA_PATH, product_dim_path=PRODUCT_DIMENSION_PATH):
+    if EXCLUSION_RULES != DEFAULT_EXCLUSION_RULES:
+        raise ValueError('The duckdb backend only applies the default exclusion rules, unset QVI_EXCLUSION_RULES')
+    con = connect()
+    transactions = f'read_csv({sql_path(transaction_path)}, header = true)'
+
+    # Product dimension from the distinct products, parsed in pandas (one row per product)
+    products = con.execute(f'SELECT PROD_NBR, PROD_NAME, count(*) AS n FROM {transactions} GROUP BY ALL').df()
+    product_dim = load_product_dimension(products[['PROD_NBR', 'PROD_NAME']], product_dim_path)
+    con.register('products', product_dim[['SALSA', 'PACK_SIZE', 'BRAND']].reset_index())
+
+    con.execute(f'''
+        CREATE TEMP TABLE outlier_customers AS
+        SELECT DISTINCT t.LYLTY_CARD_NBR
+        FROM {transactions} t JOIN products p USING (PROD_NBR)
+        WHERE t.PROD_QTY = {OUTLIER_QTY} AND NOT p.SALSA''')
+    outlier_customers = sorted(con.execute('SELECT LYLTY_CARD_NBR FROM outlier_customers').df()['LYLTY_CARD_NBR'].tolist())
+
+    cleaned = f'''
+        SELECT DATE {sql_path(ORIGIN_DATE)} + CAST(t.DATE AS INTEGER) AS DATE, t.STORE_NBR, t.LYLTY_CARD_NBR,
+               t.TXN_ID, t.PROD_NBR, t.PROD_NAME, t.PROD_QTY, t.TOT_SALES, p.PACK_SIZE, p.BRAND,
+               c.LIFESTAGE, c.PREMIUM_CUSTOMER
+        FROM {transactions} t
+        JOIN products p USING (PROD_NBR)
+        LEFT JOIN {customer_source(customer_path)} c USING (LYLTY_CARD_NBR)
+        WHERE NOT p.SALSA AND t.LYLTY_CARD_NBR NOT IN (SELECT LYLTY_CARD_NBR FROM outlier_customers)'''
+    remove_output(output_path)
+    if is_csv(output_path):
+        con.execute(f'COPY ({cleaned}) TO {sql_path(output_path)} (FORMAT csv, HEADER)')
+    else:
+        con.execute(f'COPY (SELECT *, year(DATE) * 100 + month(DATE) AS YEARMONTH FROM ({cleaned})) '
+                    f'TO {sql_path(output_path)} (FORMAT parquet, PARTITION_BY (YEARMONTH))')
+
+    rows_out, missing_customers = con.execute(
+        f'SELECT count(*), count(*) - count(LIFESTAGE) FROM {cleaned_source(output_path)}').fetchone()
+    con.close()
+    product_counts = products.set_index('PROD_NBR')['n']
+    return {
+        'rows_in': int(product_counts.sum()),
+        'rows_out': rows_out,
+        'missing_customers': missing_customers,
+        'outlier_customers': outlier_customers,
+        'product_counts': product_counts,
+        'word_counts': product_word_counts(product_dim, product_counts)
+    }
+
+
+# Aggregation stage: store/month measures, only for months before `before` if given
+# The month cut is part of the scan, so Parquet partitions of later months are never read
+def measure_over_time(cleaned_path=CLEANED_DATA_PATH, before=None):
+    where = '' if before is None else f'WHERE YEARMONTH < {int(before)}'
+    con = connect()
+    measureOverTime = con.execute(MEASURE_SQL.format(source=cleaned_source(cleaned_path), where=where)).df()
+    con.close()
+    measureOverTime['no_Customers'] = measureOverTime['no_Customers'].astype('int64')
+    return apply_schema(measureOverTime).reset_index(drop=True)
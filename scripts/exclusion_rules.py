@@ -0,0 +1,161 @@
+# Declarative exclusion rules for the transaction data, evaluated together into one keep mask
+# Rules are plain dicts applied in order; each rule only sees the rows kept by the rules before it:
+#   {'name': ..., 'kind': 'product_name', 'pattern': 'salsa'}
+#       rows of products whose name matches a regex (case-insensitive), matched once per distinct product
+#   {'name': ..., 'kind': 'row', 'column': 'PROD_QTY', 'op': '>', 'value': 50}
+#       rows matching a condition
+#   {'name': ..., 'kind': 'customer', 'column': 'PROD_QTY', 'op': '>=', 'value': 200}
+#       every row of a loyalty card with at least one row matching the condition
+#   {'name': ..., 'kind': 'store', 'column': 'YEARMONTH'}
+#       every row of a store that misses a value of the column (a month) present in the data
+# Every rule produces a boolean mask over the frame. The masks are combined and the frame is filtered
+# once by the caller, so no rule copies the data. The report counts, per rule, the rows it excluded
+# that the earlier rules kept and the keys (cards, stores) it excluded.
+#
+# Replace the default rules with a JSON list of rules: QVI_EXCLUSION_RULES=rules.json
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+# Comparison operators of row, customer and store conditions
+OPS = {
+    '==': np.equal,
+    '!=': np.not_equal,
+    '>': np.greater,
+    '>=': np.greater_equal,
+    '<': np.less,
+    '<=': np.less_equal
+}
+
+# Pack quantity that marks a commercial (non retail) customer
+OUTLIER_QTY = 200
+
+# Key column of each rule kind that excludes whole keys
+KEY_COLUMNS = {'customer': 'LYLTY_CARD_NBR', 'store': 'STORE_NBR'}
+
+# The exclusions of chip_analysis.py: salsa products, then the commercial customer who bought 200 packs
+DEFAULT_EXCLUSION_RULES = [
+    {'name': 'salsa', 'kind': 'product_name', 'pattern': 'salsa'},
+    {'name': 'commercial_customer', 'kind': 'customer', 'column': 'PROD_QTY', 'op': '==', 'value': OUTLIER_QTY}
+]
+
+# Stores without a full observation period, as in Trial_store_analysis.py
+STORE_RULES = [
+    {'name': 'incomplete_store', 'kind': 'store', 'column': 'YEARMONTH'}
+]
+
+
+# Check a rule, raising ValueError for unknown kinds, operators or missing fields
+def validate_rule(rule):
+    required = {'product_name': ['pattern'], 'row': ['column', 'op', 'value'], 'customer': ['column', 'op', 'value'],
+                'store': ['column']}
+    if rule.get('kind') not in required:
+        raise ValueError(f"Unknown exclusion rule kind {rule.get('kind')!r}, expected one of {list(required)}")
+    missing = [field for field in ['name'] + required[rule['kind']] if field not in rule]
+    if missing:
+        raise ValueError(f'Exclusion rule {rule} is missing {missing}')
+    if 'op' in rule and rule['op'] not in OPS:
+        raise ValueError(f"Unknown operator {rule['op']!r} in exclusion rule {rule['name']!r}, expected one of {list(OPS)}")
+    return rule
+
+
+# Read a JSON list of rules
+def load_rules(path):
+    with open(path) as f:
+        return [validate_rule(rule) for rule in json.load(f)]
+
+
+# Rules used by the scripts, override with the QVI_EXCLUSION_RULES environment variable
+EXCLUSION_RULES = load_rules(os.environ['QVI_EXCLUSION_RULES']) if os.environ.get('QVI_EXCLUSION_RULES') else DEFAULT_EXCLUSION_RULES
+
+
+# Columns the rules read
+def rule_columns(rules):
+    columns = set()
+    for rule in rules:
+        if rule['kind'] == 'product_name':
+            columns |= {'PROD_NBR', 'PROD_NAME'}
+        else:
+            columns.add(rule['column'])
+        if rule['kind'] in KEY_COLUMNS:
+            columns.add(KEY_COLUMNS[rule['kind']])
+    return sorted(columns)
+
+
+# Rows matching the condition of a row or customer rule
+def condition_mask(df, rule):
+    return OPS[rule['op']](df[rule['column']].to_numpy(), rule['value'])
+
+
+# Rows whose product name matches the rule's pattern
+# With a product dimension (indexed by PROD_NBR) the names are looked up by product number,
+# otherwise the PROD_NAME column is factorized and each distinct name is matched once
+def product_name_mask(df, rule, products=None):
+    if products is not None:
+        flags = products['PROD_NAME'].str.contains(rule['pattern'], case=False, na=False).to_numpy()
+        positions = products.index.get_indexer(df['PROD_NBR'])
+        if (positions < 0).any():
+            raise ValueError('Transactions reference products missing from the product dimension')
+        return flags[positions]
+    codes, names = pd.factorize(df['PROD_NAME'])
+    flags = pd.Series(names).str.contains(rule['pattern'], case=False, na=False).to_numpy()
+    return np.append(flags, False)[codes]
+
+
+# Stores that miss a value of the rule's column (a month) among the kept rows
+def incomplete_keys(df, rule, keep):
+    keys = df[KEY_COLUMNS[rule['kind']]].to_numpy()[keep]
+    values = df[rule['column']].to_numpy()[keep]
+    key_codes, distinct_keys = pd.factorize(keys)
+    value_codes, distinct_values = pd.factorize(values)
+    pairs = np.unique(key_codes.astype(np.int64) * len(distinct_values) + value_codes)
+    counts = np.bincount(pairs // max(len(distinct_values), 1), minlength=len(distinct_keys))
+    return np.sort(np.asarray(distinct_keys)[counts < len(distinct_values)])
+
+
+# Evaluate the rules over a frame
+# products: product dimension for product_name rules (optional)
+# excluded_keys: precomputed keys of customer or store rules, by rule name (e.g. cards found in a
+# first pass over a file read in chunks); rules without an entry are evaluated on the frame
+# Returns {'keep': boolean mask, 'report': DataFrame per rule, 'excluded_keys': {rule name: keys}}
+def evaluate_rules(df, rules=EXCLUSION_RULES, products=None, excluded_keys=None):
+    excluded_keys = dict(excluded_keys or {})
+    keep = np.ones(len(df), dtype=bool)
+    report = []
+    for rule in rules:
+        kind = rule['kind']
+        if kind == 'product_name':
+            mask = product_name_mask(df, rule, products)
+        elif kind == 'row':
+            mask = condition_mask(df, rule)
+        else:
+            if rule['name'] not in excluded_keys:
+                if kind == 'customer':
+                    matches = keep & condition_mask(df, rule)
+                    excluded_keys[rule['name']] = np.unique(df[KEY_COLUMNS[kind]].to_numpy()[matches])
+                else:
+                    excluded_keys[rule['name']] = incomplete_keys(df, rule, keep)
+            mask = np.isin(df[KEY_COLUMNS[kind]].to_numpy(), excluded_keys[rule['name']])
+        excluded = keep & mask
+        report.append({'rule': rule['name'], 'kind': kind, 'rows_excluded': int(excluded.sum()),
+                       'keys_excluded': len(excluded_keys[rule['name']]) if kind in KEY_COLUMNS else None})
+        keep &= ~mask
+    report = pd.DataFrame(report, columns=['rule', 'kind', 'rows_excluded', 'keys_excluded']).astype({'keys_excluded': 'Int64'})
+    return {'keep': keep, 'report': report, 'excluded_keys': excluded_keys}
+
+
+# Rows that could match a customer rule, to collect in a first pass over a chunked file
+def customer_rule_candidates(df, rules=EXCLUSION_RULES):
+    mask = np.zeros(len(df), dtype=bool)
+    for rule in rules:
+        if rule['kind'] == 'customer':
+            mask |= condition_mask(df, rule)
+    return mask
+
+
+# Combine the per-rule reports of several chunks evaluated with the same excluded keys
+def combine_reports(reports):
+    combined = pd.concat(reports).groupby(['rule', 'kind'], sort=False)
+    return combined.agg({'rows_excluded': 'sum', 'keys_excluded': 'max'}).reset_index()
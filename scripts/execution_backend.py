@@ -0,0 +1,95 @@
+# Pluggable execution backends for the cleaning, aggregation and matching stages
+# Every backend implements the same stages over the same local files:
+#   clean(transaction_path, customer_path, output_path)  -> summary dict, writes QVI_cleaned_data
+#   measure_over_time(cleaned_path, before=None)         -> store/month measures (long table)
+# 'pandas' runs them in memory (cleaning chunk by chunk, see cleaning_pipeline.py);
+# 'duckdb' runs the same logic as lazy DuckDB queries that spill to disk, for larger-than-RAM
+# data (see duckdb_backend.py). Pick one with the QVI_BACKEND environment variable.
+# Matching only needs the small pre-trial measures, so it is shared by both backends:
+# the YEARMONTH < trial start cut is pushed down into the aggregation stage.
+#
+# Usage (from the data directory), all three stages end to end:
+#   python execution_backend.py --backend duckdb --trial-stores 77 86 88
+import argparse
+import importlib
+import os
+
+from cleaning_pipeline import run_chunked_pipeline
+from control_matching import find_similar_control_stores
+from monthly_aggregates import AGGREGATE_COLUMNS
+from qvi_io import CLEANED_DATA_PATH, read_cleaned_data
+from store_metrics import compute_measure_over_time
+from workbook_io import CUSTOMER_DATA_PATH
+
+# Backend used by the scripts, override with the QVI_BACKEND environment variable
+BACKEND = os.environ.get('QVI_BACKEND', 'pandas')
+
+# Module implementing each backend, imported only when the backend is used
+BACKENDS = {
+    'pandas': 'execution_backend',
+    'duckdb': 'duckdb_backend'
+}
+
+# Stages every backend implements
+STAGES = ['clean', 'measure_over_time']
+
+# First month of the trial period, matching uses the months before it
+TRIAL_START = 201902
+
+
+# Stage functions of a backend: stage name -> function
+def get_backend(name=BACKEND):
+    if name not in BACKENDS:
+        raise ValueError(f'Unknown execution backend: {name}, expected one of {list(BACKENDS)}')
+    module = importlib.import_module(BACKENDS[name])
+    return {stage: getattr(module, stage) for stage in STAGES}
+
+
+# pandas backend: clean the transactions chunk by chunk
+def clean(transaction_path='QVI_transaction_data.csv', customer_path=CUSTOMER_DATA_PATH,
+          output_path=CLEANED_DATA_PATH):
+    return run_chunked_pipeline(transaction_path, customer_path, output_path)
+
+
+# pandas backend: store/month measures, only for months before `before` if given
+# The month filter is handed to read_cleaned_data, which prunes Parquet month partitions
+def measure_over_time(cleaned_path=CLEANED_DATA_PATH, before=None):
+    filters = None if before is None else [('YEARMONTH', '<', before)]
+    df = read_cleaned_data(cleaned_path, columns=AGGREGATE_COLUMNS, filters=filters)
+    return compute_measure_over_time(df).reset_index()
+
+
+# Stores that miss a month of the observation period in a store/month table
+def stores_missing_months(measureOverTime):
+    months_per_store = measureOverTime.groupby('STORE_NBR')['YEARMONTH'].nunique()
+    return months_per_store[months_per_store < measureOverTime['YEARMONTH'].nunique()].index.tolist()
+
+
+# Matching stage: score control stores on the months before the trial start
+# Stores without every pre-trial month are not considered
+def match_control_stores(cleaned_path, trial_stores, trial_start=TRIAL_START, n=5, corr_weight=0.5, backend=BACKEND):
+    preTrialMeasures = get_backend(backend)['measure_over_time'](cleaned_path, before=trial_start)
+    preTrialMeasures = preTrialMeasures[~preTrialMeasures['STORE_NBR'].isin(stores_missing_months(preTrialMeasures))]
+    return find_similar_control_stores(preTrialMeasures, trial_stores, n=n, corr_weight=corr_weight)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run cleaning, aggregation and control store matching on one backend.')
+    parser.add_argument('--backend', default=BACKEND, choices=list(BACKENDS))
+    parser.add_argument('--transactions', default='QVI_transaction_data.csv')
+    parser.add_argument('--customers', default=CUSTOMER_DATA_PATH, help='CSV or xlsx')
+    parser.add_argument('--cleaned-data', default=CLEANED_DATA_PATH)
+    parser.add_argument('--trial-stores', type=int, nargs='+', default=[77, 86, 88])
+    parser.add_argument('--trial-start', type=int, default=TRIAL_START)
+    parser.add_argument('--output', default='QVI_measure_over_time.csv')
+    args = parser.parse_args()
+
+    stages = get_backend(args.backend)
+    summary = stages['clean'](args.transactions, args.customers, args.cleaned_data)
+    print(f"Rows read: {summary['rows_in']}, rows written: {summary['rows_out']}")
+
+    measureOverTime = stages['measure_over_time'](args.cleaned_data)
+    measureOverTime.to_csv(args.output, index=False)
+    print(f'{len(measureOverTime)} store/months saved to {args.output}')
+
+    print(match_control_stores(args.cleaned_data, args.trial_stores, args.trial_start, backend=args.backend))
@@ -0,0 +1,183 @@
+# Instrumentation of the named steps of the analysis scripts
+# Every step records wall time, CPU time, the resident set size (RSS) at its end, the process's peak
+# RSS so far and the rows going in and out. When a step raises the peak, the step set it. Steps nest;
+# an enclosing step includes the time of the steps inside it.
+# Turn it on with environment variables, nothing is recorded otherwise:
+#   QVI_PROFILE=json|trace          write the steps as a JSON log or a Chrome trace (chrome://tracing,
+#                                   ui.perfetto.dev) to QVI_PROFILE_PATH at exit
+#   QVI_PROFILE_PATH=<path>         output file, default qvi_profile.json
+#   QVI_PROFILE_SAMPLING=<seconds>  also sample the main thread's stack at this interval and write
+#                                   the counts as folded stacks (flamegraph.pl, speedscope) to
+#                                   <path>.folded, prefixed with the step that was running
+# When QVI_PROFILE is not set, `instrumented` returns functions unchanged and `step` returns a
+# shared no-op context manager, so the hooks can stay on the hot paths.
+#
+# Usage in the scripts:
+#   with step('merge_customers', rows_in=len(transaction_data)) as record:
+#       merged_data = pd.merge(...)
+#       record['rows_out'] = len(merged_data)
+#
+#   @instrumented('score_control_stores')
+#   def score_control_stores(preTrialMeasures, ...):
+import atexit
+import functools
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+
+# Output format, override with the QVI_PROFILE environment variable ('' turns instrumentation off)
+PROFILE = os.environ.get('QVI_PROFILE', '')
+
+# Output file, override with QVI_PROFILE_PATH
+PROFILE_PATH = os.environ.get('QVI_PROFILE_PATH', 'qvi_profile.json')
+
+# Stack sampling interval in seconds, override with QVI_PROFILE_SAMPLING (0 turns sampling off)
+PROFILE_SAMPLING = float(os.environ.get('QVI_PROFILE_SAMPLING', 0))
+
+# Output formats
+PROFILE_FORMATS = ['json', 'trace']
+
+if PROFILE and PROFILE not in PROFILE_FORMATS:
+    raise ValueError(f'Unknown QVI_PROFILE format {PROFILE!r}, expected one of {PROFILE_FORMATS}')
+
+ENABLED = bool(PROFILE)
+
+# Finished steps, and the names of the steps running right now in each thread (outermost first):
+# thread id -> list of names. Every thread only pushes and pops its own list, so steps running in
+# worker threads (dashboard_service.py) keep their own depth; keyed by thread id rather than
+# threading.local so the sampling thread can read the main thread's steps
+_records = []
+_active = {}
+_samples = Counter()
+_start = time.perf_counter()
+
+# Returned by step() when instrumentation is off
+_NO_STEP = nullcontext({})
+
+
+# Current resident set size in bytes, None where /proc is not available
+def current_rss():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+# Peak resident set size of the process so far in bytes (ru_maxrss is in kB on Linux, bytes on macOS)
+def peak_rss():
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+# Number of rows of a DataFrame, Series or array, None for anything else
+def row_count(value):
+    shape = getattr(value, 'shape', None)
+    return shape[0] if shape else None
+
+
+@contextmanager
+def _recorded_step(name, rows_in):
+    record = {'name': name, 'rows_in': rows_in, 'rows_out': None}
+    thread = threading.get_ident()
+    active = _active.setdefault(thread, [])
+    active.append(name)
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    try:
+        yield record
+    finally:
+        record['start_seconds'] = start_wall - _start
+        record['wall_seconds'] = time.perf_counter() - start_wall
+        record['cpu_seconds'] = time.process_time() - start_cpu
+        record['rss_bytes'] = current_rss()
+        record['peak_rss_bytes'] = peak_rss()
+        record['depth'] = len(active) - 1
+        record['thread'] = thread
+        active.pop()
+        if not active:
+            del _active[thread]
+        _records.append(record)
+
+
+# Context manager recording one named step; yields a dict to set 'rows_out' (or other fields) on
+def step(name, rows_in=None):
+    if not ENABLED:
+        return _NO_STEP
+    return _recorded_step(name, rows_in)
+
+
+# Decorator recording every call of a function as a step
+# rows_in and rows_out are the row counts of the first argument and of the result
+def instrumented(name):
+    def decorate(func):
+        if not ENABLED:
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with step(name, rows_in=row_count(args[0]) if args else None) as record:
+                result = func(*args, **kwargs)
+                record['rows_out'] = row_count(result)
+            return result
+        return wrapper
+    return decorate
+
+
+# Sampling thread: count the main thread's stacks, prefixed with the running steps
+def _sample(interval, main_thread_id):
+    while True:
+        time.sleep(interval)
+        frame = sys._current_frames().get(main_thread_id)
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+            frame = frame.f_back
+        _samples[';'.join(list(_active.get(main_thread_id, [])) + stack[::-1])] += 1
+
+
+# Chrome trace events of the recorded steps (complete events, microseconds)
+def trace_events(records):
+    return [{
+        'name': record['name'],
+        'cat': 'step',
+        'ph': 'X',
+        'ts': record['start_seconds'] * 1e6,
+        'dur': record['wall_seconds'] * 1e6,
+        'pid': os.getpid(),
+        'tid': record['thread'],
+        'args': {key: value for key, value in record.items() if key not in ('name', 'start_seconds', 'wall_seconds', 'thread')}
+    } for record in records]
+
+
+# Write the recorded steps (and the sampled stacks) in the given format
+def write_profile(path=PROFILE_PATH, profile_format=PROFILE):
+    if profile_format == 'trace':
+        payload = {'traceEvents': trace_events(_records), 'displayTimeUnit': 'ms'}
+    else:
+        payload = {'argv': sys.argv, 'pid': os.getpid(), 'steps': _records}
+    with open(path, 'w') as f:
+        json.dump(payload, f, indent=1, default=str)
+    if _samples:
+        with open(f'{path}.folded', 'w') as f:
+            for stack, count in _samples.most_common():
+                f.write(f'{stack} {count}\n')
+
+
+# Worker processes (report rendering, trial batches) do not write over the main process's profile
+def _write_at_exit():
+    if multiprocessing.parent_process() is None:
+        write_profile()
+
+
+if ENABLED:
+    atexit.register(_write_at_exit)
+    if PROFILE_SAMPLING > 0 and multiprocessing.parent_process() is None:
+        threading.Thread(target=_sample, args=(PROFILE_SAMPLING, threading.main_thread().ident), daemon=True,
+                         name='qvi-profile-sampler').start()
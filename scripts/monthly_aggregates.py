@@ -0,0 +1,171 @@
+# Persisted store/month aggregate store for measureOverTime
+# Keeps additive sums (TOT_SALES, PROD_QTY), transaction counts and the distinct
+# (store, month, loyalty card) triples needed to count customers, so a new batch of
+# cleaned transactions can be appended without rescanning the history.
+#
+# Layout of the store directory:
+#   aggregates.parquet  one row per (STORE_NBR, YEARMONTH) with the additive measures
+#   customers/          distinct (STORE_NBR, YEARMONTH, LYLTY_CARD_NBR), partitioned by YEARMONTH
+#   batches.json        ids of the batches already appended
+#   staging/            an append in progress, see below
+#
+# An append writes its new customer files, the updated aggregates and batches.json to staging/
+# first and marks it complete with a COMMITTED file; only then are the files moved into place.
+# A staging directory without the marker (a crash while staging) is discarded, one with it (a crash
+# while moving) is moved into place the next time the store is read or appended to, so the three
+# parts always describe the same batches and a retried batch is neither lost nor counted twice.
+#
+# A transaction (TXN_ID) is assumed to arrive within a single batch, so transaction
+# counts of different batches can be added.
+#
+# Usage (from the data directory):
+#   python monthly_aggregates.py QVI_cleaned_data.csv
+#   python monthly_aggregates.py new_week_cleaned.csv --store QVI_monthly_aggregates
+import argparse
+import json
+import os
+import shutil
+
+import pandas as pd
+
+from qvi_io import read_cleaned_data
+from store_metrics import METRICS, compute_aggregates
+
+# Default location of the aggregate store, override with the QVI_AGGREGATE_STORE environment variable
+AGGREGATE_STORE_PATH = os.environ.get('QVI_AGGREGATE_STORE', 'QVI_monthly_aggregates')
+
+# Columns of the cleaned data the aggregate store needs
+AGGREGATE_COLUMNS = ['STORE_NBR', 'YEARMONTH', 'LYLTY_CARD_NBR', 'TXN_ID', 'PROD_QTY', 'TOT_SALES']
+
+# Additive measures kept per (STORE_NBR, YEARMONTH)
+ADDITIVE_COLUMNS = ['TOT_SALES', 'PROD_QTY', 'n_transactions', 'n_customers']
+
+KEYS = ['STORE_NBR', 'YEARMONTH']
+
+
+# Empty aggregate table with the right index and columns
+def empty_aggregates():
+    index = pd.MultiIndex.from_arrays([pd.Series(dtype='int64'), pd.Series(dtype='int64')], names=KEYS)
+    return pd.DataFrame({'TOT_SALES': pd.Series(dtype='float64'), 'PROD_QTY': pd.Series(dtype='int64'),
+                         'n_transactions': pd.Series(dtype='int64'), 'n_customers': pd.Series(dtype='int64')},
+                        index=index)
+
+
+# Aggregate one batch of cleaned transactions
+# Returns the additive measures per store/month (without customers) and the distinct customer triples
+def aggregate_batch(transactions):
+    aggregates = compute_aggregates(transactions, {
+        'TOT_SALES': ('TOT_SALES', 'sum'),
+        'PROD_QTY': ('PROD_QTY', 'sum'),
+        'n_transactions': ('TXN_ID', 'nunique')
+    })
+    customers = transactions[KEYS + ['LYLTY_CARD_NBR']].drop_duplicates()
+    return aggregates, customers
+
+
+# Finish or discard an interrupted append: a committed staging directory is moved into place, any
+# other staging directory is removed. Moving is repeatable, files already moved are skipped
+def recover_store(store_path=AGGREGATE_STORE_PATH):
+    staging = os.path.join(store_path, 'staging')
+    if not os.path.exists(staging):
+        return
+    if os.path.exists(os.path.join(staging, 'COMMITTED')):
+        staged_customers = os.path.join(staging, 'customers')
+        for root, _, names in os.walk(staged_customers):
+            target = os.path.join(store_path, 'customers', os.path.relpath(root, staged_customers))
+            os.makedirs(target, exist_ok=True)
+            for name in names:
+                os.replace(os.path.join(root, name), os.path.join(target, name))
+        for name in ['aggregates.parquet', 'batches.json']:
+            if os.path.exists(os.path.join(staging, name)):
+                os.replace(os.path.join(staging, name), os.path.join(store_path, name))
+    shutil.rmtree(staging)
+
+
+# Load the additive aggregates of a store, empty if the store does not exist yet
+def load_aggregates(store_path=AGGREGATE_STORE_PATH):
+    recover_store(store_path)
+    path = os.path.join(store_path, 'aggregates.parquet')
+    if not os.path.exists(path):
+        return empty_aggregates()
+    return pd.read_parquet(path).set_index(KEYS)
+
+
+# Distinct customer triples for the given months only, other month partitions are not read
+def load_customers(store_path=AGGREGATE_STORE_PATH, months=None):
+    path = os.path.join(store_path, 'customers')
+    if not os.path.exists(path):
+        return pd.DataFrame({col: pd.Series(dtype='int64') for col in KEYS + ['LYLTY_CARD_NBR']})
+    filters = None if months is None else [('YEARMONTH', 'in', [int(month) for month in months])]
+    customers = pd.read_parquet(path, filters=filters)
+    customers['YEARMONTH'] = customers['YEARMONTH'].astype('int64')
+    return customers[KEYS + ['LYLTY_CARD_NBR']]
+
+
+# Ids of the batches already appended to the store
+def load_batches(store_path=AGGREGATE_STORE_PATH):
+    recover_store(store_path)
+    path = os.path.join(store_path, 'batches.json')
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return json.load(f)
+
+
+# Append a batch of cleaned transactions to the store
+# Only the month partitions touched by the batch are read to find customers not seen before.
+# A batch_id that was already appended is skipped, so re-running a weekly load is harmless.
+def append_transactions(transactions, store_path=AGGREGATE_STORE_PATH, batch_id=None):
+    batches = load_batches(store_path)
+    if batch_id is not None and batch_id in batches:
+        return load_aggregates(store_path)
+
+    aggregates = load_aggregates(store_path)
+    staging = os.path.join(store_path, 'staging')
+    os.makedirs(staging)
+    batch_aggregates, batch_customers = aggregate_batch(transactions)
+
+    # Customers not already counted for their store/month
+    known = load_customers(store_path, batch_customers['YEARMONTH'].unique())
+    new_customers = batch_customers.merge(known, how='left', indicator=True)
+    new_customers = new_customers.loc[new_customers['_merge'] == 'left_only', KEYS + ['LYLTY_CARD_NBR']]
+    if len(new_customers):
+        new_customers.to_parquet(os.path.join(staging, 'customers'), partition_cols=['YEARMONTH'], index=False)
+    batch_aggregates['n_customers'] = new_customers.groupby(KEYS).size()
+    batch_aggregates = batch_aggregates.fillna({'n_customers': 0})
+
+    aggregates = aggregates.add(batch_aggregates[ADDITIVE_COLUMNS], fill_value=0).sort_index()
+    aggregates = aggregates.astype({'PROD_QTY': 'int64', 'n_transactions': 'int64', 'n_customers': 'int64'})
+    aggregates.reset_index().to_parquet(os.path.join(staging, 'aggregates.parquet'), index=False)
+
+    if batch_id is not None:
+        with open(os.path.join(staging, 'batches.json'), 'w') as f:
+            json.dump(batches + [batch_id], f)
+    open(os.path.join(staging, 'COMMITTED'), 'w').close()
+    recover_store(store_path)
+    return aggregates
+
+
+# Build measureOverTime (same columns as Trial_store_analysis.py) from the additive aggregates
+def measure_over_time(aggregates, metrics=METRICS):
+    measureOverTime = pd.DataFrame({name: func(aggregates) for name, func in metrics.items()}, index=aggregates.index)
+    return measureOverTime.reset_index()
+
+
+# Stores that do not have a full observation period (a month without transactions)
+def incomplete_stores(aggregates):
+    observed = aggregates['n_transactions'].unstack('YEARMONTH')
+    return observed[observed.isnull().any(axis=1)].index.tolist()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Append cleaned transactions to the monthly aggregate store.')
+    parser.add_argument('cleaned_data', help='cleaned transactions, CSV or Parquet dataset (see qvi_io.py)')
+    parser.add_argument('--store', default=AGGREGATE_STORE_PATH)
+    args = parser.parse_args()
+
+    transactions = read_cleaned_data(args.cleaned_data, columns=AGGREGATE_COLUMNS)
+    batch_id = f'{os.path.abspath(args.cleaned_data)}@{os.path.getmtime(args.cleaned_data)}'
+    aggregates = append_transactions(transactions, args.store, batch_id)
+    print(f"Aggregate store {args.store}: {len(aggregates)} store/months, "
+          f"months {aggregates.index.get_level_values('YEARMONTH').min()} to {aggregates.index.get_level_values('YEARMONTH').max()}")
@@ -0,0 +1,184 @@
+# The three analysis scripts as a DAG of cached stages
+#   cleaned_data -> measure_over_time -> control_stores, trial_assessment, counterfactual   (Trial_store_analysis.py)
+#   cleaned_data -> segment_cube -> segment_summary                         (QVI_analysis.py)
+# Each stage result is cached on disk (stage_cache.py) under a key built from the content of the
+# input files, the keys of the upstream stages and the stage's own parameters. Changing only the
+# trial period or corr_weight therefore reuses the cached cleaned data and measureOverTime, and
+# changing the target segment reuses the cached segment cube. The exclusion rules (QVI_EXCLUSION_RULES)
+# and the execution backend (QVI_BACKEND) are parameters of the cleaned data, so changing either
+# cleans again and invalidates every stage below it.
+#
+# Usage (from the data directory):
+#   python pipeline.py --trial-period 201902 201904 --corr-weight 0.5
+#   python pipeline.py --stages segment_summary --target-segment Budget
+import argparse
+import json
+import os
+import tempfile
+
+import pandas as pd
+
+from control_matching import find_similar_control_stores
+from exclusion_rules import EXCLUSION_RULES
+from execution_backend import BACKEND, BACKENDS, get_backend, stores_missing_months
+from qvi_io import read_cleaned_data
+from segment_cube import build_segment_cube, rollup, welch_test
+from stage_cache import STAGE_CACHE_DIR, STAGE_CACHE_MAX_BYTES, cached_stage, file_hash, stage_key
+from store_metrics import compute_measure_over_time
+from synthetic_control import SOLVERS, synthetic_control
+from trial_batch import complete_stores_only, evaluate_trials
+from workbook_io import CUSTOMER_DATA_PATH
+
+# Pipeline inputs that are files, hashed by content
+FILE_INPUTS = ['transactions', 'customers']
+
+# Default parameters of the stages
+DEFAULT_PARAMS = {
+    'trial_stores': [77, 86, 88],
+    'trial_period': [201902, 201904],
+    'corr_weight': 0.5,
+    'method': 'ttest',
+    'seed': 2019,
+    'solver': 'nnls',
+    'target_segment': 'Mainstream',
+    'target_lifestages': ['MIDAGE SINGLES/COUPLES', 'YOUNG SINGLES/COUPLES'],
+    'exclusion_rules': json.dumps(EXCLUSION_RULES, sort_keys=True),
+    'backend': BACKEND
+}
+
+
+# Clean the transactions with an execution backend
+# exclusion_rules: the rules the backends apply (EXCLUSION_RULES as JSON), part of the cache key
+def clean_stage(transactions, customers, exclusion_rules, backend):
+    if exclusion_rules != json.dumps(EXCLUSION_RULES, sort_keys=True):
+        raise ValueError('The cleaned data can only apply the exclusion rules loaded at import, set QVI_EXCLUSION_RULES instead')
+    with tempfile.TemporaryDirectory() as tmp:
+        cleaned_path = os.path.join(tmp, 'QVI_cleaned_data.parquet')
+        get_backend(backend)['clean'](transactions, customers, cleaned_path)
+        return read_cleaned_data(cleaned_path)
+
+
+# Store/month measures of every store and month
+def measure_over_time_stage(cleaned):
+    return compute_measure_over_time(cleaned).reset_index()
+
+
+# Top 5 control stores of each trial store, scored on the months before the trial period
+def control_stores_stage(measureOverTime, trial_stores, trial_period, corr_weight):
+    measureOverTime = measureOverTime[~measureOverTime['STORE_NBR'].isin(stores_missing_months(measureOverTime))]
+    preTrialMeasures = measureOverTime[measureOverTime['YEARMONTH'] < trial_period[0]]
+    return find_similar_control_stores(preTrialMeasures, trial_stores, corr_weight=corr_weight)
+
+
+# Trial assessment of each trial store against its best control store (see trial_batch.py)
+def trial_assessment_stage(measureOverTime, trial_stores, trial_period, corr_weight, method, seed):
+    specs = [(trial_store, tuple(trial_period)) for trial_store in trial_stores]
+    return evaluate_trials(complete_stores_only(measureOverTime), specs, processes=1, corr_weight=corr_weight,
+                           method=method, seed=seed)
+
+
+# Counterfactual of each trial store from a weighted combination of donor stores (see synthetic_control.py)
+def counterfactual_stage(measureOverTime, trial_stores, trial_period, corr_weight, solver):
+    specs = [(trial_store, tuple(trial_period)) for trial_store in trial_stores]
+    return synthetic_control(complete_stores_only(measureOverTime), specs, solver=solver, corr_weight=corr_weight)
+
+
+# Segment cube of the cleaned transactions
+def segment_cube_stage(cleaned):
+    return build_segment_cube(cleaned)
+
+
+# Price per unit of the target segment against the other PREMIUM_CUSTOMER groups (Welch t-tests),
+# and the brand and pack size counts of the target segment
+def segment_summary_stage(cube, target_segment, target_lifestages):
+    target = {'PREMIUM_CUSTOMER': target_segment, 'LIFESTAGE': target_lifestages}
+    tests = []
+    for segment in cube['PREMIUM_CUSTOMER'].cat.categories:
+        if segment != target_segment:
+            t_stat, p_value = welch_test(cube, target, {'PREMIUM_CUSTOMER': segment, 'LIFESTAGE': target_lifestages})
+            tests.append({'segment': segment, 't_statistic': t_stat, 'p_value': p_value})
+    return {
+        'welch_tests': pd.DataFrame(tests),
+        'brands': rollup(cube, ['BRAND'], target)['n_rows'].sort_values(ascending=False),
+        'pack_sizes': rollup(cube, ['PACK_SIZE'], target)['n_rows'].sort_values(ascending=False)
+    }
+
+
+# Stages: name -> (function, inputs (stages or files), parameter names)
+STAGES = {
+    'cleaned_data': (clean_stage, ['transactions', 'customers'], ['exclusion_rules', 'backend']),
+    'measure_over_time': (measure_over_time_stage, ['cleaned_data'], []),
+    'control_stores': (control_stores_stage, ['measure_over_time'], ['trial_stores', 'trial_period', 'corr_weight']),
+    'trial_assessment': (trial_assessment_stage, ['measure_over_time'],
+                         ['trial_stores', 'trial_period', 'corr_weight', 'method', 'seed']),
+    'counterfactual': (counterfactual_stage, ['measure_over_time'], ['trial_stores', 'trial_period', 'corr_weight', 'solver']),
+    'segment_cube': (segment_cube_stage, ['cleaned_data'], []),
+    'segment_summary': (segment_summary_stage, ['segment_cube'], ['target_segment', 'target_lifestages'])
+}
+
+
+# Run the target stages and whatever they need, reusing cached results
+# files: {'transactions': path, 'customers': path}; params: overrides of DEFAULT_PARAMS
+# Returns the results of the targets and a log of (stage, cache hit) in execution order
+def run_pipeline(targets, files, params=None, cache_dir=STAGE_CACHE_DIR, max_bytes=STAGE_CACHE_MAX_BYTES):
+    params = {**DEFAULT_PARAMS, **(params or {})}
+    keys, values, log = {}, {}, []
+
+    def stage_params(name):
+        return {p: params[p] for p in STAGES[name][2]}
+
+    # Keys only depend on file contents, upstream keys and parameters, so they are known before running
+    def key(name):
+        if name in FILE_INPUTS:
+            return file_hash(files[name], cache_dir)
+        if name not in keys:
+            func, inputs, _ = STAGES[name]
+            keys[name] = stage_key(name, func, [key(dep) for dep in inputs], stage_params(name))
+        return keys[name]
+
+    # Upstream stages only run (or load) when this stage is not cached
+    def run(name):
+        if name in FILE_INPUTS:
+            return files[name]
+        if name not in values:
+            func, inputs, _ = STAGES[name]
+            values[name], _, hit = cached_stage(name, func, [(key(dep), lambda dep=dep: run(dep)) for dep in inputs],
+                                                stage_params(name), cache_dir, max_bytes)
+            log.append((name, hit))
+        return values[name]
+
+    results = {target: run(target) for target in targets}
+    return results, log
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the analysis stages with on-disk result caching.')
+    parser.add_argument('--transactions', default='QVI_transaction_data.csv')
+    parser.add_argument('--customers', default=CUSTOMER_DATA_PATH, help='CSV or xlsx')
+    parser.add_argument('--stages', nargs='+', default=['control_stores', 'trial_assessment', 'segment_summary'],
+                        choices=list(STAGES))
+    parser.add_argument('--trial-stores', type=int, nargs='+', default=DEFAULT_PARAMS['trial_stores'])
+    parser.add_argument('--trial-period', type=int, nargs=2, default=DEFAULT_PARAMS['trial_period'])
+    parser.add_argument('--corr-weight', type=float, default=DEFAULT_PARAMS['corr_weight'])
+    parser.add_argument('--method', default=DEFAULT_PARAMS['method'])
+    parser.add_argument('--seed', type=int, default=DEFAULT_PARAMS['seed'])
+    parser.add_argument('--solver', default=DEFAULT_PARAMS['solver'], choices=list(SOLVERS))
+    parser.add_argument('--target-segment', default=DEFAULT_PARAMS['target_segment'])
+    parser.add_argument('--target-lifestages', nargs='+', default=DEFAULT_PARAMS['target_lifestages'])
+    parser.add_argument('--backend', default=DEFAULT_PARAMS['backend'], choices=list(BACKENDS))
+    parser.add_argument('--cache-dir', default=STAGE_CACHE_DIR)
+    args = parser.parse_args()
+
+    # The exclusion rules come from QVI_EXCLUSION_RULES only
+    params = {name: getattr(args, name) for name in DEFAULT_PARAMS if name != 'exclusion_rules'}
+    results, log = run_pipeline(args.stages, {'transactions': args.transactions, 'customers': args.customers},
+                                params, args.cache_dir)
+    for name, hit in log:
+        print(f"{name}: {'cached' if hit else 'computed'}")
+    for name, result in results.items():
+        print(f'\n{name}:')
+        if isinstance(result, dict):
+            for part, value in result.items():
+                print(f'{part}:\n{value}')
+        else:
+            print(result)
@@ -0,0 +1,118 @@
+# Product dimension table for the chips transaction data
+# There are only ~100 distinct products, so PROD_NAME is parsed once per product (pack size,
+# brand, salsa flag and name words) and the attributes are attached to transactions by PROD_NBR.
+# The table is cached on disk and rebuilt when the product list or the parsing rules change.
+import hashlib
+import json
+import os
+import warnings
+from collections import Counter
+
+import pandas as pd
+
+from instrumentation import instrumented
+
+# On-disk cache of the product dimension, with the hash it was built from next to it
+PRODUCT_DIMENSION_PATH = 'QVI_product_dimension.csv'
+
+# Clean brand names change Red to RRD (left to right)
+brand_replacements = {
+    'Red': 'RRD',
+    'Smith': 'Smiths',
+    'Dorito': 'Doritos',
+    'Woolworths': 'WW',
+    'Infzns': 'Infuzions'
+}
+
+
+# Flag salsa products, True if PROD_NAME contains the word 'salsa' (nulls are not salsa)
+def is_salsa(prod_name):
+    return prod_name.str.contains('salsa', case=False, na=False)
+
+
+# Pack size is the first number in the product name
+def extract_pack_size(prod_name):
+    return prod_name.str.extract(r'(\d+)', expand=False).astype(int)
+
+
+# Brand is the first word of the product name, with known spellings made consistent
+def extract_brand(prod_name):
+    return prod_name.str.split().str[0].replace(brand_replacements)
+
+
+# Words of a product name, skipping words with digits or special characters
+def name_words(name):
+    return [word for word in name.split() if word.isascii() and word.isalpha()]
+
+
+# Distinct (PROD_NBR, PROD_NAME) pairs, one per product number
+# A product number seen with more than one name keeps its first name, with a warning
+def distinct_products(transactions):
+    products = transactions[['PROD_NBR', 'PROD_NAME']].drop_duplicates()
+    duplicated = products['PROD_NBR'].duplicated(keep=False)
+    if duplicated.any():
+        warnings.warn(f"PROD_NBR with more than one PROD_NAME, keeping the first name: "
+                      f"{sorted(products.loc[duplicated, 'PROD_NBR'].unique().tolist())}")
+        products = products.drop_duplicates('PROD_NBR')
+    return products.sort_values('PROD_NBR').reset_index(drop=True)
+
+
+# Hash of the product list and the parsing rules, used to invalidate the on-disk cache
+def products_hash(products):
+    digest = hashlib.sha256()
+    for prod_nbr, prod_name in products[['PROD_NBR', 'PROD_NAME']].itertuples(index=False):
+        digest.update(f'{prod_nbr}\t{prod_name}\n'.encode())
+    digest.update(json.dumps(brand_replacements, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+# Parse every distinct product exactly once, indexed by PROD_NBR
+def build_product_dimension(products):
+    product_dim = products[['PROD_NBR', 'PROD_NAME']].copy()
+    product_dim['SALSA'] = is_salsa(product_dim['PROD_NAME'])
+    product_dim['PACK_SIZE'] = extract_pack_size(product_dim['PROD_NAME'])
+    product_dim['BRAND'] = extract_brand(product_dim['PROD_NAME'])
+    product_dim['WORDS'] = [' '.join(name_words(name)) for name in product_dim['PROD_NAME']]
+    return product_dim.set_index('PROD_NBR')
+
+
+# Load the product dimension from the cache, rebuilding it if the products have changed
+@instrumented('load_product_dimension')
+def load_product_dimension(products, cache_path=PRODUCT_DIMENSION_PATH):
+    products = distinct_products(products)
+    current_hash = products_hash(products)
+    hash_path = f'{cache_path}.sha256'
+
+    if cache_path and os.path.exists(cache_path) and os.path.exists(hash_path):
+        with open(hash_path) as f:
+            if f.read().strip() == current_hash:
+                product_dim = pd.read_csv(cache_path, index_col='PROD_NBR', keep_default_na=False)
+                return product_dim.astype({'SALSA': bool, 'PACK_SIZE': int})
+
+    product_dim = build_product_dimension(products)
+    if cache_path:
+        product_dim.to_csv(cache_path)
+        with open(hash_path, 'w') as f:
+            f.write(current_hash)
+    return product_dim
+
+
+# Attach product attributes to transactions with an integer join on PROD_NBR
+def attach_product_attributes(transactions, product_dim, columns=('PACK_SIZE', 'BRAND')):
+    positions = product_dim.index.get_indexer(transactions['PROD_NBR'])
+    if (positions < 0).any():
+        raise ValueError('Transactions reference products missing from the product dimension')
+    for col in columns:
+        transactions[col] = product_dim[col].to_numpy()[positions]
+    return transactions
+
+
+# Frequency of each product name word, most common first
+# product_counts holds the number of transactions per PROD_NBR (e.g. PROD_NBR.value_counts())
+@instrumented('product_word_counts')
+def product_word_counts(product_dim, product_counts):
+    word_counts = Counter()
+    for prod, count in product_counts.items():
+        for word in product_dim.at[prod, 'WORDS'].split():
+            word_counts[word] += int(count)
+    return pd.Series(word_counts, dtype='int64').sort_values(ascending=False)
@@ -0,0 +1,172 @@
+# Reading and writing the QVI_cleaned_data hand-off between the three stages
+# The cleaned data can be kept as CSV or as a Parquet dataset partitioned by month.
+# Either way it is read back with typed columns, and only the columns a stage needs are parsed.
+import argparse
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from instrumentation import instrumented
+
+# Location of the cleaned data, override with the QVI_CLEANED_DATA environment variable
+# A path ending in .csv is read/written as CSV, anything else as a Parquet dataset directory
+CLEANED_DATA_PATH = os.environ.get('QVI_CLEANED_DATA', 'QVI_cleaned_data.csv')
+
+# Columns of the Parquet dataset used as directory partitions
+PARTITION_COLS = ['YEARMONTH']
+
+# Compact in-memory schema of the cleaned data, applied whenever it is loaded
+# Low-cardinality strings are categoricals (compared and grouped on their integer codes),
+# integers are downcast to the smallest type that holds the QVI ranges (checked at load)
+# and DATE is datetime64. TOT_SALES stays float64: it is summed over millions of rows, where
+# float32 would already change the store/month totals.
+CLEANED_DTYPES = {
+    'DATE': 'datetime64[ns]',
+    'STORE_NBR': 'int16',
+    'LYLTY_CARD_NBR': 'int32',
+    'TXN_ID': 'int32',
+    'PROD_NBR': 'int16',
+    'PROD_NAME': 'category',
+    'PROD_QTY': 'int16',
+    'TOT_SALES': 'float64',
+    'PACK_SIZE': 'int16',
+    'BRAND': 'category',
+    'LIFESTAGE': 'category',
+    'PREMIUM_CUSTOMER': 'category',
+    'YEARMONTH': 'int32'
+}
+
+
+# Check if a path should be handled as CSV
+def is_csv(path):
+    return str(path).lower().endswith('.csv')
+
+
+# Month ID in format yyyymm from a datetime column
+def add_yearmonth(df):
+    df['YEARMONTH'] = df['DATE'].dt.year * 100 + df['DATE'].dt.month
+    return df
+
+
+# Cast the columns of a frame to the compact schema
+# Integers are range checked first, a value that does not fit the declared type raises
+# instead of silently wrapping around
+def apply_schema(df, schema=CLEANED_DTYPES):
+    dtypes = {col: dtype for col, dtype in schema.items() if col in df.columns and df[col].dtype != dtype}
+    for col, dtype in dtypes.items():
+        if dtype.startswith('int'):
+            info = np.iinfo(dtype)
+            if len(df) and (df[col].min() < info.min or df[col].max() > info.max):
+                raise ValueError(f'{col} has values outside the {dtype} range of the cleaned data schema')
+    return df.astype(dtypes)
+
+
+# Boolean mask of the rows whose categorical value is one of values, compared on the integer codes
+def category_mask(series, values):
+    if isinstance(values, str):
+        values = [values]
+    codes = series.cat.categories.get_indexer(values)
+    return np.isin(series.cat.codes.to_numpy(), codes[codes >= 0])
+
+
+# Memory used per column before and after the compact schema, in MB, with a total row
+def memory_report(before, after):
+    report = pd.DataFrame({
+        'dtype_before': before.dtypes.astype(str),
+        'before_MB': before.memory_usage(deep=True, index=False) / 1e6,
+        'dtype_after': after.dtypes.astype(str),
+        'after_MB': after.memory_usage(deep=True, index=False) / 1e6
+    })
+    report.loc['Total'] = ['', report['before_MB'].sum(), '', report['after_MB'].sum()]
+    return report.round(2)
+
+
+# Remove an existing output so a new run does not append to stale files
+def remove_output(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+# Write (or append) cleaned rows to CSV or to the partitioned Parquet dataset
+def write_cleaned_data(df, path=CLEANED_DATA_PATH, append=False, partition_cols=PARTITION_COLS):
+    if not append:
+        remove_output(path)
+    if is_csv(path):
+        df.to_csv(path, mode='a' if append else 'w', header=not append, index=False)
+        return
+    df = df.copy()
+    if 'YEARMONTH' in partition_cols and 'YEARMONTH' not in df.columns:
+        add_yearmonth(df)
+    # Categoricals are stored as plain values (nulls kept) so chunks with different categories can share a dataset,
+    # Parquet dictionary-encodes them on disk anyway
+    for col in df.columns:
+        if isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype(df[col].cat.categories.dtype)
+    df.to_parquet(path, partition_cols=list(partition_cols), index=False)
+
+
+# Apply (column, op, value) filters to a frame read from CSV, matching the Parquet filter syntax
+def apply_filters(df, filters):
+    ops = {
+        '==': lambda s, v: s == v,
+        '=': lambda s, v: s == v,
+        '!=': lambda s, v: s != v,
+        '<': lambda s, v: s < v,
+        '<=': lambda s, v: s <= v,
+        '>': lambda s, v: s > v,
+        '>=': lambda s, v: s >= v,
+        'in': lambda s, v: s.isin(v),
+        'not in': lambda s, v: ~s.isin(v)
+    }
+    mask = pd.Series(True, index=df.index)
+    for col, op, value in filters:
+        mask &= ops[op](df[col], value)
+    return df[mask]
+
+
+# Read the cleaned data with the compact schema (CLEANED_DTYPES)
+# columns: only these columns are parsed (YEARMONTH is derived from DATE for CSV input)
+# filters: list of (column, op, value); for Parquet these prune month partitions before reading
+@instrumented('read_cleaned_data')
+def read_cleaned_data(path=CLEANED_DATA_PATH, columns=None, filters=None):
+    if is_csv(path):
+        needed = None
+        if columns is not None:
+            needed = set(columns) | {col for col, _, _ in filters or []}
+            if 'YEARMONTH' in needed:
+                needed = (needed - {'YEARMONTH'}) | {'DATE'}
+        parse_dates = ['DATE'] if needed is None or 'DATE' in needed else False
+        # Integers are parsed as int64 and downcast by apply_schema, which checks the ranges
+        parse_dtypes = {col: 'int64' if dtype.startswith('int') else dtype
+                        for col, dtype in CLEANED_DTYPES.items() if col != 'DATE'}
+        df = pd.read_csv(path, usecols=None if needed is None else lambda col: col in needed,
+                         dtype=parse_dtypes, parse_dates=parse_dates)
+        if 'DATE' in df.columns:
+            add_yearmonth(df)
+        if filters:
+            df = apply_filters(df, filters)
+        if columns is not None:
+            df = df[list(columns)]
+        return apply_schema(df.reset_index(drop=True))
+
+    df = pd.read_parquet(path, columns=None if columns is None else list(columns), filters=filters)
+    if 'YEARMONTH' in df.columns:
+        df['YEARMONTH'] = df['YEARMONTH'].astype('int64')
+    return apply_schema(df)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Memory of the cleaned data with and without the compact schema.')
+    parser.add_argument('path', nargs='?', default=CLEANED_DATA_PATH)
+    args = parser.parse_args()
+
+    if is_csv(args.path):
+        before = pd.read_csv(args.path)
+    else:
+        before = pd.read_parquet(args.path)
+    after = read_cleaned_data(args.path, columns=list(before.columns))
+    print(memory_report(before, after))
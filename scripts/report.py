@@ -0,0 +1,117 @@
+# Headless report mode for the analysis scripts
+# The scripts call show_figures(name) where they used to call plt.show(). Without QVI_REPORT_DIR
+# this is plt.show(), so interactive runs are unchanged. With QVI_REPORT_DIR set, matplotlib is
+# switched to the non-interactive Agg backend, every open figure is pickled and closed instead of
+# shown, and write_report() renders the collected figures in parallel worker processes to PNG/SVG
+# files with an index.html, so an unattended (nightly) run produces the full report without a display.
+#
+# Usage:
+#   QVI_REPORT_DIR=report python ../scripts/chip_analysis.py   # writes report/chip_analysis/...
+from concurrent.futures import ProcessPoolExecutor
+import html
+import os
+import pickle
+
+import matplotlib
+
+# Report directory, reports are only written when the QVI_REPORT_DIR environment variable is set
+REPORT_DIR = os.environ.get('QVI_REPORT_DIR')
+
+# File formats written for every figure, override with e.g. QVI_REPORT_FORMATS=png
+REPORT_FORMATS = os.environ.get('QVI_REPORT_FORMATS', 'png,svg').split(',')
+
+# Resolution of the raster formats
+REPORT_DPI = 100
+
+if REPORT_DIR:
+    matplotlib.use('Agg', force=True)
+
+import matplotlib.pyplot as plt  # noqa: E402
+
+from instrumentation import instrumented  # noqa: E402
+
+# Figures collected so far: (file name, title, pickled figure)
+_figures = []
+
+
+# Title of a figure, its suptitle or else the first axes title
+# Figure.get_suptitle needs matplotlib 3.8, older versions go straight to the axes titles
+def figure_title(fig):
+    suptitle = fig.get_suptitle() if hasattr(fig, 'get_suptitle') else ''
+    if suptitle:
+        return suptitle
+    for ax in fig.axes:
+        if ax.get_title():
+            return ax.get_title()
+    return ''
+
+
+# Show the open figures, or collect them for the report in headless mode
+# name is used for the file names, unless a figure was given its own label (plt.figure(num='label'));
+# several open figures get a numbered suffix
+def show_figures(name):
+    if not REPORT_DIR:
+        plt.show()
+        return
+    figures = [plt.figure(number) for number in plt.get_fignums()]
+    unlabelled = [fig for fig in figures if not fig.get_label()]
+    for fig in figures:
+        label = fig.get_label() or name
+        if len(unlabelled) > 1 and fig in unlabelled:
+            label = f'{name}_{unlabelled.index(fig) + 1}'
+        _figures.append((f'{len(_figures) + 1:02d}_{label}', figure_title(fig), pickle.dumps(fig)))
+    plt.close('all')
+
+
+# Worker: unpickle one figure and save it in every format, returns the file names written
+def _render(file_name, payload, directory, formats, dpi):
+    matplotlib.use('Agg', force=True)
+    fig = pickle.loads(payload)
+    files = []
+    for fmt in formats:
+        files.append(f'{file_name}.{fmt}')
+        fig.savefig(os.path.join(directory, files[-1]), format=fmt, dpi=dpi)
+    plt.close(fig)
+    return files
+
+
+# Index page listing every figure in the order it was shown
+def _write_index(directory, report_name, rendered):
+    lines = [f'<html><head><meta charset="utf-8"><title>{html.escape(report_name)}</title></head><body>',
+             f'<h1>{html.escape(report_name)}</h1>']
+    for (file_name, title, _), files in rendered:
+        image = files[0]
+        links = ' '.join(f'<a href="{html.escape(f)}">{html.escape(f.rsplit(".", 1)[1])}</a>' for f in files)
+        lines.append(f'<h2>{html.escape(title or file_name)}</h2>')
+        lines.append(f'<p><img src="{html.escape(image)}" style="max-width: 100%"><br>{links}</p>')
+    lines.append('</body></html>')
+    path = os.path.join(directory, 'index.html')
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(lines))
+    return path
+
+
+# Render the collected figures to REPORT_DIR/<report_name>, in parallel worker processes
+# processes: worker processes (default: all CPUs), 1 renders in this process
+# Returns the path of the index file, None when not running in headless report mode
+@instrumented('write_report')
+def write_report(report_name, processes=None, formats=None):
+    if not REPORT_DIR:
+        return None
+    formats = formats or REPORT_FORMATS
+    directory = os.path.join(REPORT_DIR, report_name)
+    os.makedirs(directory, exist_ok=True)
+
+    figures = list(_figures)
+    _figures.clear()
+    args = [(file_name, payload, directory, formats, REPORT_DPI) for file_name, _, payload in figures]
+    processes = min(processes or os.cpu_count(), max(1, len(figures)))
+    if processes == 1:
+        files = [_render(*arg) for arg in args]
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            files = list(pool.map(_render, *zip(*args)))
+
+    index = _write_index(directory, report_name, list(zip(figures, files)))
+    print(f'Report with {len(figures)} figures written to {index}')
+    return index
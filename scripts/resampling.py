@@ -0,0 +1,140 @@
+# Permutation and bootstrap tests for the difference in means of two samples
+# All resamples are drawn as batched NumPy index arrays, a chunk of resamples at a time, so
+# there is no Python loop per resample and memory stays bounded by max_elements.
+# a and b may also be 2-D with one independent test per row (e.g. one row per trial store);
+# every row is then tested against the same resampled indices in one pass.
+import numpy as np
+from scipy.stats import ttest_ind
+
+from instrumentation import instrumented
+
+# Resamples drawn per test
+DEFAULT_RESAMPLES = 10_000
+
+# Upper bound on the number of resampled values held in memory at once
+DEFAULT_MAX_ELEMENTS = 2 ** 24
+
+# Tests understood by two_sample_test and their display names
+METHODS = {
+    'ttest': 'T-test',
+    'welch': 'Welch t-test',
+    'permutation': 'Permutation test',
+    'bootstrap': 'Bootstrap test'
+}
+
+
+# View both samples as (tests, observations) arrays with the same number of tests
+def _as_2d(a, b):
+    a, b = np.asarray(a, dtype=np.float64), np.asarray(b, dtype=np.float64)
+    squeeze = a.ndim == 1 and b.ndim == 1
+    a, b = np.atleast_2d(a), np.atleast_2d(b)
+    if a.shape[0] != b.shape[0]:
+        raise ValueError('a and b must hold the same number of tests (rows)')
+    return a, b, squeeze
+
+
+# Sizes of the resample chunks, each chunk holding at most max_elements resampled values
+def _chunks(n_resamples, values_per_resample, max_elements):
+    chunk_size = max(1, max_elements // max(1, values_per_resample))
+    for start in range(0, n_resamples, chunk_size):
+        yield min(chunk_size, n_resamples - start)
+
+
+# Count resampled statistics at least as extreme as the observed one
+# A small tolerance keeps ties from being lost to rounding, as in scipy.stats.permutation_test
+def _extreme_counts(null, observed, alternative):
+    gamma = np.abs(1e-14 * observed)[:, np.newaxis]
+    observed = observed[:, np.newaxis]
+    if alternative == 'greater':
+        return (null >= observed - gamma).sum(axis=1)
+    if alternative == 'less':
+        return (null <= observed + gamma).sum(axis=1)
+    return (np.abs(null) >= np.abs(observed) - gamma).sum(axis=1)
+
+
+# Permutation test of mean(a) - mean(b)
+# Group labels are shuffled a batch of resamples at a time: the positions of the n random keys
+# that fall in the smallest n_small are a uniformly random subset of the pooled sample. Only the
+# smaller group is gathered, the other group's sum follows from the pooled total
+# Returns the observed difference and the p-value (arrays for 2-D input)
+@instrumented('permutation_test')
+def permutation_test(a, b, n_resamples=DEFAULT_RESAMPLES, alternative='two-sided', seed=None,
+                     max_elements=DEFAULT_MAX_ELEMENTS):
+    a, b, squeeze = _as_2d(a, b)
+    pooled = np.concatenate([a, b], axis=1)
+    n_a, n = a.shape[1], pooled.shape[1]
+    n_small = min(n_a, n - n_a)
+    totals = pooled.sum(axis=1, keepdims=True)
+    observed = a.mean(axis=1) - b.mean(axis=1)
+
+    rng = np.random.default_rng(seed)
+    counts = np.zeros(len(pooled), dtype=np.int64)
+    for k in _chunks(n_resamples, len(pooled) * n, max_elements):
+        idx = rng.random((k, n)).argpartition(n_small - 1, axis=1)[:, :n_small]
+        sums_small = pooled[:, idx].sum(axis=2)
+        sums_a = sums_small if n_small == n_a else totals - sums_small
+        null = sums_a / n_a - (totals - sums_a) / (n - n_a)
+        counts += _extreme_counts(null, observed, alternative)
+
+    p_value = (counts + 1) / (n_resamples + 1)
+    return (observed[0], p_value[0]) if squeeze else (observed, p_value)
+
+
+# Bootstrap means of both samples, a chunk of resamples at a time -> (tests, k) arrays
+def _bootstrap_means(rng, a, b, k):
+    idx_a = rng.integers(0, a.shape[1], size=(k, a.shape[1]), dtype=np.int32)
+    idx_b = rng.integers(0, b.shape[1], size=(k, b.shape[1]), dtype=np.int32)
+    return a[:, idx_a].mean(axis=2), b[:, idx_b].mean(axis=2)
+
+
+# Percentile bootstrap confidence interval of mean(a) - mean(b)
+# Returns (low, high), arrays for 2-D input
+@instrumented('bootstrap_ci')
+def bootstrap_ci(a, b, n_resamples=DEFAULT_RESAMPLES, confidence=0.95, seed=None, max_elements=DEFAULT_MAX_ELEMENTS):
+    a, b, squeeze = _as_2d(a, b)
+    rng = np.random.default_rng(seed)
+    diffs = []
+    for k in _chunks(n_resamples, len(a) * (a.shape[1] + b.shape[1]), max_elements):
+        means_a, means_b = _bootstrap_means(rng, a, b, k)
+        diffs.append(means_a - means_b)
+    diffs = np.concatenate(diffs, axis=1)
+
+    alpha = (1 - confidence) / 2
+    low, high = np.quantile(diffs, [alpha, 1 - alpha], axis=1)
+    return (low[0], high[0]) if squeeze else (low, high)
+
+
+# Bootstrap test of mean(a) - mean(b)
+# Both samples are shifted to the pooled mean so the resamples follow the null hypothesis
+# Returns the observed difference and the p-value (arrays for 2-D input)
+def bootstrap_test(a, b, n_resamples=DEFAULT_RESAMPLES, alternative='two-sided', seed=None,
+                   max_elements=DEFAULT_MAX_ELEMENTS):
+    a, b, squeeze = _as_2d(a, b)
+    observed = a.mean(axis=1) - b.mean(axis=1)
+    pooled_mean = np.concatenate([a, b], axis=1).mean(axis=1, keepdims=True)
+    a_null = a - a.mean(axis=1, keepdims=True) + pooled_mean
+    b_null = b - b.mean(axis=1, keepdims=True) + pooled_mean
+
+    rng = np.random.default_rng(seed)
+    counts = np.zeros(len(a), dtype=np.int64)
+    for k in _chunks(n_resamples, len(a) * (a.shape[1] + b.shape[1]), max_elements):
+        means_a, means_b = _bootstrap_means(rng, a_null, b_null, k)
+        counts += _extreme_counts(means_a - means_b, observed, alternative)
+
+    p_value = (counts + 1) / (n_resamples + 1)
+    return (observed[0], p_value[0]) if squeeze else (observed, p_value)
+
+
+# Two sample test by name, returns (statistic, p-value)
+# 'ttest' and 'welch' return the t statistic, the resampling tests the difference in means;
+# seed and the other keyword arguments only apply to the resampling tests
+def two_sample_test(a, b, method='ttest', seed=None, **kwargs):
+    if method == 'ttest':
+        return tuple(ttest_ind(a, b, axis=-1))
+    if method == 'welch':
+        return tuple(ttest_ind(a, b, axis=-1, equal_var=False))
+    if method == 'permutation':
+        return permutation_test(a, b, seed=seed, **kwargs)
+    if method == 'bootstrap':
+        return bootstrap_test(a, b, seed=seed, **kwargs)
+    raise ValueError(f'Unknown test method: {method}, expected one of {list(METHODS)}')
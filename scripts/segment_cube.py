@@ -0,0 +1,110 @@
+# Segment cube: additive measures precomputed over
+# LIFESTAGE x PREMIUM_CUSTOMER x BRAND x PACK_SIZE x YEARMONTH x STORE_NBR
+# One grouping pass over the cleaned transactions keeps the sums, sums of squares and row counts
+# of every observed cell. Slices and roll-ups (total sales by segment, brand counts of a segment,
+# Welch t-test inputs, ...) then add up cube cells instead of scanning the transactions again.
+#
+# Usage (from the data directory):
+#   python segment_cube.py QVI_cleaned_data.csv --output QVI_segment_cube.parquet
+import argparse
+
+import numpy as np
+import pandas as pd
+from scipy.stats import ttest_ind_from_stats
+
+from instrumentation import instrumented
+from qvi_io import CLEANED_DATA_PATH, category_mask, read_cleaned_data
+
+# Default location of a saved cube
+SEGMENT_CUBE_PATH = 'QVI_segment_cube.parquet'
+
+# Dimensions of the cube, in grouping order
+CUBE_DIMENSIONS = ['LIFESTAGE', 'PREMIUM_CUSTOMER', 'BRAND', 'PACK_SIZE', 'YEARMONTH', 'STORE_NBR']
+
+# Additive measures kept per cell: name -> function of the transactions
+# A measure with a <name>_SQ companion can be turned into a mean and a variance (see moments)
+CUBE_MEASURES = {
+    'TOT_SALES': lambda df: df['TOT_SALES'],
+    'TOT_SALES_SQ': lambda df: df['TOT_SALES'] ** 2,
+    'PROD_QTY': lambda df: df['PROD_QTY'].astype('int64'),
+    'PROD_QTY_SQ': lambda df: df['PROD_QTY'].astype('int64') ** 2,
+    'PRICE_PER_UNIT': lambda df: df['TOT_SALES'] / df['PROD_QTY'],
+    'PRICE_PER_UNIT_SQ': lambda df: (df['TOT_SALES'] / df['PROD_QTY']) ** 2
+}
+
+# Columns of the cleaned data the cube is built from
+CUBE_COLUMNS = CUBE_DIMENSIONS + ['TOT_SALES', 'PROD_QTY']
+
+
+# Build the cube from cleaned transactions, one row per observed cell with n_rows and every measure
+# Rows with a null dimension (cards without customer details) keep their own cells, so roll-ups of
+# the whole cube still count every transaction
+@instrumented('build_segment_cube')
+def build_segment_cube(transactions, dimensions=CUBE_DIMENSIONS, measures=None):
+    if measures is None:
+        measures = CUBE_MEASURES
+    values = pd.DataFrame({dim: transactions[dim] for dim in dimensions})
+    for name, func in measures.items():
+        values[name] = func(transactions)
+    values['n_rows'] = 1
+    return values.groupby(list(dimensions), observed=True, dropna=False).sum().reset_index()
+
+
+# Cube cells matching where: {dimension: value or list of values}
+def filter_cube(cube, where=None):
+    mask = np.ones(len(cube), dtype=bool)
+    for dim, values in (where or {}).items():
+        if isinstance(cube[dim].dtype, pd.CategoricalDtype):
+            mask &= category_mask(cube[dim], values)
+        else:
+            mask &= cube[dim].isin(np.atleast_1d(values)).to_numpy()
+    return cube[mask]
+
+
+# Roll the cube up to the dimensions in by (none for a grand total), optionally on a slice
+# Returns the summed measures and n_rows, indexed by the by dimensions; cells with a null by
+# dimension are left out, as in a groupby of the transactions, but count in the other roll-ups
+def rollup(cube, by=(), where=None):
+    cells = filter_cube(cube, where)
+    measures = [col for col in cube.columns if col not in CUBE_DIMENSIONS]
+    if not by:
+        return pd.DataFrame([cells[measures].sum()]).astype(cells[measures].dtypes.to_dict())
+    return cells.groupby(list(by), observed=True)[measures].sum()
+
+
+# Mean, sample variance and count of a measure from its rolled-up sum, sum of squares and n_rows
+def moments(rolled, measure):
+    n = rolled['n_rows']
+    mean = rolled[measure] / n
+    var = (rolled[f'{measure}_SQ'] - n * mean ** 2) / (n - 1)
+    return pd.DataFrame({'mean': mean, 'var': var.clip(lower=0), 'n': n})
+
+
+# Welch t-test of a measure between two slices of the cube, returns (t statistic, p-value)
+def welch_test(cube, where_a, where_b, measure='PRICE_PER_UNIT'):
+    a = moments(rollup(cube, where=where_a), measure).iloc[0]
+    b = moments(rollup(cube, where=where_b), measure).iloc[0]
+    return tuple(ttest_ind_from_stats(a['mean'], np.sqrt(a['var']), a['n'],
+                                      b['mean'], np.sqrt(b['var']), b['n'], equal_var=False))
+
+
+# Save a cube to Parquet, categorical dimensions are kept
+def save_segment_cube(cube, path=SEGMENT_CUBE_PATH):
+    cube.to_parquet(path, index=False)
+
+
+# Load a cube saved by save_segment_cube
+def load_segment_cube(path=SEGMENT_CUBE_PATH):
+    return pd.read_parquet(path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the LIFESTAGE x PREMIUM_CUSTOMER x BRAND x PACK_SIZE segment cube.')
+    parser.add_argument('cleaned_data', nargs='?', default=CLEANED_DATA_PATH)
+    parser.add_argument('--output', default=SEGMENT_CUBE_PATH)
+    args = parser.parse_args()
+
+    transactions = read_cleaned_data(args.cleaned_data, columns=CUBE_COLUMNS)
+    cube = build_segment_cube(transactions)
+    save_segment_cube(cube, args.output)
+    print(f'Segment cube with {len(cube):,} cells from {len(transactions):,} transactions saved to {args.output}')
@@ -0,0 +1,214 @@
+# On-disk cache of pipeline stage results, keyed by content hashes
+# The key of a stage is a hash of its name, its code, the keys of its inputs and its parameters.
+# Its code is the stage function plus the source of every analysis module it depends on: the
+# modules of the functions and modules it references, and everything those import in turn, so an
+# edit to e.g. store_metrics.py changes the key of every stage that computes measureOverTime.
+# Input files are hashed by content (memoized per path, size and mtime, so unchanged files are
+# not read again), and the key of a stage result only depends on upstream keys, so a stage
+# whose inputs did not change is found in the cache without running or even loading anything
+# upstream of it. The cache is bounded in size: least recently used entries are evicted first.
+#
+# Layout of the cache directory:
+#   <stage>-<key>/result.parquet | result.pkl   the stage result (DataFrames as Parquet)
+#   <stage>-<key>/meta.json                      stage, key, parameters and size
+#   file_hashes.json                             memoized content hashes of input files
+import ast
+import functools
+import hashlib
+import inspect
+import json
+import os
+import pickle
+import shutil
+import time
+
+import pandas as pd
+
+# Cache directory, override with the QVI_STAGE_CACHE environment variable
+STAGE_CACHE_DIR = os.environ.get('QVI_STAGE_CACHE', '.qvi_stage_cache')
+
+# Size limit of the cache in bytes, override with QVI_STAGE_CACHE_MAX_BYTES
+STAGE_CACHE_MAX_BYTES = int(os.environ.get('QVI_STAGE_CACHE_MAX_BYTES', 5 * 1024 ** 3))
+
+# Bump to invalidate every cached result, a last resort for changes the code hash cannot see
+# (e.g. the format of the cache entries); code changes in the analysis modules are picked up
+CACHE_VERSION = 1
+
+# Directory of the analysis modules whose source is part of the stage keys
+MODULE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Bytes read at a time when hashing files
+HASH_BLOCK_SIZE = 1 << 20
+
+
+# SHA-256 of a file's content, memoized in the cache directory by (path, size, mtime)
+def file_hash(path, cache_dir=STAGE_CACHE_DIR):
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    index_path = os.path.join(cache_dir, 'file_hashes.json')
+    index = {}
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+    entry = index.get(path)
+    if entry and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+        return entry['sha256']
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    index[path] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': digest.hexdigest()}
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(index_path, 'w') as f:
+        json.dump(index, f)
+    return index[path]['sha256']
+
+
+# Analysis modules imported by a module, directly or indirectly, the module included
+# Imports are read from the source, including imports inside functions, and so are module names
+# given as strings (modules imported by name through importlib, e.g. the execution backends)
+def module_dependencies(module_name, found=None):
+    found = set() if found is None else found
+    path = os.path.join(MODULE_DIR, f'{module_name}.py')
+    if module_name in found or not os.path.exists(path):
+        return found
+    found.add(module_name)
+    for node in ast.walk(ast.parse(module_source(module_name))):
+        if isinstance(node, ast.Import):
+            names = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+            names = [node.module]
+        elif isinstance(node, ast.Constant) and isinstance(node.value, str) and node.value.isidentifier():
+            names = [node.value]
+        else:
+            continue
+        for dependency in names:
+            module_dependencies(dependency.split('.')[0], found)
+    return found
+
+
+# Source of an analysis module, read once per process
+@functools.lru_cache(maxsize=None)
+def module_source(module_name):
+    with open(os.path.join(MODULE_DIR, f'{module_name}.py'), encoding='utf-8') as f:
+        return f.read()
+
+
+# Analysis modules a function references through its globals (functions, classes and modules)
+def referenced_modules(func):
+    names, codes = set(), [func.__code__]
+    while codes:
+        code = codes.pop()
+        names |= set(code.co_names)
+        codes += [const for const in code.co_consts if inspect.iscode(const)]
+    modules = set()
+    for name in names & set(func.__globals__):
+        value = func.__globals__[name]
+        source = inspect.getfile(value) if inspect.ismodule(value) else getattr(inspect.getmodule(value), '__file__', None)
+        if source and os.path.dirname(os.path.abspath(source)) == MODULE_DIR:
+            modules.add(os.path.splitext(os.path.basename(source))[0])
+    return modules
+
+
+# Hash of a stage function's source and of the source of every analysis module it depends on
+def code_hash(func):
+    digest = hashlib.sha256(inspect.getsource(func).encode())
+    modules = set()
+    for module_name in referenced_modules(func):
+        module_dependencies(module_name, modules)
+    for module_name in sorted(modules):
+        digest.update(module_name.encode())
+        digest.update(hashlib.sha256(module_source(module_name).encode()).digest())
+    return digest.hexdigest()
+
+
+# Key of a stage: hash of its name, code, input keys and JSON-serializable parameters
+def stage_key(name, func, input_keys, params):
+    payload = json.dumps({
+        'stage': name,
+        'version': CACHE_VERSION,
+        'code': code_hash(func),
+        'inputs': list(input_keys),
+        'params': params
+    }, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+# Total size of the files below a directory
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+# Directory of a cache entry
+def entry_path(name, key, cache_dir=STAGE_CACHE_DIR):
+    return os.path.join(cache_dir, f'{name}-{key[:24]}')
+
+
+# Check if a stage result is cached
+def is_cached(name, key, cache_dir=STAGE_CACHE_DIR):
+    return os.path.exists(os.path.join(entry_path(name, key, cache_dir), 'meta.json'))
+
+
+# Load a cached stage result and mark it as recently used
+def load_entry(name, key, cache_dir=STAGE_CACHE_DIR):
+    path = entry_path(name, key, cache_dir)
+    os.utime(path)
+    if os.path.exists(os.path.join(path, 'result.parquet')):
+        return pd.read_parquet(os.path.join(path, 'result.parquet'))
+    with open(os.path.join(path, 'result.pkl'), 'rb') as f:
+        return pickle.load(f)
+
+
+# Store a stage result, written to a temporary directory first so a partial entry is never read
+def save_entry(name, key, value, params=None, cache_dir=STAGE_CACHE_DIR):
+    path = entry_path(name, key, cache_dir)
+    tmp_path = f'{path}.tmp{os.getpid()}'
+    os.makedirs(tmp_path, exist_ok=True)
+    if isinstance(value, pd.DataFrame):
+        value.to_parquet(os.path.join(tmp_path, 'result.parquet'))
+    else:
+        with open(os.path.join(tmp_path, 'result.pkl'), 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump({'stage': name, 'key': key, 'params': params, 'created': time.time(),
+                   'size': directory_size(tmp_path)}, f, default=str)
+    if os.path.exists(path):
+        shutil.rmtree(tmp_path)
+    else:
+        os.replace(tmp_path, path)
+
+
+# Evict least recently used entries until the cache fits in max_bytes, keep is never evicted
+def evict(max_bytes=STAGE_CACHE_MAX_BYTES, cache_dir=STAGE_CACHE_DIR, keep=()):
+    entries = []
+    for entry in os.listdir(cache_dir):
+        meta_path = os.path.join(cache_dir, entry, 'meta.json')
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                size = json.load(f)['size']
+            entries.append((os.path.getmtime(os.path.join(cache_dir, entry)), entry, size))
+    total = sum(size for _, _, size in entries)
+    evicted = []
+    for _, entry, size in sorted(entries):
+        if total <= max_bytes:
+            break
+        if os.path.join(cache_dir, entry) in keep:
+            continue
+        shutil.rmtree(os.path.join(cache_dir, entry))
+        total -= size
+        evicted.append(entry)
+    return evicted
+
+
+# Run a stage through the cache: returns (value, key, hit)
+# inputs are (key, loader) pairs; loaders are only called when the stage has to run
+def cached_stage(name, func, inputs=(), params=None, cache_dir=STAGE_CACHE_DIR, max_bytes=STAGE_CACHE_MAX_BYTES):
+    params = params or {}
+    key = stage_key(name, func, [input_key for input_key, _ in inputs], params)
+    if is_cached(name, key, cache_dir):
+        return load_entry(name, key, cache_dir), key, True
+    value = func(*[loader() for _, loader in inputs], **params)
+    save_entry(name, key, value, params, cache_dir)
+    evict(max_bytes, cache_dir, keep=(entry_path(name, key, cache_dir),))
+    return value, key, False
@@ -0,0 +1,115 @@
+# Store/month metrics for measureOverTime in a single grouping pass
+# The (STORE_NBR, YEARMONTH) keys are factorized once into integer group codes and every
+# aggregate is reduced with NumPy over those codes, instead of one pandas groupby per metric.
+# Extra aggregates and metrics can be registered and are computed in the same pass.
+import numpy as np
+import pandas as pd
+
+from instrumentation import instrumented
+
+KEYS = ['STORE_NBR', 'YEARMONTH']
+
+# Aggregates computed in the grouping pass: name -> (column, reducer)
+# Reducers: 'sum', 'count', 'nunique' and 'mean'
+AGGREGATES = {
+    'TOT_SALES': ('TOT_SALES', 'sum'),
+    'PROD_QTY': ('PROD_QTY', 'sum'),
+    'n_transactions': ('TXN_ID', 'nunique'),
+    'n_customers': ('LYLTY_CARD_NBR', 'nunique')
+}
+
+# measureOverTime metrics derived from the aggregates: name -> function of the aggregate table
+METRICS = {
+    'Total Sales': lambda agg: agg['TOT_SALES'],
+    'no_Customers': lambda agg: agg['n_customers'],
+    'trans_per_customer': lambda agg: agg['n_transactions'] / agg['n_customers'],
+    'chips_per_customer': lambda agg: agg['PROD_QTY'] / agg['n_transactions'],
+    'average_price': lambda agg: agg['TOT_SALES'] / agg['PROD_QTY']
+}
+
+
+# Register an extra aggregate, e.g. register_aggregate('n_products', 'PROD_NBR', 'nunique')
+def register_aggregate(name, column, reducer):
+    if reducer not in ('sum', 'count', 'nunique', 'mean'):
+        raise ValueError(f'Unknown reducer: {reducer}')
+    AGGREGATES[name] = (column, reducer)
+
+
+# Register an extra metric computed from the aggregates,
+# e.g. register_metric('sales_per_customer', lambda agg: agg['TOT_SALES'] / agg['n_customers'])
+def register_metric(name, func):
+    METRICS[name] = func
+
+
+# Factorize the grouping keys into one integer code per row
+# Returns the codes and the sorted key values of every group
+def group_codes(df, keys=KEYS):
+    codes = np.zeros(len(df), dtype=np.int64)
+    levels = []
+    for key in keys:
+        key_codes, uniques = pd.factorize(df[key], sort=True)
+        codes = codes * len(uniques) + key_codes
+        levels.append(uniques)
+    return codes, pd.MultiIndex.from_product(levels, names=keys)
+
+
+# Number of distinct values of a column within each group
+# (value, group) pairs are packed into one int64, sorted, and the first of each run counted;
+# integer columns are offset directly, anything else is factorized first
+def count_distinct(codes, values, n_groups):
+    values = np.asarray(values)
+    if len(values) == 0:
+        return np.zeros(n_groups, dtype=np.int64)
+    if np.issubdtype(values.dtype, np.integer) and int(values.max()) - int(values.min()) < np.iinfo(np.int64).max // n_groups:
+        value_codes = values.astype(np.int64) - values.min()
+    else:
+        value_codes = pd.factorize(values)[0].astype(np.int64)
+    pairs = np.sort(value_codes * n_groups + codes)
+    first = np.empty(len(pairs), dtype=bool)
+    first[0] = True
+    np.not_equal(pairs[1:], pairs[:-1], out=first[1:])
+    return np.bincount(pairs[first] % n_groups, minlength=n_groups)
+
+
+# Reduce every aggregate over the group codes, keeping only groups that occur in the data
+# Float sums go through one pandas groupby on the integer codes, whose compensated summation
+# gives the same totals as a plain groupby; integer sums, counts and distinct counts use bincount
+def compute_aggregates(df, aggregates=None, keys=KEYS):
+    if aggregates is None:
+        aggregates = AGGREGATES
+    codes, index = group_codes(df, keys)
+    n_groups = len(index)
+    counts = np.bincount(codes, minlength=n_groups)
+
+    float_sums = {name: df[column].to_numpy() for name, (column, reducer) in aggregates.items()
+                  if reducer in ('sum', 'mean') and not np.issubdtype(df[column].dtype, np.integer)}
+    if float_sums:
+        float_sums = pd.DataFrame(float_sums).groupby(codes).sum().reindex(range(n_groups), fill_value=0)
+
+    columns = {}
+    for name, (column, reducer) in aggregates.items():
+        if reducer == 'count':
+            columns[name] = counts
+        elif reducer == 'nunique':
+            columns[name] = count_distinct(codes, df[column], n_groups)
+        else:
+            if name in float_sums:
+                sums = float_sums[name].to_numpy()
+            else:
+                sums = np.bincount(codes, weights=df[column].to_numpy(), minlength=n_groups).astype(np.int64)
+            if reducer == 'mean':
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    sums = sums / counts
+            columns[name] = sums
+
+    observed = counts > 0
+    return pd.DataFrame({name: values[observed] for name, values in columns.items()}, index=index[observed])
+
+
+# measureOverTime indexed by (STORE_NBR, YEARMONTH), one column per registered metric
+@instrumented('measure_over_time')
+def compute_measure_over_time(df, metrics=None, aggregates=None):
+    if metrics is None:
+        metrics = METRICS
+    agg = compute_aggregates(df, aggregates)
+    return pd.DataFrame({name: func(agg) for name, func in metrics.items()}, index=agg.index)
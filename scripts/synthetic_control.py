@@ -0,0 +1,182 @@
+# Regression-based counterfactual (synthetic control) of trial stores
+# For every trial store a weighted combination of donor stores is fitted on the months before the
+# trial and projected over the trial period: what the trial store would have done without the
+# trial. The donors of a trial store are the stores with the best control scores on the pre-trial
+# months (control_matching.py, trial stores excluded), so no control store is picked by hand and
+# the fit cannot just interpolate the few pre-trial months with hundreds of stores. All trial
+# stores of a period are solved together, as one stack of (months x donors) problems:
+#   'nnls'   non-negative weights, by accelerated projected gradient, every trial store updated
+#            in the same batched matrix product per iteration
+#   'ridge'  ridge regression weights, one batched linear solve
+# The uplift is actual - counterfactual over the trial months. The t-value of a month is its gap
+# over the standard deviation of the pre-trial gaps, significant beyond the 95% quantile of a t
+# distribution with (pre-trial months - 1) degrees of freedom.
+#
+# Usage (from the data directory), specs CSV with columns trial_store, trial_start, trial_end:
+#   python synthetic_control.py trial_specs.csv --solver nnls --output counterfactual.csv
+import argparse
+
+import numpy as np
+import pandas as pd
+from scipy.stats import t as t_distribution
+
+from control_matching import MATCH_METRICS, control_score
+from instrumentation import instrumented
+from qvi_io import CLEANED_DATA_PATH, read_cleaned_data
+from store_metrics import compute_measure_over_time
+from trial_batch import ASSESS_METRICS, complete_stores_only, metric_cube
+
+# Donor stores fitted per trial store
+DEFAULT_DONORS = 5
+
+# Relative ridge penalty, scaled by the mean diagonal of each donor Gram matrix
+DEFAULT_ALPHA = 1e-3
+
+# Iteration limit and relative tolerance of the NNLS solver
+NNLS_MAX_ITER = 5000
+NNLS_TOL = 1e-9
+
+# Weights below this are reported as unused donors
+WEIGHT_THRESHOLD = 1e-6
+
+
+# Non-negative least squares of a stack of problems: min ||X[i] w[i] - y[i]|| with w[i] >= 0
+# X: (problems, observations, donors), y: (problems, observations) -> W: (problems, donors)
+# FISTA on the Gram matrices; each problem is rescaled first, which leaves its weights unchanged
+def batch_nnls(X, y, max_iter=NNLS_MAX_ITER, tol=NNLS_TOL):
+    scale = np.maximum(np.abs(X).max(axis=(1, 2)), 1e-12)
+    X, y = X / scale[:, None, None], y / scale[:, None]
+    gram, target = np.einsum('pok,pol->pkl', X, X), np.einsum('pok,po->pk', X, y)
+    step = 1 / np.maximum(np.linalg.eigvalsh(gram)[:, -1], 1e-12)
+    W = np.zeros_like(target)
+    Z, momentum = W, 1.0
+    for _ in range(max_iter):
+        W_next = np.maximum(Z - step[:, None] * (np.einsum('pkl,pl->pk', gram, Z) - target), 0)
+        momentum_next = (1 + np.sqrt(1 + 4 * momentum ** 2)) / 2
+        Z = W_next + (momentum - 1) / momentum_next * (W_next - W)
+        converged = np.abs(W_next - W).max() <= tol * max(np.abs(W_next).max(), 1)
+        W, momentum = W_next, momentum_next
+        if converged:
+            break
+    return W
+
+
+# Ridge regression weights of a stack of problems, one batched solve
+def batch_ridge(X, y, alpha=DEFAULT_ALPHA):
+    gram, target = np.einsum('pok,pol->pkl', X, X), np.einsum('pok,po->pk', X, y)
+    penalty = alpha * np.trace(gram, axis1=1, axis2=2) / gram.shape[1]
+    return np.linalg.solve(gram + penalty[:, None, None] * np.eye(gram.shape[1]), target[..., None])[..., 0]
+
+
+# Solvers of the donor weights: name -> function(X, y, alpha)
+SOLVERS = {
+    'nnls': lambda X, y, alpha: batch_nnls(X, y),
+    'ridge': batch_ridge
+}
+
+
+# Donor pool of every trial store: positions of the n_donors candidate stores with the best
+# finalControlScore on the pre-trial months, best first -> (trials, n_donors)
+def donor_pools(cube, metrics, positions, pre, candidates, n_donors=DEFAULT_DONORS, corr_weight=0.5):
+    if candidates.sum() < n_donors:
+        raise ValueError(f'{n_donors} donor stores are needed, only {candidates.sum()} stores are not trial stores')
+    scores = np.mean([control_score(cube[metrics.index(metric)][positions][:, pre], cube[metrics.index(metric)][:, pre],
+                                    corr_weight) for metric in MATCH_METRICS], axis=0)
+    scores[:, ~candidates] = -np.inf
+    return np.argsort(-np.nan_to_num(scores, nan=-np.inf), axis=1, kind='stable')[:, :n_donors]
+
+
+# Counterfactual of every trial store, fitted on the months before its trial period
+# measureOverTime must hold a full observation period for every store (null stores removed)
+# specs: list of (trial store, (trial start, trial end)); metrics: measures to fit, one problem each
+# Returns {'summary': one row per trial and metric, 'monthly': actual and counterfactual per month,
+#          'weights': the donors used by every trial and metric}
+@instrumented('synthetic_control')
+def synthetic_control(measureOverTime, specs, metrics=tuple(ASSESS_METRICS), solver='nnls', n_donors=DEFAULT_DONORS,
+                      alpha=DEFAULT_ALPHA, corr_weight=0.5):
+    if solver not in SOLVERS:
+        raise ValueError(f'Unknown solver: {solver}, expected one of {list(SOLVERS)}')
+    metrics = list(metrics)
+    cube_metrics = list(dict.fromkeys(list(MATCH_METRICS) + metrics))
+    cube, stores, months = metric_cube(measureOverTime, cube_metrics)
+    specs = pd.DataFrame([(store, period[0], period[1]) for store, period in specs],
+                         columns=['trial_store', 'trial_start', 'trial_end'])
+    candidates = ~np.isin(stores, specs['trial_store'].unique())
+
+    summary, monthly, weights = [], [], []
+    for (start, end), group in specs.groupby(['trial_start', 'trial_end'], sort=False):
+        trial_stores = group['trial_store'].unique()
+        positions = np.searchsorted(stores, trial_stores)
+        if (positions >= len(stores)).any() or (stores[np.minimum(positions, len(stores) - 1)] != trial_stores).any():
+            raise ValueError(f'Trial stores without a full observation period: {trial_stores}')
+        pre = months < start
+        during = (months >= start) & (months <= end)
+        if pre.sum() < 2 or not during.any():
+            raise ValueError(f'Trial period {start}-{end} needs at least two earlier months and one trial month')
+        critical = t_distribution.ppf(0.975, pre.sum() - 1)
+        pools = donor_pools(cube, cube_metrics, positions, pre, candidates, n_donors, corr_weight)
+
+        for metric in metrics:
+            # (trials, months, donors) and (trials, months); all trials of the period solved at once
+            values = cube[cube_metrics.index(metric)]
+            donor_values, actual = values[pools].transpose(0, 2, 1), values[positions]
+            W = SOLVERS[solver](donor_values[:, pre], actual[:, pre], alpha)
+            counterfactual = np.einsum('pmk,pk->pm', donor_values, W)
+            gap = actual - counterfactual
+            with np.errstate(divide='ignore', invalid='ignore'):
+                t_values = gap / gap[:, pre].std(axis=1, ddof=1)[:, None]
+                uplift_pct = gap[:, during].sum(axis=1) / counterfactual[:, during].sum(axis=1)
+
+            summary.append(pd.DataFrame({
+                'trial_store': trial_stores,
+                'trial_start': start,
+                'trial_end': end,
+                'metric': metric,
+                'pre_rmse': np.sqrt((gap[:, pre] ** 2).mean(axis=1)),
+                'actual': actual[:, during].sum(axis=1),
+                'counterfactual': counterfactual[:, during].sum(axis=1),
+                'uplift': gap[:, during].sum(axis=1),
+                'uplift_pct': uplift_pct,
+                'significant_months': (np.abs(t_values[:, during]) > critical).sum(axis=1),
+                'donors_used': (np.abs(W) > WEIGHT_THRESHOLD).sum(axis=1),
+                'top_donor': stores[pools[np.arange(len(pools)), np.argmax(W, axis=1)]]
+            }))
+            monthly.append(pd.DataFrame({
+                'trial_store': np.repeat(trial_stores, len(months)),
+                'metric': metric,
+                'YEARMONTH': np.tile(months, len(trial_stores)),
+                'trial_period': np.tile(during, len(trial_stores)),
+                'actual': actual.ravel(),
+                'counterfactual': counterfactual.ravel(),
+                't_value': t_values.ravel()
+            }))
+            trial, donor = np.nonzero(np.abs(W) > WEIGHT_THRESHOLD)
+            weights.append(pd.DataFrame({'trial_store': trial_stores[trial], 'metric': metric,
+                                         'donor_store': stores[pools[trial, donor]], 'weight': W[trial, donor]}))
+
+    summary = pd.concat(summary, ignore_index=True).sort_values(['trial_store', 'metric'], ignore_index=True)
+    monthly = pd.concat(monthly, ignore_index=True).sort_values(['trial_store', 'metric', 'YEARMONTH'], ignore_index=True)
+    weights = pd.concat(weights, ignore_index=True).sort_values(['trial_store', 'metric', 'weight'],
+                                                                ascending=[True, True, False], ignore_index=True)
+    return {'summary': summary, 'monthly': monthly, 'weights': weights}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Synthetic control counterfactual of many trial stores.')
+    parser.add_argument('specs', help='CSV with trial_store, trial_start, trial_end (yyyymm)')
+    parser.add_argument('--cleaned-data', default=CLEANED_DATA_PATH)
+    parser.add_argument('--solver', default='nnls', choices=list(SOLVERS))
+    parser.add_argument('--donors', type=int, default=DEFAULT_DONORS, help='donor stores per trial store')
+    parser.add_argument('--alpha', type=float, default=DEFAULT_ALPHA, help='relative ridge penalty')
+    parser.add_argument('--output', default='counterfactual.csv')
+    args = parser.parse_args()
+
+    df1 = read_cleaned_data(args.cleaned_data, columns=['STORE_NBR', 'YEARMONTH', 'LYLTY_CARD_NBR', 'TXN_ID', 'PROD_QTY', 'TOT_SALES'])
+    measureOverTime = complete_stores_only(compute_measure_over_time(df1).reset_index())
+    specs = pd.read_csv(args.specs)
+    specs = list(zip(specs['trial_store'], zip(specs['trial_start'], specs['trial_end'])))
+
+    results = synthetic_control(measureOverTime, specs, solver=args.solver, n_donors=args.donors, alpha=args.alpha)
+    results['summary'].to_csv(args.output, index=False)
+    print(results['summary'])
+    print(f"{len(specs)} trials, counterfactual summary saved to {args.output}")
@@ -0,0 +1,161 @@
+# Batch evaluation of many trial stores across a process pool
+# Each spec is a trial store with its trial period. For every spec the best control store is
+# picked on the months before the trial starts (control_matching.py) and the trial period is
+# assessed with t-tests (or a resampling test, see resampling.py), as in Trial_store_analysis.py.
+#
+# Usage (from the data directory), specs CSV with columns trial_store, trial_start, trial_end:
+#   python trial_batch.py trial_specs.csv --processes 8 --output trial_results.csv
+#
+# The store x month matrix of every metric is placed once in shared memory; workers attach to
+# it by name instead of receiving a pickled copy, and only trial store numbers travel per task.
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+from control_matching import MATCH_METRICS, control_score
+from instrumentation import instrumented
+from qvi_io import CLEANED_DATA_PATH, read_cleaned_data
+from resampling import METHODS, two_sample_test
+from store_metrics import compute_measure_over_time
+
+# Metrics compared between trial and control store: metric -> suffix of the result columns
+ASSESS_METRICS = {
+    'Total Sales': 'sales',
+    'no_Customers': 'customers'
+}
+
+# Trial stores evaluated per task
+DEFAULT_CHUNK_SIZE = 32
+
+# Shared store x month matrices of the current worker process
+_shared = {}
+
+
+# Stack the store x month matrix of each metric into one (metrics, stores, months) array
+# measureOverTime must hold a full observation period for every store (null stores removed)
+def metric_cube(measureOverTime, metrics):
+    stores = np.sort(measureOverTime['STORE_NBR'].unique())
+    months = np.sort(measureOverTime['YEARMONTH'].unique())
+    cube = np.stack([measureOverTime.pivot(index='STORE_NBR', columns='YEARMONTH', values=metric)
+                     .reindex(index=stores, columns=months).to_numpy(dtype=np.float64) for metric in metrics])
+    if np.isnan(cube).any():
+        raise ValueError('measureOverTime must have every month for every store, remove the null stores first')
+    return cube, stores, months
+
+
+# Drop stores that do not have a full observation period
+def complete_stores_only(measureOverTime):
+    months_per_store = measureOverTime.groupby('STORE_NBR')['YEARMONTH'].transform('nunique')
+    return measureOverTime[months_per_store == measureOverTime['YEARMONTH'].nunique()]
+
+
+# Worker initializer: attach to the shared metric cube created by evaluate_trials
+def _attach(shm_name, shape, stores, months, metrics, settings):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    _shared.update(shm=shm, cube=np.ndarray(shape, dtype=np.float64, buffer=shm.buf), stores=stores,
+                   months=months, metrics=metrics, **settings)
+
+
+# Match and assess a group of trial stores that share the same trial period
+def _evaluate(trial_stores, trial_period):
+    cube, stores, months, metrics = _shared['cube'], _shared['stores'], _shared['months'], _shared['metrics']
+    positions = np.searchsorted(stores, trial_stores)
+    if (positions >= len(stores)).any() or (stores[np.minimum(positions, len(stores) - 1)] != trial_stores).any():
+        raise ValueError(f'Trial stores without a full observation period: {trial_stores}')
+
+    pre = months < trial_period[0]
+    during = (months >= trial_period[0]) & (months <= trial_period[1])
+
+    # finalControlScore is the mean of the per-metric scores; the trial store itself scores NaN
+    scores = np.mean([control_score(cube[metrics.index(metric)][positions][:, pre], cube[metrics.index(metric)][:, pre],
+                                    _shared['corr_weight']) for metric in MATCH_METRICS], axis=0)
+    scores[np.arange(len(positions)), positions] = np.nan
+    # A trial whose candidates all score NaN (e.g. constant pre-trial series) has no control store:
+    # its control store and statistics are left empty instead of failing the whole batch
+    matched = ~np.isnan(scores).all(axis=1)
+    best = np.argmax(np.where(np.isnan(scores), -np.inf, scores), axis=1)
+
+    results = {
+        'trial_store': trial_stores,
+        'trial_start': trial_period[0],
+        'trial_end': trial_period[1],
+        'control_store': pd.Series(stores[best]).where(matched),
+        'finalControlScore': scores[np.arange(len(positions)), best]
+    }
+    for metric, suffix in ASSESS_METRICS.items():
+        trial_values = cube[metrics.index(metric)][positions][:, during]
+        control_values = cube[metrics.index(metric)][best][:, during]
+        # All trials of the task are tested together, one row per trial
+        statistic, p_value = two_sample_test(trial_values, control_values, _shared['method'], _shared['seed'])
+        results[f'trial_total_{suffix}'] = trial_values.sum(axis=1)
+        results[f'control_total_{suffix}'] = np.where(matched, control_values.sum(axis=1), np.nan)
+        results[f'statistic_{suffix}'] = np.where(matched, statistic, np.nan)
+        results[f'p_value_{suffix}'] = np.where(matched, p_value, np.nan)
+    return pd.DataFrame(results)
+
+
+# Evaluate a list of (trial store, (trial start, trial end)) specs, returns one row per spec
+# processes: worker processes (default: all CPUs), 1 runs everything in this process
+# method/seed: significance test of the trial period, see resampling.two_sample_test
+@instrumented('evaluate_trials')
+def evaluate_trials(measureOverTime, specs, processes=None, chunk_size=DEFAULT_CHUNK_SIZE, corr_weight=0.5,
+                    method='ttest', seed=None):
+    settings = {'corr_weight': corr_weight, 'method': method, 'seed': seed}
+    metrics = list(dict.fromkeys(list(MATCH_METRICS) + list(ASSESS_METRICS)))
+    cube, stores, months = metric_cube(measureOverTime, metrics)
+
+    # Trials that share a period are matched together in one batched pass
+    specs = pd.DataFrame([(store, period[0], period[1]) for store, period in specs],
+                         columns=['trial_store', 'trial_start', 'trial_end'])
+    tasks = []
+    for (start, end), group in specs.groupby(['trial_start', 'trial_end'], sort=False):
+        trial_stores = group['trial_store'].unique()
+        for i in range(0, len(trial_stores), chunk_size):
+            tasks.append((trial_stores[i:i + chunk_size], (start, end)))
+
+    if processes == 1:
+        _shared.update(cube=cube, stores=stores, months=months, metrics=metrics, **settings)
+        try:
+            results = [_evaluate(*task) for task in tasks]
+        finally:
+            _shared.clear()
+    else:
+        shm = shared_memory.SharedMemory(create=True, size=cube.nbytes)
+        try:
+            np.ndarray(cube.shape, dtype=cube.dtype, buffer=shm.buf)[:] = cube
+            initargs = (shm.name, cube.shape, stores, months, metrics, settings)
+            with ProcessPoolExecutor(max_workers=processes or os.cpu_count(), initializer=_attach, initargs=initargs) as pool:
+                results = list(pool.map(_evaluate, *zip(*tasks))) if tasks else []
+        finally:
+            shm.close()
+            shm.unlink()
+
+    results = pd.concat(results, ignore_index=True) if results else pd.DataFrame()
+    return specs.merge(results, on=['trial_store', 'trial_start', 'trial_end'], how='left')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Match and assess many trial stores across a process pool.')
+    parser.add_argument('specs', help='CSV with trial_store, trial_start, trial_end (yyyymm)')
+    parser.add_argument('--cleaned-data', default=CLEANED_DATA_PATH)
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument('--method', default='ttest', choices=list(METHODS))
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--output', default='trial_results.csv')
+    args = parser.parse_args()
+
+    df1 = read_cleaned_data(args.cleaned_data, columns=['STORE_NBR', 'YEARMONTH', 'LYLTY_CARD_NBR', 'TXN_ID', 'PROD_QTY', 'TOT_SALES'])
+    measureOverTime = complete_stores_only(compute_measure_over_time(df1).reset_index())
+    specs = pd.read_csv(args.specs)
+    specs = list(zip(specs['trial_store'], zip(specs['trial_start'], specs['trial_end'])))
+
+    results = evaluate_trials(measureOverTime, specs, args.processes, args.chunk_size, method=args.method, seed=args.seed)
+    results.to_csv(args.output, index=False)
+    print(f'{len(results)} trials evaluated, results saved to {args.output}')
+    if results['control_store'].isnull().any():
+        print(f"No control store for trial stores {results.loc[results['control_store'].isnull(), 'trial_store'].tolist()}")
@@ -0,0 +1,172 @@
+# Ingestion of Excel workbooks, such as data/QVI_purchase_behaviour_excel.xlsx or multi-sheet upstream exports
+# Reading xlsx is slow, so a workbook is converted once into a Parquet file next to it (<workbook>.parquet)
+# and that file is read afterwards. Rows are streamed with openpyxl's read-only reader and written in
+# batches, so even a large workbook never sits in memory at once. Sheets with the same header are
+# appended in workbook order. The conversion is reused while the workbook is unchanged. The size and
+# mtime are checked first. When those changed, the content hash is compared, so a copied or touched
+# workbook is not converted again.
+# Column types are declared (WORKBOOK_DTYPES) rather than inferred from the first batch, so a column
+# whose cells change type further down the sheet still converts; undeclared columns are kept as text.
+# A failed conversion removes its partial file.
+#
+# Usage (from the data directory):
+#   python workbook_io.py QVI_purchase_behaviour_excel.xlsx
+import argparse
+import hashlib
+import json
+import os
+import time
+
+import pandas as pd
+
+from instrumentation import instrumented
+
+# Customer demographics file read by the scripts, CSV or xlsx, override with QVI_CUSTOMER_DATA
+CUSTOMER_DATA_PATH = os.environ.get('QVI_CUSTOMER_DATA', 'QVI_purchase_behaviour.csv')
+
+# File extensions read as Excel workbooks
+WORKBOOK_EXTENSIONS = ('.xlsx', '.xlsm')
+
+# Rows converted and written per batch
+WORKBOOK_BATCH_ROWS = 100_000
+
+# Declared Arrow types of the workbook columns, other columns are converted as strings
+WORKBOOK_DTYPES = {
+    'LYLTY_CARD_NBR': 'int64',
+    'LIFESTAGE': 'string',
+    'PREMIUM_CUSTOMER': 'string'
+}
+
+# Bytes read at a time when hashing workbooks
+HASH_BLOCK_SIZE = 1 << 20
+
+
+# Check if a path is an Excel workbook
+def is_workbook(path):
+    return str(path).lower().endswith(WORKBOOK_EXTENSIONS)
+
+
+# SHA-256 of a file's content
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# Generator over (sheet name, header, batch of rows) of every non-empty sheet
+def iter_workbook_rows(path, sheet_names=None, batch_rows=WORKBOOK_BATCH_ROWS):
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        for sheet_name in sheet_names or workbook.sheetnames:
+            rows = workbook[sheet_name].iter_rows(values_only=True)
+            header = next(rows, None)
+            if header is None:
+                continue
+            header = [str(name) for name in header]
+            batch = []
+            for row in rows:
+                if any(value is not None for value in row):
+                    batch.append(row)
+                if len(batch) == batch_rows:
+                    yield sheet_name, header, batch
+                    batch = []
+            if batch:
+                yield sheet_name, header, batch
+    finally:
+        workbook.close()
+
+
+# Arrow table of a batch of rows with the declared schema; string columns take the text of any cell
+def batch_table(batch, schema):
+    import pyarrow as pa
+
+    arrays = []
+    for field, values in zip(schema, zip(*batch)):
+        if pa.types.is_string(field.type):
+            values = [None if value is None else str(value) for value in values]
+        arrays.append(pa.array(values).cast(field.type))
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+# Convert the sheets of a workbook into one Parquet file, returns the number of rows written
+# dtypes: {column: Arrow type name}, columns not listed are written as strings
+def convert_workbook(path, cache_path, sheet_names=None, batch_rows=WORKBOOK_BATCH_ROWS, dtypes=None):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    dtypes = WORKBOOK_DTYPES if dtypes is None else dtypes
+    tmp_path = f'{cache_path}.tmp{os.getpid()}'
+    writer = None
+    columns = None
+    rows = 0
+    try:
+        for sheet_name, header, batch in iter_workbook_rows(path, sheet_names, batch_rows):
+            if columns is None:
+                columns = header
+                schema = pa.schema([(column, pa.type_for_alias(dtypes.get(column, 'string'))) for column in columns])
+                writer = pq.ParquetWriter(tmp_path, schema)
+            elif header != columns:
+                raise ValueError(f'Sheet {sheet_name!r} of {path} has columns {header}, expected {columns}')
+            writer.write_table(batch_table(batch, schema))
+            rows += len(batch)
+        if writer is None:
+            raise ValueError(f'No rows found in {path}')
+        writer.close()
+        os.replace(tmp_path, cache_path)
+    except BaseException:
+        if writer is not None:
+            writer.close()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return rows
+
+
+# Path of the Parquet conversion of a workbook, converting it first if the workbook changed
+@instrumented('convert_workbook')
+def workbook_cache(path, cache_path=None, sheet_names=None, batch_rows=WORKBOOK_BATCH_ROWS):
+    cache_path = cache_path or f'{path}.parquet'
+    meta_path = f'{cache_path}.json'
+    stat = os.stat(path)
+    meta = {}
+    if os.path.exists(cache_path) and os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+    if meta.get('sheets') == sheet_names:
+        if meta.get('size') == stat.st_size and meta.get('mtime_ns') == stat.st_mtime_ns:
+            return cache_path
+    current_hash = file_sha256(path)
+    if meta.get('sheets') != sheet_names or meta.get('sha256') != current_hash:
+        meta['rows'] = convert_workbook(path, cache_path, sheet_names, batch_rows)
+    meta.update({'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': current_hash, 'sheets': sheet_names})
+    with open(meta_path, 'w') as f:
+        json.dump(meta, f)
+    return cache_path
+
+
+# Read a workbook through its Parquet conversion
+def read_workbook(path, cache_path=None, sheet_names=None, columns=None):
+    return pd.read_parquet(workbook_cache(path, cache_path, sheet_names), columns=columns)
+
+
+# Read the customer demographics (LYLTY_CARD_NBR, LIFESTAGE, PREMIUM_CUSTOMER) from CSV or xlsx
+def read_customer_data(path=CUSTOMER_DATA_PATH):
+    if is_workbook(path):
+        return read_workbook(path)
+    return pd.read_csv(path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert an Excel workbook into a cached Parquet file.')
+    parser.add_argument('path')
+    parser.add_argument('--sheets', nargs='+', default=None)
+    parser.add_argument('--output', default=None)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    cache_path = workbook_cache(args.path, args.output, args.sheets)
+    print(f'{args.path} -> {cache_path} ({len(pd.read_parquet(cache_path)):,} rows, {time.perf_counter() - start:.2f} s)')